@@ -0,0 +1,125 @@
+"""
+Head to head benchmark of the storage backends.
+
+Runs the same workload (inserts, point lookups by `mongo_id` and
+`uid`, checksum queries, metadata queries and updates) against each
+backend, with `--concurrency` operations in flight, and prints the
+throughput of each phase.
+
+    python benchmarks/backends.py --config server.cfg -n 20000 mongo sqlite memory
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+
+from tornado.ioloop import IOLoop
+from tornado.gen import coroutine, multi, Return
+
+from file_catalog.config import Config
+
+def make_file(i):
+    return {
+        'uid': 'file_%08d' % i,
+        'checksum': hashlib.sha512(str(i).encode('ascii')).hexdigest(),
+        'locations': ['gsiftp://gridftp.icecube.wisc.edu/data/exp/IceCube/2016/%08d.i3.bz2' % i],
+        'dataset': i % 1000,
+        'run': {'number': i % 5000},
+        'meta_modify_date': '2016-10-%02d 12:00:00.000000' % (i % 28 + 1),
+    }
+
+def make_backend(name, config, db_host):
+    if name == 'mongo':
+        from file_catalog.mongo import Mongo
+        db = Mongo(db_host, **config.get('mongo', {}))
+        db.client.files.drop()
+        db.ensure_indexes()
+    elif name == 'sqlite':
+        from file_catalog.sqlite import SQLite
+        kwargs = dict(config.get('sqlite', {}))
+        kwargs['path'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+        db = SQLite(**kwargs)
+    elif name == 'memory':
+        from file_catalog.memory import Memory
+        db = Memory()
+    else:
+        raise Exception('unknown backend %r' % name)
+    return db
+
+@coroutine
+def call(op):
+    # yield each future on its own: multi() does not wait on
+    # executor futures thread-safely
+    ret = yield op()
+    raise Return(ret)
+
+@coroutine
+def run_phase(name, ops, concurrency):
+    """Run the callables in `ops` (each returning a future), `concurrency` at a time"""
+    start = time.time()
+    for i in range(0, len(ops), concurrency):
+        yield multi([call(op) for op in ops[i:i+concurrency]])
+    elapsed = time.time() - start
+    print('  %-22s %8d ops  %8.2fs  %10.0f ops/s' % (name, len(ops), elapsed,
+                                                    len(ops)/elapsed if elapsed else 0))
+
+@coroutine
+def benchmark(db, n, m, concurrency):
+    files = [make_file(i) for i in range(n)]
+    ids = []
+
+    @coroutine
+    def create(f):
+        ids.append((yield db.create_file(dict(f))))
+
+    yield run_phase('insert', [lambda f=f: create(f) for f in files], concurrency)
+
+    sample = lambda: random.randrange(len(ids))
+    yield run_phase('get by mongo_id',
+                    [lambda i=sample(): db.get_file({'mongo_id': ids[i]}) for _ in range(m)],
+                    concurrency)
+    yield run_phase('get by uid',
+                    [lambda i=sample(): db.get_file({'uid': files[i]['uid']}) for _ in range(m)],
+                    concurrency)
+    yield run_phase('find by checksum',
+                    [lambda i=sample(): db.find_files({'checksum': files[i]['checksum']})
+                     for _ in range(m)], concurrency)
+    yield run_phase('find by dataset',
+                    [lambda i=sample(): db.find_files({'dataset': i % 1000}, limit=100)
+                     for _ in range(m//10)], concurrency)
+    yield run_phase('find by date range',
+                    [lambda: db.find_files({'meta_modify_date': {'$gte': '2016-10-10',
+                                                                 '$lt': '2016-10-11'}},
+                                           limit=100)
+                     for _ in range(m//10)], concurrency)
+    yield run_phase('update',
+                    [lambda i=sample(): db.update_file({'mongo_id': ids[i],
+                                                        'test': random.random()})
+                     for _ in range(m)], concurrency)
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage backend benchmark')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('-n', type=int, default=10000, help='number of files')
+    parser.add_argument('-m', type=int, default=10000, help='number of lookups')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='operations in flight')
+    parser.add_argument('backends', nargs='+', help='mongo, sqlite and/or memory')
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    db_host = args.db_host or config['server']['db_host']
+    for name in args.backends:
+        print(name)
+        db = make_backend(name, config, db_host)
+        IOLoop.current().run_sync(lambda: benchmark(db, args.n, args.m,
+                                                    args.concurrency))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Throughput of the REST API through `file_catalog.client`.
+
+Registers files and looks them up against a running server, comparing
+a new connection per request with the pooled keep-alive connections,
+batched lookups, and the asynchronous client.
+
+    python benchmarks/client.py --url http://localhost:8888 -n 5000 -c 10
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import random
+import hashlib
+import argparse
+
+from tornado.ioloop import IOLoop
+
+from file_catalog.client import Client, AsyncClient
+
+def make_file(prefix, i):
+    return {
+        'uid': '%s_%08d' % (prefix, i),
+        'checksum': hashlib.sha512(('%s %d' % (prefix, i)).encode('ascii')).hexdigest(),
+        'locations': ['gsiftp://gridftp.icecube.wisc.edu/data/bench/%s/%08d.i3.bz2' % (prefix, i)],
+        'dataset': i % 100,
+    }
+
+def report(name, n, func):
+    start = time.time()
+    ret = func()
+    elapsed = time.time() - start
+    print('  %-32s %8d ops  %8.2fs  %10.0f ops/s' % (name, n, elapsed,
+                                                    n/elapsed if elapsed else 0))
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description='REST client benchmark')
+    parser.add_argument('--url', default='http://localhost:8888', help='server url')
+    parser.add_argument('-n', type=int, default=5000, help='number of files')
+    parser.add_argument('-m', type=int, default=5000, help='number of lookups')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='requests in flight')
+    parser.add_argument('--batch-size', type=int, default=1000, help='uids per lookup')
+    args = parser.parse_args()
+
+    # unique uids, so that the benchmark can run again on the same catalog
+    prefix = 'bench%d' % int(time.time())
+    files = [make_file(prefix, i) for i in range(args.n)]
+    uids = [random.choice(files)['uid'] for _ in range(args.m)]
+
+    single = Client(args.url, pool_size=0)
+    pooled = Client(args.url, pool_size=args.concurrency)
+    ids = report('register (pooled, %d at once)' % args.concurrency, args.n,
+                 lambda: pooled.register(files, args.concurrency))
+    ids = [i for i in ids if not isinstance(i, Exception)]
+    sample = [random.choice(ids) for _ in range(args.m)]
+
+    report('get (new connections)', args.m,
+           lambda: [single.get_file(i) for i in sample])
+    report('get (keep-alive)', args.m,
+           lambda: [pooled.get_file(i) for i in sample])
+    report('get (keep-alive, %d at once)' % args.concurrency, args.m,
+           lambda: pooled.map(pooled.get_file, sample, args.concurrency))
+    report('lookup (batches of %d)' % args.batch_size, args.m,
+           lambda: pooled.lookup(uids, batch_size=args.batch_size,
+                                 concurrency=args.concurrency))
+    report('list (pages of 1000)', args.n,
+           lambda: sum(1 for _ in pooled.find_files({'uid': {'$regex': '^' + prefix}},
+                                                    limit=1000)))
+
+    client = AsyncClient(args.url, pool_size=args.concurrency)
+    run = IOLoop.current().run_sync
+    report('async get (%d at once)' % args.concurrency, args.m,
+           lambda: run(lambda: client.map(client.get_file, sample, args.concurrency)))
+    report('async lookup (batches of %d)' % args.batch_size, args.m,
+           lambda: run(lambda: client.lookup(uids, batch_size=args.batch_size)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Size of a synthetic catalog with plain and with compact locations.
+
+Generates file documents with one to three replicas at a few sites,
+encodes their locations with `LocationPrefixes`, and prints the BSON
+size of the documents and the size of the keys a `locations` index
+would hold, for each prefix depth.
+
+    python benchmarks/locations.py -n 100000 --depth 2 3 4
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import random
+import hashlib
+import argparse
+
+from file_catalog.prefixes import LocationPrefixes, doc_size
+
+SITES = [
+    'gsiftp://gridftp.icecube.wisc.edu/data/exp/IceCube/%(year)d/filtered/level2/%(day)s/',
+    'gsiftp://gridftp-scratch.desy.de/pnfs/ifh.de/acs/icecube/archive/data/exp/IceCube/%(year)d/filtered/level2/%(day)s/',
+    'file:///data/exp/IceCube/%(year)d/filtered/level2/%(day)s/',
+    'srm://dcache.ndgf.org:8443/srm/managerv2?SFN=/pnfs/ndgf.org/data/icecube/%(year)d/%(day)s/',
+]
+
+def make_file(i):
+    year = 2010 + i % 8
+    day = '%02d%02d' % (i % 12 + 1, i % 28 + 1)
+    name = 'Level2_IC86.%d_data_Run%08d_Subrun%08d.i3.bz2' % (year, 120000 + i // 100, i % 100)
+    sites = random.sample(SITES, random.randint(1, 3))
+    return {
+        'uid': 'file_%08d' % i,
+        'checksum': hashlib.sha512(str(i).encode('ascii')).hexdigest(),
+        'locations': [s % {'year': year, 'day': day} + name for s in sites],
+        'file_size': random.randint(10**6, 10**9),
+        'dataset': i % 1000,
+        'run': {'number': 120000 + i // 100},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact locations size report')
+    parser.add_argument('-n', type=int, default=100000, help='number of files')
+    parser.add_argument('--depth', type=int, nargs='+', default=[2, 3, 4],
+                        help='prefix depths to compare')
+    args = parser.parse_args()
+
+    random.seed(0)
+    docs = [make_file(i) for i in range(args.n)]
+    plain_docs = sum(doc_size(doc) for doc in docs)
+    plain_keys = sum(len(l.encode('utf-8')) for doc in docs for l in doc['locations'])
+    print('%d files, %d replicas' % (len(docs), sum(len(d['locations']) for d in docs)))
+    print('  %-12s %14s %14s %10s' % ('', 'documents', 'index keys', 'prefixes'))
+    print('  %-12s %14d %14d %10s' % ('plain', plain_docs, plain_keys, '-'))
+    for depth in args.depth:
+        prefixes = LocationPrefixes(None, depth=depth)
+        stored = [prefixes.encode_doc(doc) for doc in docs]
+        size = sum(doc_size(doc) for doc in stored)
+        keys = sum(len(l.encode('utf-8')) for doc in stored for l in doc['locations'])
+        print('  %-12s %14d %14d %10d   (-%.0f%% documents, -%.0f%% keys)' % (
+              'depth %d' % depth, size, keys, len(prefixes.by_prefix),
+              100.0*(plain_docs-size)/plain_docs, 100.0*(plain_keys-keys)/plain_keys))
+
+if __name__ == '__main__':
+    main()
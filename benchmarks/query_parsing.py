@@ -0,0 +1,97 @@
+"""
+Benchmark of `urlargparse.parse` against the previous, recursive
+implementation (kept below as `legacy_parse`, including its debug
+print, with stdout sent to /dev/null while it runs).
+
+Both parsers are first checked to give the same results on the
+benchmark inputs.
+
+    python benchmarks/query_parsing.py -n 20000
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+
+from tornado.escape import json_encode, url_unescape
+
+from file_catalog import urlargparse
+
+def legacy_get_type(val):
+    try:
+        return int(val)
+    except:
+        try:
+            return float(val)
+        except:
+            return val
+
+def legacy_parse_one(key, value, ret, sym='['):
+    print('key',key,'value',value)
+    if key == '[]':
+        ret.append(value)
+    else:
+        if key[0] == '[':
+            key = key[1:]
+        start = key.find(sym)
+        if start < 0:
+            ret[legacy_get_type(key)] = value
+        else:
+            val = legacy_get_type(key[:start])
+            if isinstance(ret,dict) and val not in ret:
+                ret[val] = [] if key[start+1:start+3] == '[]' else {}
+            elif isinstance(ret,list) and len(ret) <= val:
+                ret.append([] if key[start+1:start+3] == '[]' else {})
+            if not key[start+1:]:
+                ret[val] = value
+            else:
+                legacy_parse_one(key[start+1:],value,ret[val],sym=']')
+
+def legacy_parse(data):
+    ret = {}
+    for part in data.split('&'):
+        if part:
+            key, value = url_unescape(part).split('=',1)
+            value = legacy_get_type(value)
+            legacy_parse_one(key, value, ret)
+    return ret
+
+INPUTS = {
+    'paging': {'limit': 100, 'start': 2000},
+    'json query': {'limit': 10, 'query': json_encode({'uid': {'$in': ['file_%d' % i for i in range(50)]}})},
+    'nested': {'query': {'run': {'number': 123, 'subruns': list(range(20))},
+                         'locations': ['gsiftp://host/data/%d' % i for i in range(20)],
+                         'checksum': 'abc'*40, 'size': 1.5}},
+}
+
+def timeit(fn, data, n):
+    start = time.time()
+    for _ in range(n):
+        fn(data)
+    return time.time()-start
+
+def main():
+    parser = argparse.ArgumentParser(description='urlargparse benchmark')
+    parser.add_argument('-n', type=int, default=10000, help='parses per input')
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    for name, value in sorted(INPUTS.items()):
+        data = urlargparse.encode(value)
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            expected = legacy_parse(data)
+            legacy = timeit(legacy_parse, data, args.n)
+        finally:
+            sys.stdout = stdout
+        if urlargparse.parse(data) != expected:
+            raise Exception('results differ for %s' % name)
+        new = timeit(urlargparse.parse, data, args.n)
+        print('%-12s %6d bytes  legacy %8.1fus  new %8.1fus  speedup %5.1fx' % (
+              name, len(data), 1e6*legacy/args.n, 1e6*new/args.n, legacy/new))
+
+if __name__ == '__main__':
+    main()
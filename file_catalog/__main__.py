@@ -1,13 +1,28 @@
 from __future__ import absolute_import, division, print_function
 
+import sys
 import argparse
 import logging
 import os
 
 from file_catalog.server import Server
 from file_catalog.config import Config
+from file_catalog import export, importer, dates, sharded, verify, prefixes
+
+# subcommands, taking the remaining command line arguments
+commands = {
+    'export': export.main,
+    'import': importer.main,
+    'migrate-dates': dates.main,
+    'rebalance': sharded.main,
+    'verify': verify.main,
+    'compact-locations': prefixes.main,
+}
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='File catalog')
     parser.add_argument('-p', '--port', help='port to listen on')
     parser.add_argument('--db_host', help='MongoDB host')
@@ -0,0 +1,276 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+
+from file_catalog.stats import Stats
+from file_catalog.slowlog import SlowQueryLog
+
+class Backend(object):
+    """
+    Interface of the storage backends behind the API handlers.
+
+    All data methods return futures, and take an optional `ctx`
+    keyword with the `RequestContext` of the API request. Documents
+    are identified by `mongo_id`, a 24 character hex string.
+
+    If `stats` (a `file_catalog.stats.Stats`) is set, the writes keep
+    the catalog statistics up to date. If `slow_log` (a
+    `file_catalog.slowlog.SlowQueryLog`) is set, `find_files` records
+    the cost of each query in it.
+    """
+
+    stats = None
+    slow_log = None
+
+    def find_files(self, query={}, limit=None, start=0, fields=None, sort=None,
+                   ctx=None):
+        """
+        Find files matching the mongodb `query`.
+
+        Resolves to a list of `{'mongo_id': ..., 'uid': ...}` dicts,
+        plus the (dotted) `fields` if given, ordered by `sort`, a list
+        of `(field, 1 or -1)` pairs.
+        """
+        raise NotImplementedError()
+
+    def create_file(self, metadata, ctx=None):
+        """Insert a new file. Resolves to its `mongo_id`."""
+        raise NotImplementedError()
+
+    def get_file(self, filters, ctx=None):
+        """Resolves to the first file matching `filters`, or `None`."""
+        raise NotImplementedError()
+
+    def update_file(self, metadata, ctx=None):
+        """Set the fields in `metadata` on the file with its `mongo_id`."""
+        raise NotImplementedError()
+
+    def replace_file(self, metadata, ctx=None):
+        """Replace the file with the `mongo_id` of `metadata`."""
+        raise NotImplementedError()
+
+    def delete_file(self, filters, ctx=None):
+        """Delete the file matching `filters`. Fails if there is none."""
+        raise NotImplementedError()
+
+    def count_files(self, query={}, ctx=None):
+        """Resolves to the number of files matching `query`"""
+        raise NotImplementedError()
+
+    def delete_files(self, query, limit, ctx=None):
+        """
+        Delete up to `limit` files matching `query`. Resolves to the
+        number of files deleted.
+        """
+        raise NotImplementedError()
+
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        """
+        Apply the mongodb `update` to up to `limit` files matching
+        `query` with a `mongo_id` greater than `after`, in `mongo_id`
+        order. Resolves to a `(files, modified, last_mongo_id)` tuple.
+        """
+        raise NotImplementedError()
+
+    def save_job(self, job, owner=None):
+        """
+        Store the job `job` (a dict with an `id`), replacing it. If
+        `owner` is given, only a job still running for `owner` is
+        replaced. Resolves to whether the job was stored.
+        """
+        raise NotImplementedError()
+
+    def claim_job(self, job_id, owner, stale_before):
+        """
+        Atomically mark the job `job_id` as running for `owner`, if it is
+        queued, or running with a `heartbeat` older than `stale_before`
+        (a `time.time()` value). Resolves to the claimed job, or `None`.
+        """
+        raise NotImplementedError()
+
+    def get_job(self, job_id):
+        """Resolves to the job `job_id`, or `None`"""
+        raise NotImplementedError()
+
+    def find_jobs(self, state=None):
+        """Resolves to the jobs (in `state`, if given), newest first"""
+        raise NotImplementedError()
+
+    def delete_job(self, job_id):
+        """Delete the job `job_id` and its result"""
+        raise NotImplementedError()
+
+    def save_job_result(self, job_id, seq, data):
+        """Store chunk number `seq` (a string) of the result of job `job_id`"""
+        raise NotImplementedError()
+
+    def get_job_results(self, job_id, start=0, limit=10):
+        """Resolves to the list of up to `limit` result chunks from number `start` on"""
+        raise NotImplementedError()
+
+    def export_cursor(self, query=None, projection=None, after=None,
+                      batch_size=10000, ctx=None):
+        """
+        An iterable over full documents (with `_id`) in `_id` order,
+        starting after the `mongo_id` `after`. Must not block.
+        """
+        raise NotImplementedError()
+
+    def next_batch(self, cursor, size, transform=None, ctx=None):
+        """
+        Resolves to up to `size` documents from `cursor`, passed
+        through `transform` if given.
+        """
+        raise NotImplementedError()
+
+    def get_stats(self, ctx=None):
+        """Resolves to the catalog statistics (see `file_catalog.stats.summary`)"""
+        raise NotImplementedError()
+
+    def reconcile_stats(self):
+        """Recount the catalog statistics from scratch (blocking)"""
+        raise NotImplementedError()
+
+    def sort_indexes(self, ctx=None):
+        """
+        Resolves to the key patterns (lists of `(field, 1 or -1)`) of
+        the indexes that can return files in sorted order.
+        """
+        raise NotImplementedError()
+
+    def ensure_indexes(self):
+        """Create the indexes the catalog relies on (blocking)"""
+        pass
+
+    def reconfigure(self, **options):
+        """
+        Apply new values of the options of the backend's config section.
+        Returns the names of those that need a restart.
+        """
+        return sorted(options)
+
+    def ping(self, ctx=None):
+        """Resolves once the database answered a trivial command"""
+        raise NotImplementedError()
+
+    def warmup(self, prefetch=0):
+        """
+        Get ready to serve at full speed (blocking): check that the
+        database is reachable, verify the indexes, open the
+        connections and start the threads, and read the `prefetch` most
+        recently modified files so they are in the database cache.
+        Raises if the database cannot be reached.
+        """
+        pass
+
+def sort_is_indexed(sort, indexes, query=None):
+    """
+    Whether some index in `indexes` returns files in `sort` order: the
+    sort keys must be a prefix of the index keys with all directions
+    equal or all reversed. Leading index keys that `query` pins to a
+    single value may be skipped.
+    """
+    if not sort:
+        return True
+    if list(sort) == [('_id', 1)] or list(sort) == [('_id', -1)]:
+        return True
+    query = query or {}
+    for keys in indexes:
+        keys = list(keys)
+        # skip index keys with an equality condition in the query
+        while (keys and keys[0][0] not in [s[0] for s in sort]
+               and keys[0][0] in query and not isinstance(query[keys[0][0]], (dict, list))):
+            keys = keys[1:]
+        if len(keys) < len(sort):
+            continue
+        if all(k[0] == s[0] for k,s in zip(keys, sort)):
+            same = all(k[1] == s[1] for k,s in zip(keys, sort))
+            reverse = all(k[1] == -s[1] for k,s in zip(keys, sort))
+            if same or reverse:
+                return True
+    return False
+
+def job_claimable(job, stale_before):
+    """Whether `claim_job` may take `job` (see `Backend.claim_job`)"""
+    return (job['state'] == 'queued' or
+            (job['state'] == 'running' and job.get('heartbeat', 0) < stale_before))
+
+def project(doc, fields):
+    """The dotted `fields` of `doc`, as a nested dict like a mongodb projection"""
+    ret = {}
+    for field in fields:
+        parts = field.split('.')
+        src, dst = doc, ret
+        for part in parts[:-1]:
+            if not isinstance(src, dict) or part not in src:
+                break
+            src = src[part]
+            dst = dst.setdefault(part, {})
+        else:
+            if isinstance(src, dict) and parts[-1] in src:
+                dst[parts[-1]] = src[parts[-1]]
+    return ret
+
+def apply_update(doc, update):
+    """
+    Apply a mongodb `update` with `$set`, `$unset` (dotted fields),
+    `$addToSet` (with `$each`) and `$pull` (with `$in`) to `doc` in place.
+    """
+    for field, value in update.get('$set', {}).items():
+        parts = field.split('.')
+        d = doc
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+            if not isinstance(d, dict):
+                raise Exception('cannot set %r' % field)
+        d[parts[-1]] = copy.deepcopy(value)
+    for field in update.get('$unset', {}):
+        parts = field.split('.')
+        d = doc
+        for part in parts[:-1]:
+            d = d.get(part) if isinstance(d, dict) else None
+        if isinstance(d, dict):
+            d.pop(parts[-1], None)
+    for field, value in update.get('$addToSet', {}).items():
+        values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+        current = doc.setdefault(field, [])
+        if not isinstance(current, list):
+            raise Exception('cannot $addToSet to %r' % field)
+        for v in values:
+            if v not in current:
+                current.append(copy.deepcopy(v))
+    for field, value in update.get('$pull', {}).items():
+        values = value['$in'] if isinstance(value, dict) and '$in' in value else [value]
+        if isinstance(doc.get(field), list):
+            doc[field] = [v for v in doc[field] if v not in values]
+    return doc
+
+def create_backend(config, db_host=None):
+    """Create the storage backend selected by `backend` in `[server]`"""
+    name = config.get('server', {}).get('backend', 'mongo')
+    stats = Stats(**config.get('stats', {}))
+    if not stats.enabled:
+        stats = None
+    slow_log = SlowQueryLog(**config.get('slow_queries', {}))
+    if not slow_log.enabled:
+        slow_log = None
+    if name == 'mongo':
+        from file_catalog.mongo import Mongo
+        sharding = dict(config.get('sharding', {}))
+        hosts = sharding.pop('hosts', None)
+        if hosts:
+            from file_catalog.sharded import Sharded
+            # each host is a shard; causal tokens cannot span several
+            options = dict(config.get('mongo', {}), uri=None, causal_consistency=False)
+            shards = [Mongo(host, stats=stats, slow_log=slow_log, **options)
+                      for host in hosts]
+            return Sharded(shards, stats=stats, slow_log=slow_log, **sharding)
+        return Mongo(db_host, stats=stats, slow_log=slow_log, **config.get('mongo', {}))
+    elif name == 'memory':
+        from file_catalog.memory import Memory
+        return Memory(stats=stats, slow_log=slow_log)
+    elif name == 'sqlite':
+        from file_catalog.sqlite import SQLite
+        return SQLite(stats=stats, slow_log=slow_log, **config.get('sqlite', {}))
+    else:
+        raise Exception('unknown backend %r' % name)
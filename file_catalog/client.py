@@ -0,0 +1,490 @@
+"""
+Clients of the file catalog REST API.
+
+`Client` is a blocking client keeping its HTTP connections alive in a
+pool, safe to share between threads. `AsyncClient` has the same methods
+as Tornado coroutines (awaitable from asyncio code on Python 3).
+
+Both retry requests answered with 429 or 503 after the `Retry-After`
+the server sends, or an exponential backoff, and pass on the
+`X-Causal-Token` of their last response, so that a read sees the
+client's own writes.
+
+    client = Client('http://localhost:8888')
+    mongo_ids = client.register([{'uid': ..., 'checksum': ..., 'locations': [...]}, ...])
+    for f in client.find_files({'dataset': 123}, fields=['locations']):
+        ...
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import zlib
+import random
+import socket
+import threading
+from collections import deque
+
+try:
+    import httplib as http_client
+    from urlparse import urlparse, urljoin
+except ImportError:
+    import http.client as http_client
+    from urllib.parse import urlparse, urljoin
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.escape import json_encode, json_decode, utf8
+from tornado.gen import coroutine, sleep, Return
+
+from file_catalog import urlargparse
+
+# responses asking to come back later
+RETRY_STATUS = (429, 503)
+
+# response headers the clients look at
+RESPONSE_HEADERS = ('ETag', 'Retry-After', 'X-Causal-Token')
+
+class FileCatalogError(Exception):
+    """An error response of the file catalog"""
+    def __init__(self, status, data=None):
+        self.status = status
+        self.data = data or {}
+        message = self.data.get('message') if isinstance(self.data, dict) else None
+        super(FileCatalogError, self).__init__('%d: %s' % (status, message or 'request failed'))
+
+def batches(items, size):
+    """Split the list `items` into lists of at most `size` items"""
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+class BaseClient(object):
+    """
+    Request building and response handling of the clients.
+
+    Args:
+        url (str): base url of the server, e.g. `http://localhost:8888`
+        timeout (float): seconds to wait for a response
+        retries (int): retries of requests answered with 429 or 503
+        backoff (float): first retry delay in seconds, doubled per retry
+        max_backoff (float): longest retry delay
+        pool_size (int): connections kept alive (and concurrent requests
+            of `AsyncClient`)
+        headers (dict): extra headers of every request
+    """
+    def __init__(self, url, timeout=60, retries=5, backoff=0.5, max_backoff=30,
+                 pool_size=10, headers=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.headers = dict(headers or {})
+        self.causal_token = None
+
+    def full_url(self, path, args=None):
+        """The url of `path` (a url, absolute, or relative to `/api`) with the query `args`"""
+        if '://' in path:
+            url = path
+        else:
+            url = self.url + (path if path.startswith('/') else '/api/' + path)
+        if args:
+            url += ('&' if '?' in url else '?') + urlargparse.encode(args)
+        return url
+
+    def request_headers(self, body, headers=None):
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
+        headers.update(self.headers)
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        if self.causal_token:
+            headers['X-Causal-Token'] = self.causal_token
+        return headers
+
+    def retry_delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (from 0)"""
+        try:
+            return min(float(retry_after), self.max_backoff)
+        except (TypeError, ValueError):
+            delay = min(self.backoff * 2**attempt, self.max_backoff)
+            # jitter, so that throttled clients do not come back at once
+            return delay * random.uniform(0.5, 1)
+
+    def handle_response(self, status, headers, data):
+        """
+        The decoded body and the headers of a response, raising
+        `FileCatalogError` for errors.
+        """
+        token = headers.get('X-Causal-Token')
+        if token:
+            self.causal_token = token
+        ret = json_decode(data) if data else None
+        if status >= 400:
+            raise FileCatalogError(status, ret)
+        return ret, headers
+
+    @staticmethod
+    def files_args(query, fields, sort, limit, kwargs):
+        """Query arguments of `GET /api/files`"""
+        args = dict(kwargs)
+        if query is not None:
+            args['query'] = json_encode(query)
+        if fields:
+            args['fields'] = list(fields)
+        if sort:
+            if isinstance(sort, (list, tuple)):
+                sort = ','.join(('-' if d < 0 else '') + k for k, d in sort)
+            args['sort'] = sort
+        if limit:
+            args['limit'] = limit
+        return args
+
+    @staticmethod
+    def lookup_body(uids, fields):
+        body = {'query': {'uid': {'$in': uids}}, 'limit': len(uids)}
+        if fields:
+            body['fields'] = list(fields)
+        return body
+
+    @staticmethod
+    def mongo_id(ret):
+        """The `mongo_id` of a file created or extended by `POST /api/files`"""
+        return ret['file'].rstrip('/').rsplit('/', 1)[-1]
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to one server"""
+    def __init__(self, url, size=10, timeout=60):
+        parsed = urlparse(url)
+        self.conn_class = (http_client.HTTPSConnection if parsed.scheme == 'https'
+                           else http_client.HTTPConnection)
+        self.netloc = parsed.netloc
+        self.size = size
+        self.timeout = timeout
+        self.idle = deque()
+        self.lock = threading.Lock()
+
+    def get(self):
+        """A connection, and whether it was used before"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.conn_class(self.netloc, timeout=self.timeout), False
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+class Client(BaseClient):
+    """Blocking client, see `BaseClient` for the arguments"""
+    def __init__(self, url, **kwargs):
+        super(Client, self).__init__(url, **kwargs)
+        self.pool = ConnectionPool(self.url, self.pool_size, self.timeout)
+        self.executor = None
+
+    def close(self):
+        self.pool.close()
+        if self.executor:
+            self.executor.shutdown()
+
+    def map(self, func, items, concurrency):
+        """`func` of each of `items` on `concurrency` threads"""
+        if concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max(concurrency, self.pool_size))
+        futures = [self.executor.submit(func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def send(self, method, url, body=None, headers=None):
+        """Send one request, returning the status, headers and body"""
+        parsed = urlparse(url)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        headers = self.request_headers(body, headers)
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # the server closed the idle connection
+                    continue
+                raise
+            break
+        if (resp.getheader('Connection') or '').lower() == 'close':
+            conn.close()
+        else:
+            self.pool.put(conn)
+        if (resp.getheader('Content-Encoding') or '').lower() == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return resp.status, {k: resp.getheader(k) for k in RESPONSE_HEADERS}, data
+
+    def fetch(self, method, path, body=None, args=None, headers=None):
+        """
+        Request `path` (see `full_url`), retrying on 429 and 503.
+
+        Returns the decoded JSON response and the response headers, or
+        raises `FileCatalogError`.
+        """
+        url = self.full_url(path, args)
+        if body is not None:
+            body = utf8(json_encode(body))
+        attempt = 0
+        while True:
+            status, resp_headers, data = self.send(method, url, body, headers)
+            if status not in RETRY_STATUS or attempt >= self.retries:
+                return self.handle_response(status, resp_headers, data)
+            time.sleep(self.retry_delay(attempt, resp_headers.get('Retry-After')))
+            attempt += 1
+
+    def request(self, method, path, body=None, args=None):
+        """Like `fetch`, returning the decoded JSON response only"""
+        return self.fetch(method, path, body, args)[0]
+
+    def get_file(self, mongo_id):
+        """The metadata of a file, or None if it does not exist"""
+        try:
+            return self.request('GET', 'files/' + mongo_id)
+        except FileCatalogError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def create_file(self, metadata):
+        """Register a file (or add its locations as replicas), returning its mongo_id"""
+        return self.mongo_id(self.request('POST', 'files', metadata))
+
+    def modify_file(self, method, mongo_id, metadata, etag=None):
+        if etag is None:
+            etag = self.fetch('GET', 'files/' + mongo_id)[1]['ETag']
+        return self.fetch(method, 'files/' + mongo_id, metadata,
+                          headers={'If-None-Match': etag})[0]
+
+    def update_file(self, mongo_id, metadata, etag=None):
+        """
+        Update some fields of a file, returning its metadata. The update
+        fails with a 409 if the file changed since it was read with the
+        `ETag` header `etag` (default: read it now).
+        """
+        return self.modify_file('PATCH', mongo_id, metadata, etag)
+
+    def replace_file(self, mongo_id, metadata, etag=None):
+        """Replace the metadata of a file, see `update_file`"""
+        return self.modify_file('PUT', mongo_id, metadata, etag)
+
+    def delete_file(self, mongo_id):
+        self.request('DELETE', 'files/' + mongo_id)
+
+    def stats(self):
+        return self.request('GET', 'stats')
+
+    def find_files(self, query=None, fields=None, sort=None, limit=None, **kwargs):
+        """
+        Iterate over the files matching `query`, requesting pages of
+        `limit` files (default: the server maximum) and following the
+        `next` links. `sort` is a string like `-meta_modify_date,uid` or
+        a list of `(field, 1 or -1)`.
+        """
+        ret = self.request('GET', 'files', args=self.files_args(query, fields, sort, limit, kwargs))
+        while True:
+            for f in ret['_embedded']['files']:
+                yield f
+            next_link = ret['_links'].get('next')
+            if not next_link:
+                break
+            ret = self.request('GET', urljoin(self.url + '/', next_link['href']))
+
+    def lookup(self, uids, fields=None, batch_size=1000, concurrency=1):
+        """
+        The files of `uids` as a dict by uid (missing uids are left out),
+        querying `batch_size` uids per request.
+        """
+        def query(batch):
+            body = self.lookup_body(batch, fields)
+            files = []
+            while True:
+                ret = self.request('POST', 'files/query', body)
+                files.extend(ret['_embedded']['files'])
+                # pages are capped at `max_files` of the server
+                next_link = ret['_links'].get('next')
+                if not next_link or len(files) >= len(batch):
+                    return files
+                body['start'] = next_link['start']
+        ret = {}
+        for files in self.map(query, batches(list(uids), batch_size), concurrency):
+            for f in files:
+                ret[f['uid']] = f
+        return ret
+
+    def register(self, files, concurrency=None):
+        """
+        Register the metadata of many `files`, `concurrency` (default
+        `pool_size`) at a time. Returns for each file its mongo_id, or
+        the `FileCatalogError` it failed with (e.g. a 409 conflict).
+        """
+        def create(metadata):
+            try:
+                return self.create_file(metadata)
+            except FileCatalogError as e:
+                return e
+        return self.map(create, list(files), concurrency or self.pool_size)
+
+class AsyncClient(BaseClient):
+    """
+    Non-blocking client, see `BaseClient` for the arguments. Keeps
+    connections alive if pycurl is installed.
+    """
+    def __init__(self, url, **kwargs):
+        super(AsyncClient, self).__init__(url, **kwargs)
+        try:
+            import pycurl
+            from tornado.curl_httpclient import CurlAsyncHTTPClient as http_class
+        except ImportError:
+            from tornado.simple_httpclient import SimpleAsyncHTTPClient as http_class
+        self.http = http_class(force_instance=True, max_clients=self.pool_size)
+
+    def close(self):
+        self.http.close()
+
+    @coroutine
+    def map(self, func, items, concurrency):
+        """`func` (a coroutine) of each of `items`, `concurrency` at a time"""
+        ret = [None]*len(items)
+        todo = deque(enumerate(items))
+
+        @coroutine
+        def worker():
+            while todo:
+                i, item = todo.popleft()
+                ret[i] = yield func(item)
+
+        workers = [worker() for _ in range(max(1, min(concurrency, len(items))))]
+        for w in workers:
+            yield w
+        raise Return(ret)
+
+    @coroutine
+    def fetch(self, method, path, body=None, args=None, headers=None):
+        """
+        Request `path` (see `full_url`), retrying on 429 and 503.
+
+        Resolves to the decoded JSON response and the response headers,
+        or raises `FileCatalogError`.
+        """
+        url = self.full_url(path, args)
+        if body is not None:
+            body = utf8(json_encode(body))
+        elif method in ('POST', 'PUT', 'PATCH'):
+            body = b''
+        attempt = 0
+        while True:
+            resp = yield self.http.fetch(url, method=method, body=body,
+                                         headers=self.request_headers(body, headers),
+                                         request_timeout=self.timeout,
+                                         allow_nonstandard_methods=True,
+                                         raise_error=False)
+            if resp.code == 599:
+                raise resp.error
+            if resp.code not in RETRY_STATUS or attempt >= self.retries:
+                raise Return(self.handle_response(resp.code, resp.headers, resp.body))
+            yield sleep(self.retry_delay(attempt, resp.headers.get('Retry-After')))
+            attempt += 1
+
+    @coroutine
+    def request(self, method, path, body=None, args=None):
+        """Like `fetch`, resolving to the decoded JSON response only"""
+        ret = yield self.fetch(method, path, body, args)
+        raise Return(ret[0])
+
+    @coroutine
+    def get_file(self, mongo_id):
+        """The metadata of a file, or None if it does not exist"""
+        try:
+            ret = yield self.request('GET', 'files/' + mongo_id)
+        except FileCatalogError as e:
+            if e.status != 404:
+                raise
+            ret = None
+        raise Return(ret)
+
+    @coroutine
+    def create_file(self, metadata):
+        """Register a file (or add its locations as replicas), resolving to its mongo_id"""
+        ret = yield self.request('POST', 'files', metadata)
+        raise Return(self.mongo_id(ret))
+
+    @coroutine
+    def modify_file(self, method, mongo_id, metadata, etag=None):
+        if etag is None:
+            ret = yield self.fetch('GET', 'files/' + mongo_id)
+            etag = ret[1]['ETag']
+        ret = yield self.fetch(method, 'files/' + mongo_id, metadata,
+                               headers={'If-None-Match': etag})
+        raise Return(ret[0])
+
+    def update_file(self, mongo_id, metadata, etag=None):
+        """Like `Client.update_file`"""
+        return self.modify_file('PATCH', mongo_id, metadata, etag)
+
+    def replace_file(self, mongo_id, metadata, etag=None):
+        return self.modify_file('PUT', mongo_id, metadata, etag)
+
+    def delete_file(self, mongo_id):
+        return self.request('DELETE', 'files/' + mongo_id)
+
+    def stats(self):
+        return self.request('GET', 'stats')
+
+    @coroutine
+    def find_files(self, query=None, fields=None, sort=None, limit=None, **kwargs):
+        """Like `Client.find_files`, but resolves to the list of all files"""
+        ret = yield self.request('GET', 'files',
+                                 args=self.files_args(query, fields, sort, limit, kwargs))
+        files = []
+        while True:
+            files.extend(ret['_embedded']['files'])
+            next_link = ret['_links'].get('next')
+            if not next_link:
+                break
+            ret = yield self.request('GET', urljoin(self.url + '/', next_link['href']))
+        raise Return(files)
+
+    @coroutine
+    def lookup(self, uids, fields=None, batch_size=1000, concurrency=None):
+        """Like `Client.lookup`, with `concurrency` (default `pool_size`) requests at a time"""
+        @coroutine
+        def query(batch):
+            body = self.lookup_body(batch, fields)
+            files = []
+            while True:
+                ret = yield self.request('POST', 'files/query', body)
+                files.extend(ret['_embedded']['files'])
+                next_link = ret['_links'].get('next')
+                if not next_link or len(files) >= len(batch):
+                    raise Return(files)
+                body['start'] = next_link['start']
+        pages = yield self.map(query, batches(list(uids), batch_size),
+                               concurrency or self.pool_size)
+        raise Return({f['uid']: f for files in pages for f in files})
+
+    @coroutine
+    def register(self, files, concurrency=None):
+        """Like `Client.register`"""
+        @coroutine
+        def create(metadata):
+            try:
+                ret = yield self.create_file(metadata)
+            except FileCatalogError as e:
+                ret = e
+            raise Return(ret)
+        ret = yield self.map(create, list(files), concurrency or self.pool_size)
+        raise Return(ret)
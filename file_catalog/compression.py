@@ -0,0 +1,169 @@
+"""
+Negotiated response compression.
+
+gzip is always available; brotli (`br`) and zstandard (`zstd`) are
+used when the `brotli` or `zstandard` modules are installed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import zlib
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.web import OutputTransform
+
+from file_catalog.metrics import metrics
+from file_catalog.config import set_options
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('compression')
+
+def available_encodings():
+    ret = ['gzip']
+    if brotli:
+        ret.append('br')
+    if zstandard:
+        ret.append('zstd')
+    return ret
+
+def parse_accept_encoding(header):
+    """Parse an `Accept-Encoding` header into a dict of encoding: q-value"""
+    ret = {}
+    for part in header.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        ret[name.strip().lower()] = q
+    return ret
+
+class Compression(object):
+    """
+    Compression settings of the server.
+
+    Args:
+        enabled: compress responses at all
+        encodings: supported encodings in order of preference
+        gzip_level: zlib level (1-9)
+        brotli_quality: brotli quality (0-11)
+        zstd_level: zstandard level (1-22)
+        min_length: smaller bodies are sent uncompressed
+        offload_length: larger bodies are compressed on a thread pool
+                        instead of the IOLoop (see `APIHandler.write_large`)
+        threads: size of that thread pool
+    """
+    # compressible mime types, in addition to any type beginning with "text/"
+    CONTENT_TYPES = set(['application/hal+json', 'application/json',
+                         'application/javascript', 'application/x-ndjson',
+                         'application/xml', 'image/svg+xml'])
+
+    def __init__(self, enabled=True, encodings='zstd, br, gzip',
+                 gzip_level=6, brotli_quality=5, zstd_level=3,
+                 min_length=1024, offload_length=1048576, threads=2):
+        self.enabled = enabled
+        self.encodings = self.supported(encodings)
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.min_length = min_length
+        self.offload_length = offload_length
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    # options `reconfigure` can change
+    LIVE_OPTIONS = ('enabled', 'encodings', 'gzip_level', 'brotli_quality',
+                    'zstd_level', 'min_length', 'offload_length')
+
+    @staticmethod
+    def supported(encodings):
+        """The available ones of `encodings` (a list or comma separated string)"""
+        if not isinstance(encodings, (list, tuple)):
+            encodings = [e.strip() for e in encodings.split(',') if e.strip()]
+        available = available_encodings()
+        return [e for e in encodings if e in available]
+
+    def reconfigure(self, **options):
+        """Apply new settings; returns the names of those needing a restart"""
+        if 'encodings' in options:
+            options['encodings'] = self.supported(options['encodings'])
+        return set_options(self, options, self.LIVE_OPTIONS)
+
+    def compressible_type(self, ctype):
+        return ctype.startswith('text/') or ctype in self.CONTENT_TYPES
+
+    def negotiate(self, accept_encoding):
+        """Pick our preferred encoding among those the client accepts"""
+        if not (self.enabled and accept_encoding):
+            return None
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in self.encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
+    def compress(self, data, encoding):
+        """Compress the bytes `data` with `encoding`, recording metrics"""
+        if encoding == 'gzip':
+            # wbits=31 selects the gzip container
+            c = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            ret = c.compress(data) + c.flush()
+        elif encoding == 'br':
+            ret = brotli.compress(data, quality=self.brotli_quality)
+        elif encoding == 'zstd':
+            ret = zstandard.ZstdCompressor(level=self.zstd_level).compress(data)
+        else:
+            raise Exception('unknown encoding %r' % encoding)
+        metrics.incr('compression.responses.'+encoding)
+        metrics.incr('compression.bytes_in', len(data))
+        metrics.incr('compression.bytes_out', len(ret))
+        metrics.incr('compression.bytes_saved', len(data)-len(ret))
+        return ret
+
+    def transform(self, request):
+        """Factory for tornado's `transforms` application setting"""
+        return CompressionTransform(self, request)
+
+class CompressionTransform(OutputTransform):
+    """
+    Compresses complete responses with the negotiated encoding.
+
+    Streamed responses (written in several chunks) and responses that
+    already carry a `Content-Encoding` are left alone.
+    """
+    def __init__(self, compression, request):
+        self.compression = compression
+        self.encoding = compression.negotiate(request.headers.get('Accept-Encoding', ''))
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.encoding:
+            ctype = headers.get('Content-Type', '').split(';')[0]
+            if (finishing and len(chunk) >= self.compression.min_length
+                and self.compression.compressible_type(ctype)
+                and 'Content-Encoding' not in headers):
+                chunk = self.compression.compress(chunk, self.encoding)
+                headers['Content-Encoding'] = self.encoding
+                headers['Content-Length'] = str(len(chunk))
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        return chunk
@@ -3,6 +3,10 @@ from ConfigParser import SafeConfigParser
 
 import os
 import ast
+import logging
+import numbers
+
+logger = logging.getLogger('config')
 
 class Config(dict):
     def __init__(self, path):
@@ -40,3 +44,111 @@ class Config(dict):
         value = self[section][name]
         return [e.strip() for e in value.split(',') if e.strip()]
 
+
+def set_options(obj, options, live):
+    """
+    Set the attributes of `obj` named like the `options` listed in
+    `live`. Returns the names of the other options, which need a restart.
+    """
+    for name in live:
+        if name in options:
+            setattr(obj, name, options[name])
+    return sorted(set(options) - set(live))
+
+def same_kind(old, new):
+    """Whether `new` can replace the option value `old` (a number by a number, ...)"""
+    for kind in (bool, numbers.Number, basestring, (list, tuple), dict):
+        if isinstance(old, kind):
+            return isinstance(new, kind)
+    return True
+
+class LiveConfig(object):
+    """
+    The configuration of a running server, replaced as a whole by
+    `reload()`. A request handler takes `current` once, so it never
+    sees a half-updated configuration.
+
+    Args:
+        config: the `Config` the server started with
+        per_request: `{section: options}` read from `current` when
+                     needed, so they change live (`None` for all
+                     options of a section)
+        components: `{section: object}`, the object configured by each
+                    section. Its `reconfigure(**options)` applies the
+                    changed options it can, and returns the names of
+                    the others.
+    """
+    def __init__(self, config, per_request=None, components=None):
+        self.current = config
+        self.per_request = per_request or {}
+        self.components = components or {}
+
+    def is_per_request(self, section, option):
+        if section not in self.per_request:
+            return False
+        options = self.per_request[section]
+        return options is None or option in options
+
+    def reload(self):
+        """
+        Re-read the configuration file and apply what changed. Options
+        that only take effect after a restart keep their current value
+        until then.
+
+        Nothing changes if the file cannot be read, or if a changed
+        value is of another kind than before (e.g. text for a number).
+
+        Returns the `section.option` names that were `applied` and those
+        that `need_restart`.
+        """
+        old = self.current
+        if not os.path.exists(old.path):
+            raise Exception('config file %s not found' % old.path)
+        new = Config(old.path)
+
+        changed = {}
+        errors = []
+        for section in set(old) | set(new):
+            old_options = old.get(section, {})
+            new_options = new.get(section, {})
+            for option in set(old_options) | set(new_options):
+                if (option in old_options and option in new_options
+                    and old_options[option] == new_options[option]):
+                    continue
+                if (option in old_options and option in new_options
+                    and not same_kind(old_options[option], new_options[option])):
+                    errors.append('%s.%s: %r' % (section, option, new_options[option]))
+                changed.setdefault(section, set()).add(option)
+        if errors:
+            raise Exception('invalid values: ' + ', '.join(sorted(errors)))
+
+        applied = []
+        need_restart = []
+        for section, options in changed.items():
+            new_options = new.setdefault(section, {})
+            # removed options keep the value in use until a restart
+            live = {name: new_options[name] for name in options if name in new_options}
+            restart = options - set(live)
+            component = self.components.get(section)
+            if component is not None:
+                if live:
+                    restart.update(component.reconfigure(**live))
+            else:
+                restart.update(name for name in live
+                               if not self.is_per_request(section, name))
+            for name in options:
+                if name not in restart:
+                    applied.append(section+'.'+name)
+                    continue
+                need_restart.append(section+'.'+name)
+                if name in old.get(section, {}):
+                    new_options[name] = old[section][name]
+                else:
+                    del new_options[name]
+
+        self.current = new
+        applied.sort()
+        need_restart.sort()
+        logger.info('configuration reloaded: %d options applied (%s), %d need a restart (%s)',
+                    len(applied), ', '.join(applied), len(need_restart), ', '.join(need_restart))
+        return {'applied': applied, 'need_restart': need_restart}
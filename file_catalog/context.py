@@ -0,0 +1,31 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from file_catalog.timing import Timings
+
+class RequestContext(object):
+    """Per-request state handed from the API handlers to the database layer"""
+    def __init__(self, deadline=None, read_only=False, causal_token=None):
+        # `time.time()` value by which database calls must have started
+        self.deadline = deadline
+
+        # reads of read-only requests may be served by a secondary
+        self.read_only = read_only
+
+        # opaque token of the client's last observed operation, used to
+        # read its own writes; updated by every database call
+        self.causal_token = causal_token
+
+        # time spent in each phase of the request
+        self.timings = Timings()
+
+    @classmethod
+    def from_timeout(cls, timeout, start=None, **kwargs):
+        """Create a context with a deadline `timeout` seconds after `start`"""
+        if start is None:
+            start = time.time()
+        return cls(deadline=(start + timeout) if timeout else None, **kwargs)
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
@@ -0,0 +1,167 @@
+"""
+Modification dates.
+
+`meta_modify_date` is stored as a native date (a BSON datetime in
+MongoDB), so range queries on it use the index and compare correctly.
+Older catalogs stored it as a string; `main()` converts those in place,
+in small batches, while the server keeps running:
+
+    python -m file_catalog migrate-dates --config server.cfg
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import logging
+import argparse
+import datetime
+
+logger = logging.getLogger('dates')
+
+# accepted string formats, most specific first
+DATE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+)
+
+def parse_date(value):
+    """
+    Parse a UTC date as written by `str(datetime)` (the old stored
+    format), ISO 8601 with an optional trailing `Z`, or a plain
+    `YYYY-MM-DD`. Raises `ValueError` for anything else.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if not isinstance(value, (str, type(u''))):
+        raise ValueError('date is not a string: %r' % (value,))
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid date %r' % value)
+
+def set_last_modification_date(d):
+    """Set `meta_modify_date` of the document `d` to now"""
+    # MongoDB keeps dates to the millisecond: truncate, so that the
+    # response (and its ETag) matches the document read back later
+    now = datetime.datetime.utcnow()
+    d['meta_modify_date'] = now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def modified_filter(since=None, before=None):
+    """
+    The `meta_modify_date` condition for files modified at or after
+    `since` and before `before` (either may be `None`).
+    """
+    cond = {}
+    if since is not None:
+        cond['$gte'] = parse_date(since)
+    if before is not None:
+        cond['$lt'] = parse_date(before)
+    return cond
+
+def add_modified_filter(query, since=None, before=None):
+    """Restrict `query` to a modification date range, returning the new query"""
+    cond = modified_filter(since, before)
+    if not cond:
+        return query
+    query = dict(query or {})
+    if 'meta_modify_date' in query:
+        return {'$and': [query, {'meta_modify_date': cond}]}
+    query['meta_modify_date'] = cond
+    return query
+
+def migrate_dates(files, batch_size=1000, pause=0, dry_run=False):
+    """
+    Convert the string `meta_modify_date` values of the collection
+    `files` to datetimes.
+
+    Documents are walked in `_id` order, `batch_size` at a time, and
+    each batch is written with one unordered `bulk_write`. An update only
+    applies if the document still holds the string that was read, so a
+    file modified by the server in the meantime (which then has a
+    datetime already) is left alone. Converted documents no longer match,
+    so an interrupted migration simply continues when run again.
+
+    Returns the counters `converted`, `changed` (modified concurrently)
+    and `invalid` (unparseable, left as is).
+    """
+    from pymongo import UpdateOne
+
+    counts = {'converted': 0, 'changed': 0, 'invalid': 0}
+    after = None
+    start = time.time()
+    while True:
+        query = {'meta_modify_date': {'$type': 'string'}}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        batch = list(files.find(query, projection=['meta_modify_date'],
+                                sort=[('_id', 1)], limit=batch_size))
+        if not batch:
+            break
+        after = batch[-1]['_id']
+
+        requests = []
+        for doc in batch:
+            value = doc['meta_modify_date']
+            try:
+                date = parse_date(value)
+            except ValueError:
+                logger.warn('%s: cannot parse meta_modify_date %r', doc['_id'], value)
+                counts['invalid'] += 1
+                continue
+            requests.append(UpdateOne({'_id': doc['_id'], 'meta_modify_date': value},
+                                      {'$set': {'meta_modify_date': date}}))
+        if requests and not dry_run:
+            result = files.bulk_write(requests, ordered=False)
+            counts['converted'] += result.modified_count
+            counts['changed'] += len(requests) - result.modified_count
+        else:
+            counts['converted'] += len(requests)
+
+        elapsed = time.time() - start
+        logger.info('%d converted, %d changed concurrently, %d invalid (%.0f docs/s)',
+                    counts['converted'], counts['changed'], counts['invalid'],
+                    counts['converted'] / elapsed if elapsed > 0 else 0)
+        if pause:
+            time.sleep(pause)
+    return counts
+
+def main(argv=None):
+    from file_catalog.config import Config
+    from file_catalog.backend import create_backend
+
+    parser = argparse.ArgumentParser(prog='file_catalog migrate-dates',
+            description='Convert string meta_modify_date values to dates')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents per bulk write')
+    parser.add_argument('--pause', type=float, default=0.1,
+                        help='seconds to sleep between batches, to limit the load')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only count the values to convert')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+    config = Config(args.config)
+    db = create_backend(config, args.db_host or config['server']['db_host'])
+    shards = getattr(db, 'shards', [db])
+    if not all(hasattr(shard, 'client') for shard in shards):
+        raise Exception('migrating dates needs the mongo backend')
+    counts = {'converted': 0, 'changed': 0, 'invalid': 0}
+    for i, shard in enumerate(shards):
+        if len(shards) > 1:
+            logger.info('shard %d', i)
+        shard_counts = migrate_dates(shard.client.files, batch_size=args.batch_size,
+                                     pause=args.pause, dry_run=args.dry_run)
+        for k, v in shard_counts.items():
+            counts[k] += v
+    logger.info('done: %d converted, %d changed concurrently, %d invalid',
+                counts['converted'], counts['changed'], counts['invalid'])
@@ -0,0 +1,185 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+import threading
+from functools import wraps, partial
+
+from concurrent.futures import ThreadPoolExecutor
+
+from file_catalog.metrics import metrics
+
+class Overloaded(Exception):
+    """Work was refused to protect the server; the client should retry later"""
+    pass
+
+class QueueFull(Overloaded):
+    pass
+
+class DeadlineExceeded(Overloaded):
+    pass
+
+# kinds of database calls, which may each have a thread pool of their own:
+# single-file lookups, list queries, single-file writes, and bulk or admin
+# work (multi-file updates, jobs, exports, statistics)
+WORKLOADS = ('point', 'list', 'write', 'bulk')
+
+def run_on_executor(method=None, workload=None):
+    """
+    Run `method` on `self.executor` (a `BoundedExecutor`), returning a future.
+
+    Used as `@run_on_executor(workload='point')`, the call runs on the
+    pool of that workload in `self.executors` (`WorkloadExecutors`), if
+    the object has one.
+
+    If a `ctx` keyword (`RequestContext`) is given, the call must start
+    before its deadline, otherwise it fails with `DeadlineExceeded`
+    without touching the database. The time spent waiting for a thread
+    and running `method` is added to the `wait` and `db` phases of
+    `ctx.timings`.
+    """
+    if method is None:
+        return partial(run_on_executor, workload=workload)
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        executor = self.executor
+        if workload and getattr(self, 'executors', None):
+            executor = self.executors.get(workload)
+        ctx = kwargs.get('ctx')
+        if ctx is None:
+            return executor.submit(method, self, *args, **kwargs)
+        submitted = time.time()
+        def timed():
+            start = time.time()
+            ctx.timings.add('wait', start-submitted)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                ctx.timings.add('db', time.time()-start)
+        return executor.submit_before(ctx.deadline, timed)
+    return wrapper
+
+class Rendezvous(object):
+    """
+    Makes callers of `wait` block until `n` of them are waiting, so
+    that calls on `n` threads overlap. Gives up after `timeout` seconds.
+    """
+    def __init__(self, n, timeout=10):
+        self.n = n
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.arrived = 0
+        self.event = threading.Event()
+
+    def wait(self):
+        with self.lock:
+            self.arrived += 1
+            if self.arrived >= self.n:
+                self.event.set()
+        self.event.wait(self.timeout)
+
+class BoundedExecutor(object):
+    """
+    A ThreadPoolExecutor with a bounded queue.
+
+    At most `max_workers` calls run at once and at most `max_queue` wait
+    for a thread. Submitting beyond that raises `QueueFull` right away
+    instead of letting the backlog (and latency) grow without limit.
+    """
+    def __init__(self, max_workers=10, max_queue=100, name='executor'):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.name = name
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_before(None, fn, *args, **kwargs)
+
+    def submit_before(self, deadline, fn, *args, **kwargs):
+        """
+        Submit `fn`, which must start running before `deadline`
+        (a `time.time()` value, or `None` for no deadline).
+
+        If the deadline has passed by the time a thread picks up the
+        call, `fn` is not run and the future fails with `DeadlineExceeded`.
+        """
+        if deadline is not None and time.time() > deadline:
+            metrics.incr(self.name+'.expired')
+            raise DeadlineExceeded('request deadline exceeded')
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                metrics.incr(self.name+'.rejected')
+                raise QueueFull('too many requests queued')
+            self.pending += 1
+            metrics.observe(self.name+'.pending', self.pending)
+            metrics.observe(self.name+'.queued', max(0, self.pending-self.max_workers))
+
+        submitted = time.time()
+        def run():
+            now = time.time()
+            metrics.observe(self.name+'.wait_ms', 1000.0*(now-submitted))
+            if deadline is not None and now > deadline:
+                metrics.incr(self.name+'.expired')
+                raise DeadlineExceeded('request deadline exceeded')
+            return fn(*args, **kwargs)
+
+        try:
+            future = self.executor.submit(run)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class WorkloadExecutors(object):
+    """
+    A `BoundedExecutor` per workload (see `WORKLOADS`), so that a backlog
+    of one kind of call, e.g. slow list queries, does not hold up the
+    others, e.g. single-file lookups.
+
+    `pools` maps a workload to its `(max_workers, max_queue)`. Workloads
+    without a pool of their own run on `default`. Each pool reports its
+    metrics as `<name>.<workload>.pending`, `.queued`, `.wait_ms`,
+    `.rejected` and `.expired`.
+    """
+    def __init__(self, default, pools=None, name='executor'):
+        self.default = default
+        self.pools = {}
+        for workload, (max_workers, max_queue) in (pools or {}).items():
+            if workload not in WORKLOADS:
+                raise Exception('unknown workload %r' % workload)
+            self.pools[workload] = BoundedExecutor(max_workers=max_workers,
+                                                   max_queue=max_queue,
+                                                   name='%s.%s' % (name, workload))
+
+    def get(self, workload):
+        return self.pools.get(workload, self.default)
+
+    def all(self):
+        """The executors in use, the default one first if any workload runs on it"""
+        executors = [self.pools[w] for w in sorted(self.pools)]
+        if len(self.pools) < len(WORKLOADS):
+            executors.insert(0, self.default)
+        return executors
+
+    def set_queues(self, pools):
+        """
+        Apply the `max_queue` values of `pools`. Returns False, changing
+        nothing, if `pools` has other workloads or thread counts, which
+        need new executors.
+        """
+        pools = pools or {}
+        if (sorted(pools) != sorted(self.pools) or
+                any(self.pools[w].max_workers != pools[w][0] for w in pools)):
+            return False
+        for workload, (max_workers, max_queue) in pools.items():
+            self.pools[workload].max_queue = max_queue
+        return True
@@ -0,0 +1,201 @@
+"""
+Export of the whole catalog as gzip-compressed NDJSON.
+
+Documents are read from a single cursor in `_id` order, so an
+interrupted export can resume after the last `mongo_id` it emitted.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import gzip
+import zlib
+import logging
+import argparse
+import datetime
+
+from bson.objectid import ObjectId
+
+logger = logging.getLogger('export')
+
+def json_default(obj):
+    """Serialize the BSON types that json cannot handle"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return str(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def to_ndjson(doc):
+    """Convert a raw catalog document to one NDJSON line"""
+    if '_id' in doc:
+        doc['mongo_id'] = str(doc.pop('_id'))
+    return json.dumps(doc, sort_keys=True, default=json_default) + '\n'
+
+def parse_fields(fields):
+    """Turn a comma separated list of field names into a projection"""
+    if not fields:
+        return None
+    if isinstance(fields, (list, tuple)):
+        return list(fields)
+    return [f.strip() for f in fields.split(',') if f.strip()]
+
+class GzipStream(object):
+    """Incremental gzip compressor producing one continuous gzip stream"""
+    def __init__(self, level=6):
+        # wbits=31 selects the gzip container
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """Compress `data`, flushing so the client can decode it right away"""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+def write_checkpoint(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+def export_to_file(db, path, query=None, projection=None, batch_size=10000,
+                   resume=False, progress_interval=10):
+    """
+    Export the catalog to the gzip-compressed NDJSON file `path`.
+
+    Every batch is written as its own gzip member (concatenated members
+    form a valid gzip file) and followed by a checkpoint recording the
+    last exported `mongo_id` and the file size. With `resume`, the file
+    is truncated to the checkpointed size and the export continues
+    after that `mongo_id`.
+
+    Args:
+        db: `file_catalog.mongo.Mongo` instance
+        path: output file name
+        query: mongodb query specification
+        projection: list of fields to export (default all)
+        batch_size: documents per cursor batch and per gzip member
+        resume: continue an interrupted export
+        progress_interval: seconds between progress log messages
+
+    Returns:
+        number of documents exported by this call
+    """
+    checkpoint_path = path + '.checkpoint'
+    after = None
+    offset = 0
+    total = 0
+    if resume:
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint:
+            after = checkpoint['after']
+            offset = checkpoint['offset']
+            total = checkpoint['count']
+            logger.info('resuming after %s (%d documents already exported)',
+                        after, total)
+
+    cursor = db.export_cursor(query=query, projection=projection,
+                              after=after, batch_size=batch_size)
+
+    mode = 'r+b' if offset else 'wb'
+    count = 0
+    start = last_report = time.time()
+    with open(path, mode) as f:
+        f.seek(offset)
+        f.truncate()
+        lines = []
+        for doc in cursor:
+            lines.append(to_ndjson(doc))
+            after = doc['mongo_id']
+            if len(lines) >= batch_size:
+                offset = _write_member(f, lines)
+                count += len(lines)
+                lines = []
+                write_checkpoint(checkpoint_path, {'after': after,
+                                                   'offset': offset,
+                                                   'count': total+count})
+                now = time.time()
+                if now - last_report > progress_interval:
+                    logger.info('exported %d documents, %.0f docs/s',
+                                total+count, count/(now-start))
+                    last_report = now
+        if lines:
+            offset = _write_member(f, lines)
+            count += len(lines)
+            write_checkpoint(checkpoint_path, {'after': after,
+                                               'offset': offset,
+                                               'count': total+count})
+
+    logger.info('export finished: %d documents in %.1fs', total+count,
+                time.time()-start)
+    return count
+
+def _write_member(f, lines):
+    """Write `lines` as one complete gzip member, returning the file size"""
+    member = gzip.GzipFile(fileobj=f, mode='wb')
+    member.write(''.join(lines).encode('utf-8'))
+    member.close()
+    f.flush()
+    return f.tell()
+
+def export_to_stream(db, out, query=None, projection=None, batch_size=10000):
+    """Export the catalog as one gzip stream to the binary file object `out`"""
+    stream = GzipStream()
+    count = 0
+    for doc in db.export_cursor(query=query, projection=projection,
+                                batch_size=batch_size):
+        out.write(stream.compress(to_ndjson(doc)))
+        count += 1
+    out.write(stream.finish())
+    out.flush()
+    return count
+
+def main(argv=None):
+    from file_catalog.config import Config
+    from file_catalog.backend import create_backend
+
+    parser = argparse.ArgumentParser(prog='file_catalog export',
+                                     description='Export the file catalog as gzip-compressed NDJSON')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('--query', help='mongodb query (JSON)')
+    parser.add_argument('--fields', help='comma separated list of fields to export')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='documents per cursor batch')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='resume an interrupted export to --output')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+
+    config = Config(args.config)
+    # all shards, if any
+    db = create_backend(config, args.db_host or config['server']['db_host'])
+
+    query = json.loads(args.query) if args.query else None
+    projection = parse_fields(args.fields)
+
+    if args.output == '-':
+        if args.resume:
+            parser.error('--resume needs an --output file')
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        export_to_stream(db, out, query=query, projection=projection,
+                         batch_size=args.batch_size)
+    else:
+        export_to_file(db, args.output, query=query, projection=projection,
+                       batch_size=args.batch_size, resume=args.resume)
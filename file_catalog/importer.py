@@ -0,0 +1,283 @@
+"""
+Parallel bulk import of NDJSON catalog dumps.
+
+The input (one JSON document per line, optionally gzip-compressed, as
+written by `file_catalog export`) is cut into chunks which a pool of
+worker processes validates and writes with unordered bulk inserts.
+With shards configured, each file goes to the shard of its `uid`.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import json
+import time
+import gzip
+import logging
+import argparse
+import multiprocessing
+from collections import deque, defaultdict
+
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+
+from file_catalog.validation import Validation
+from file_catalog.dates import parse_date, set_last_modification_date
+from file_catalog.backend import create_backend
+from file_catalog.sharded import new_id
+
+logger = logging.getLogger('import')
+
+# duplicate key error, i.e. the document was imported before
+DUPLICATE_KEY = 11000
+
+def prepare_record(validation, record):
+    """
+    Turn one NDJSON record into a document to insert.
+
+    `mongo_id` and `meta_modify_date` of exported documents are kept;
+    everything else must pass the same checks as a file created
+    through the REST API.
+
+    Returns a `(document, error)` tuple.
+    """
+    if not isinstance(record, dict):
+        return None, 'not a JSON object'
+    metadata = dict(record)
+    mongo_id = metadata.pop('mongo_id', None)
+    modify_date = metadata.pop('meta_modify_date', None)
+
+    error = validation.metadata_creation_error(metadata)
+    if error:
+        return None, error
+
+    if mongo_id:
+        try:
+            metadata['_id'] = ObjectId(mongo_id)
+        except Exception:
+            return None, 'invalid mongo_id'
+    if modify_date:
+        try:
+            metadata['meta_modify_date'] = parse_date(modify_date)
+        except ValueError:
+            return None, 'invalid meta_modify_date'
+    else:
+        set_last_modification_date(metadata)
+    return metadata, None
+
+# state of each worker process
+_worker = {}
+
+def mongo_backend(config, db_host):
+    """The backend of `config`, which must keep the files in MongoDB"""
+    db = create_backend(config, db_host)
+    if not all(hasattr(shard, 'client') for shard in getattr(db, 'shards', [db])):
+        raise Exception('importing needs the mongo backend')
+    return db
+
+def _init_worker(config, db_host, dry_run):
+    _worker['validation'] = Validation(config)
+    _worker['db'] = None if dry_run else mongo_backend(config, db_host)
+
+def _insert(shard, docs, stats):
+    """
+    Insert `docs` into the `Mongo` backend `shard`, counting the outcome
+    in `stats`, and add the inserted files to the catalog statistics.
+    """
+    stored = docs
+    if shard.prefixes:
+        stored = [shard.prefixes.encode_doc(doc) for doc in docs]
+    failed = set()
+    try:
+        result = shard.client.files.insert_many(stored, ordered=False)
+        stats['inserted'] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        stats['inserted'] += e.details['nInserted']
+        for err in e.details['writeErrors']:
+            failed.add(err['index'])
+            if err['code'] == DUPLICATE_KEY:
+                stats['skipped'] += 1
+            else:
+                stats['failed'] += 1
+                logger.warn('insert failed: %s', err.get('errmsg'))
+    if shard.stats:
+        shard._count(shard.stats.count(doc for i, doc in enumerate(docs)
+                                       if i not in failed))
+
+def _import_chunk(lines):
+    """Validate and insert one chunk of lines, returning its counters"""
+    validation = _worker['validation']
+    db = _worker['db']
+    stats = {'records': 0, 'invalid': 0, 'inserted': 0, 'skipped': 0, 'failed': 0}
+    docs = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        stats['records'] += 1
+        try:
+            doc, error = prepare_record(validation, json.loads(line))
+        except ValueError:
+            doc, error = None, 'invalid JSON'
+        if error:
+            stats['invalid'] += 1
+            logger.debug('invalid record: %s: %s', error, line[:200])
+        else:
+            docs.append(doc)
+
+    if not docs or db is None:
+        # nothing to do, or a dry run
+        return stats
+
+    shards = getattr(db, 'shards', None)
+    if shards is None:
+        _insert(db, docs, stats)
+        return stats
+    # as `Sharded.create_file`: on the shard of the uid, with a mongo_id
+    # recording it (exported files keep theirs, as after a rebalance)
+    by_shard = defaultdict(list)
+    for doc in docs:
+        shard = db.ring.shard(doc['uid'])
+        if '_id' not in doc:
+            doc['_id'] = new_id(shard)
+        by_shard[shard].append(doc)
+    for shard in sorted(by_shard):
+        _insert(shards[shard], by_shard[shard], stats)
+    return stats
+
+def read_chunks(f, chunk_size, skip_lines=0):
+    """
+    Yield `(lines, line_number)` chunks from the file object `f`,
+    where `line_number` counts the lines read up to the end of the chunk.
+    """
+    line_number = 0
+    chunk = []
+    for line in f:
+        line_number += 1
+        if line_number <= skip_lines:
+            continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk, line_number
+            chunk = []
+    if chunk:
+        yield chunk, line_number
+
+def open_input(path):
+    if path.endswith('.gz'):
+        # GzipFile of Python 2 has no `read1`, which TextIOWrapper needs
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path)), encoding='utf-8')
+    return io.open(path, encoding='utf-8')
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+def write_checkpoint(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+def import_file(path, config, db_host=None, workers=None, chunk_size=5000,
+                resume=False, dry_run=False, progress_interval=10):
+    """
+    Import the NDJSON file `path` into the catalog.
+
+    Chunks are handed to `workers` processes with a bounded number in
+    flight, and results are collected in input order. After each chunk,
+    a checkpoint records how many input lines are fully imported, so
+    `resume` can skip them. Records re-sent after an interruption are
+    rejected by the unique indexes and counted as skipped.
+
+    Returns a dict of counters.
+    """
+    checkpoint_path = path + '.import-checkpoint'
+    totals = {'records': 0, 'invalid': 0, 'inserted': 0, 'skipped': 0, 'failed': 0}
+    skip_lines = 0
+    if resume:
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint:
+            skip_lines = checkpoint['lines']
+            totals.update(checkpoint['totals'])
+            logger.info('resuming after line %d', skip_lines)
+
+    if db_host is None:
+        db_host = config['server']['db_host']
+    if not dry_run:
+        mongo_backend(config, db_host).ensure_indexes()
+
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(config, db_host, dry_run))
+    pending = deque()
+    start = last_report = time.time()
+    done_records = 0
+
+    def collect():
+        result, lines = pending.popleft()
+        stats = result.get()
+        for k,v in stats.items():
+            totals[k] += v
+        if not dry_run:
+            write_checkpoint(checkpoint_path, {'lines': lines, 'totals': totals})
+        return stats['records']
+
+    try:
+        with open_input(path) as f:
+            for chunk, lines in read_chunks(f, chunk_size, skip_lines):
+                pending.append((pool.apply_async(_import_chunk, (chunk,)), lines))
+                # keep a bounded number of chunks in flight
+                if len(pending) >= 2*workers:
+                    done_records += collect()
+                now = time.time()
+                if now - last_report > progress_interval:
+                    logger.info('%d records, %.0f records/s, %d inserted, '
+                                '%d skipped, %d invalid, %d failed',
+                                totals['records'], done_records/(now-start),
+                                totals['inserted'], totals['skipped'],
+                                totals['invalid'], totals['failed'])
+                    last_report = now
+        while pending:
+            done_records += collect()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.time()-start
+    logger.info('import %s: %d records in %.1fs (%.0f records/s), '
+                '%d inserted, %d skipped, %d invalid, %d failed',
+                'dry run' if dry_run else 'finished',
+                totals['records'], elapsed, done_records/elapsed if elapsed else 0,
+                totals['inserted'], totals['skipped'], totals['invalid'],
+                totals['failed'])
+    return totals
+
+def main(argv=None):
+    from file_catalog.config import Config
+
+    parser = argparse.ArgumentParser(prog='file_catalog import',
+                                     description='Import an NDJSON catalog dump')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: number of cpus)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='records per bulk insert')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='resume an interrupted import')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only validate, do not write')
+    parser.add_argument('input', help='NDJSON file (may be gzip-compressed)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+
+    totals = import_file(args.input, Config(args.config), db_host=args.db_host,
+                         workers=args.workers, chunk_size=args.chunk_size,
+                         resume=args.resume, dry_run=args.dry_run)
+    return 1 if totals['failed'] else 0
@@ -0,0 +1,362 @@
+"""
+Asynchronous jobs for long-running catalog operations.
+
+A job is submitted through the API, saved with the backend and run in
+the background on the IOLoop, at most `workers` jobs at a time; the
+others wait in state `queued`. Jobs work in batches: deleting or
+updating a batch of files, or exporting a batch of documents, which is
+appended to the job result (NDJSON chunks stored with the backend).
+Between batches a job sleeps long enough to stay within `rate` files
+per second, so regular API traffic keeps getting database threads.
+
+Several servers may share the jobs. A server claims a job before
+running it, and renews its claim (the job's `heartbeat`) with every
+batch; the state is saved after every batch only while the job is still
+running for that server, so a cancel from any server stops it. Jobs
+left queued, or running without a heartbeat for `lease` seconds (their
+server stopped), are resumed by the next server to look (see
+`JobManager.resume`), and finished jobs and their results are removed
+`retention` seconds after they ended (see `JobManager.collect`).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import datetime
+from collections import deque
+
+from bson.objectid import ObjectId
+from tornado.gen import coroutine, sleep, Return
+from tornado.ioloop import IOLoop
+
+from file_catalog import export
+from file_catalog.dates import parse_date
+from file_catalog.metrics import metrics
+from file_catalog.executor import Overloaded
+from file_catalog.validation import update_values
+from file_catalog.config import set_options
+
+logger = logging.getLogger('jobs')
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'$date': str(obj)}
+    if isinstance(obj, ObjectId):
+        return {'$oid': str(obj)}
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _json_hook(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return parse_date(obj['$date'])
+    if len(obj) == 1 and '$oid' in obj:
+        return ObjectId(obj['$oid'])
+    return obj
+
+def dump_query(query):
+    """
+    Encode a query as a JSON string, keeping dates and ids. Stored
+    operations hold their query as a string, since mongodb does not
+    allow `$` operators as field names of a stored document.
+    """
+    return json.dumps(query, default=_json_default, sort_keys=True)
+
+def load_query(data):
+    """Decode a query encoded by `dump_query`"""
+    return json.loads(data, object_hook=_json_hook)
+
+def update_filter(query, update):
+    """
+    The files of `query` that the validated bulk `update` changes.
+    Files it would leave as they are are skipped, so they keep their
+    modification date and do not count as modified. So are the files
+    that `$pull` would leave without any location.
+    """
+    unchanged = {}
+    for field, value in update.get('$set', {}).items():
+        unchanged[field] = value
+    for field in update.get('$unset', {}):
+        unchanged[field] = {'$exists': False}
+    clauses = [query]
+    if '$addToSet' in update:
+        unchanged['locations'] = {'$all': update_values(update['$addToSet']['locations'], '$each')}
+    if '$pull' in update:
+        pulled = update_values(update['$pull']['locations'], '$in')
+        unchanged['locations'] = {'$nin': pulled}
+        clauses.append({'locations': {'$elemMatch': {'$nin': pulled}}})
+    clauses.append({'$nor': [unchanged]})
+    return {'$and': clauses}
+
+# states of jobs that have not ended
+ACTIVE_STATES = ('queued', 'running')
+
+# seconds to wait before retrying a call the database refused, doubling
+# up to the maximum
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5
+
+class JobManager(object):
+    """
+    Runs and tracks jobs.
+
+    Args:
+        db: the storage backend
+        workers: jobs running at the same time
+        batch_size: default files per batch
+        max_batch_size: largest batch a client may ask for
+        rate: default limit of files per second (0 for no limit)
+        retention: seconds to keep finished jobs and their results
+        gc_interval: seconds between removals of expired jobs (0 to disable)
+        lease: seconds without a heartbeat after which a running job
+               is taken over by another server
+    """
+    def __init__(self, db, workers=2, batch_size=1000, max_batch_size=10000,
+                 rate=1000, retention=86400, gc_interval=3600, lease=600):
+        self.db = db
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.rate = rate
+        self.retention = retention
+        self.gc_interval = gc_interval
+        self.lease = lease
+        # who claims the jobs run here
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        # ids of the jobs running in this process, and jobs waiting for a worker
+        self.running = set()
+        self.queue = deque()
+        self.cancelled = set()
+
+    def reconfigure(self, **options):
+        """Apply new settings; returns the names of those needing a restart"""
+        restart = set_options(self, options, ('workers', 'batch_size', 'max_batch_size',
+                                              'rate', 'retention', 'lease'))
+        self.start_queued()
+        return restart
+
+    def start_queued(self):
+        """Hand free workers to queued jobs"""
+        while self.queue and len(self.running) < self.workers:
+            self.schedule(self.queue.popleft())
+
+    def check_limits(self, batch_size=None, rate=None):
+        """Check `batch_size` and `rate`, returning them with the defaults filled in"""
+        batch_size = int(self.batch_size if batch_size is None else batch_size)
+        if not 0 < batch_size <= self.max_batch_size:
+            raise Exception('batch_size must be between 1 and %d' % self.max_batch_size)
+        rate = float(self.rate if rate is None else rate)
+        if rate < 0:
+            raise Exception('rate is negative')
+        return batch_size, rate
+
+    def new_job(self, kind, query, batch_size=None, rate=None, **kwargs):
+        """A new job of type `kind` on the files matching `query`"""
+        batch_size, rate = self.check_limits(batch_size, rate)
+        now = str(datetime.datetime.utcnow())
+        job = {
+            'id': uuid.uuid4().hex,
+            'type': kind,
+            'query': dump_query(query),
+            'batch_size': batch_size,
+            'rate': rate,
+            'state': 'queued',
+            'matched': None,
+            'processed': 0,
+            'batches': 0,
+            'created': now,
+            'updated': now,
+            'error': None,
+        }
+        job.update(kwargs)
+        return job
+
+    @coroutine
+    def submit(self, job):
+        """Count the matching files, save `job` and schedule it"""
+        job['matched'] = yield self.db.count_files(load_query(job['query']))
+        yield self.db.save_job(job)
+        self.schedule(job)
+        raise Return(job)
+
+    def schedule(self, job):
+        """Run `job` now if a worker is free, or queue it"""
+        if job['id'] in self.running or any(j['id'] == job['id'] for j in self.queue):
+            return
+        if len(self.running) < self.workers:
+            self.running.add(job['id'])
+            job['state'] = 'running'
+            IOLoop.current().spawn_callback(self.run, job)
+        else:
+            job['state'] = 'queued'
+            self.queue.append(job)
+
+    @coroutine
+    def cancel(self, job):
+        """
+        Cancel `job`; a running job stops after its current batch. A job
+        running on another server stops when it next saves its state.
+        """
+        if job['id'] in self.running:
+            self.cancelled.add(job['id'])
+            return
+        self.queue = deque(j for j in self.queue if j['id'] != job['id'])
+        job['state'] = 'cancelled'
+        job['updated'] = str(datetime.datetime.utcnow())
+        yield self.db.save_job(job)
+
+    @coroutine
+    def resume(self):
+        """
+        Schedule the queued jobs, and the running ones whose server
+        stopped (no heartbeat for `lease` seconds). Whichever server
+        claims a job first runs it.
+        """
+        try:
+            jobs = yield self.db.find_jobs()
+        except Exception:
+            logger.warn('cannot list jobs to resume', exc_info=True)
+            return
+        stale_before = time.time() - self.lease
+        for job in reversed(jobs):
+            if job['id'] in self.running or any(j['id'] == job['id'] for j in self.queue):
+                continue
+            if job['state'] == 'queued':
+                self.schedule(job)
+            elif job['state'] == 'running' and job.get('heartbeat', 0) < stale_before:
+                logger.info('resuming %s job %s after %d files',
+                            job['type'], job['id'], job['processed'])
+                self.schedule(job)
+
+    @coroutine
+    def collect(self):
+        """Remove the jobs that ended more than `retention` seconds ago"""
+        try:
+            cutoff = str(datetime.datetime.utcnow()
+                         - datetime.timedelta(seconds=self.retention))
+            jobs = yield self.db.find_jobs()
+            for job in jobs:
+                if job['state'] not in ACTIVE_STATES and job['updated'] < cutoff:
+                    yield self.db.delete_job(job['id'])
+                    metrics.incr('jobs.collected')
+        except Exception:
+            logger.warn('cannot remove expired jobs', exc_info=True)
+
+    @coroutine
+    def retry(self, method, *args, **kwargs):
+        """
+        Call the backend `method`, retrying after a backoff while the
+        database is overloaded, so that a busy server delays a job
+        instead of failing it.
+        """
+        delay = RETRY_DELAY
+        while True:
+            try:
+                ret = yield method(*args, **kwargs)
+            except Overloaded:
+                metrics.incr('jobs.retries')
+                yield sleep(delay)
+                delay = min(2*delay, MAX_RETRY_DELAY)
+            else:
+                raise Return(ret)
+
+    @coroutine
+    def run_batch(self, job, query, cursor=None):
+        """Process one batch of `job`. Resolves to the number of files done."""
+        if job['type'] == 'delete':
+            n = yield self.retry(self.db.delete_files, query, job['batch_size'])
+            raise Return(n)
+        if job['type'] == 'update':
+            update = load_query(job['update'])
+            update.setdefault('$set', {})['meta_modify_date'] = datetime.datetime.utcnow()
+            n, modified, last = yield self.retry(self.db.update_files, query, update,
+                                                 job['batch_size'], after=job['after'])
+            if n:
+                # continue after the last file, even if it did not change
+                job['after'] = last
+                job['modified'] += modified
+            raise Return(n)
+        if job['type'] == 'export':
+            def encode(docs):
+                last = str(docs[-1]['_id']) if docs else None
+                return len(docs), last, ''.join(export.to_ndjson(d) for d in docs)
+            n, last, data = yield self.retry(self.db.next_batch, cursor, job['batch_size'],
+                                             transform=encode)
+            if n:
+                yield self.retry(self.db.save_job_result, job['id'], job['chunks'], data)
+                job['chunks'] += 1
+                job['bytes'] += len(data)
+                job['after'] = last
+            raise Return(n)
+        raise Exception('unknown job type %r' % job['type'])
+
+    @coroutine
+    def run(self, job):
+        try:
+            claimed = yield self.retry(self.db.claim_job, job['id'], self.owner,
+                                       time.time() - self.lease)
+        except Exception:
+            logger.warn('cannot claim job %s', job['id'], exc_info=True)
+            claimed = None
+        if not claimed:
+            # another server runs it, or it was cancelled meanwhile
+            self.running.discard(job['id'])
+            self.cancelled.discard(job['id'])
+            self.start_queued()
+            return
+        job.update(claimed)
+
+        query = load_query(job['query'])
+        cursor = None
+        owned = True
+        try:
+            if job['type'] == 'export':
+                cursor = self.db.export_cursor(query=query, projection=job['fields'],
+                                               after=job['after'],
+                                               batch_size=job['batch_size'])
+            while True:
+                if job['id'] in self.cancelled:
+                    job['state'] = 'cancelled'
+                    break
+                start = time.time()
+                n = yield self.run_batch(job, query, cursor)
+                if not n:
+                    job['state'] = 'done'
+                    break
+                job['processed'] += n
+                job['batches'] += 1
+                job['updated'] = str(datetime.datetime.utcnow())
+                job['heartbeat'] = time.time()
+                metrics.incr('jobs.%s.files' % job['type'], n)
+                owned = yield self.retry(self.db.save_job, job, owner=self.owner)
+                if not owned:
+                    # cancelled, or taken over, by another server
+                    stored = yield self.retry(self.db.get_job, job['id'])
+                    job['state'] = stored['state'] if stored else 'cancelled'
+                    break
+                if job['rate'] > 0:
+                    delay = n / job['rate'] - (time.time() - start)
+                    if delay > 0:
+                        yield sleep(delay)
+        except Exception as e:
+            logger.warn('%s job %s failed', job['type'], job['id'], exc_info=True)
+            job['state'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+            self.running.discard(job['id'])
+            self.cancelled.discard(job['id'])
+        job['updated'] = str(datetime.datetime.utcnow())
+        logger.info('%s job %s %s: %d files', job['type'], job['id'],
+                    job['state'], job['processed'])
+        try:
+            if owned:
+                yield self.retry(self.db.save_job, job, owner=self.owner)
+        except Exception:
+            logger.warn('cannot save job %s', job['id'], exc_info=True)
+        # hand the worker to the next job
+        self.start_queued()
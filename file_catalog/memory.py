@@ -0,0 +1,515 @@
+"""
+In-memory storage backend.
+
+Documents live in a dict keyed by `_id`, with hash indexes on `uid`
+and `checksum`. Queries support the common subset of the mongodb query
+language, so the same REST API works without a database, e.g. for
+tests or read-through edge caches.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import copy
+import time
+import heapq
+import logging
+import threading
+import numbers
+import datetime
+from itertools import islice
+from functools import wraps, cmp_to_key
+from collections import defaultdict
+
+from concurrent.futures import Future
+from bson.objectid import ObjectId
+
+from file_catalog.backend import Backend, project, apply_update, job_claimable
+from file_catalog.executor import DeadlineExceeded
+from file_catalog import stats as catalog_stats
+
+logger = logging.getLogger('memory')
+
+def run_now(method):
+    """
+    Run `method` right away, returning its result or error as a
+    completed future. A `ctx` whose deadline has passed fails with
+    `DeadlineExceeded`, as on the other backends.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        future = Future()
+        ctx = kwargs.get('ctx')
+        try:
+            if ctx is not None and ctx.expired():
+                raise DeadlineExceeded('request deadline exceeded')
+            if ctx is not None:
+                with ctx.timings.phase('db'):
+                    ret = method(self, *args, **kwargs)
+            else:
+                ret = method(self, *args, **kwargs)
+            future.set_result(ret)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return wrapper
+
+def get_path(doc, path):
+    """All values at the dotted `path` of `doc`, descending into lists"""
+    values = [doc]
+    for part in path.split('.'):
+        next_values = []
+        for v in values:
+            if isinstance(v, dict):
+                if part in v:
+                    next_values.append(v[part])
+            elif isinstance(v, list):
+                if part.isdigit():
+                    if int(part) < len(v):
+                        next_values.append(v[int(part)])
+                else:
+                    next_values.extend(e[part] for e in v
+                                       if isinstance(e, dict) and part in e)
+        values = next_values
+    return values
+
+def expand(values):
+    """Values plus the elements of list values, as mongodb compares them"""
+    for v in values:
+        yield v
+        if isinstance(v, list):
+            for e in v:
+                yield e
+
+def comparable(a, b):
+    """Whether `a` and `b` are of the same type class for range queries"""
+    for types in ((numbers.Number,), (str, type(u'')), (datetime.datetime,),
+                  (ObjectId,)):
+        if isinstance(a, types) and isinstance(b, types):
+            return not isinstance(a, bool) and not isinstance(b, bool)
+    return False
+
+# order of the types when sorting, as in mongodb
+SORT_ORDER = ((type(None),), (numbers.Number,), (str, type(u'')), (dict,), (list,),
+              (ObjectId,), (bool,), (datetime.datetime,))
+
+def sort_key(doc, field):
+    """Sort key of the (first) value of `field` in `doc`"""
+    values = get_path(doc, field)
+    value = values[0] if values else None
+    for rank, types in enumerate(SORT_ORDER):
+        if isinstance(value, types) and not (rank == 1 and isinstance(value, bool)):
+            if isinstance(value, (dict, list)):
+                return (rank, repr(value))
+            return (rank, value)
+    return (len(SORT_ORDER), repr(value))
+
+def sort_order(sort):
+    """A key function ordering documents by `sort`, a list of `(field, direction)`"""
+    def compare(a, b):
+        for field, direction in sort:
+            ka, kb = sort_key(a, field), sort_key(b, field)
+            if ka != kb:
+                return direction if ka > kb else -direction
+        return 0
+    return cmp_to_key(compare)
+
+def is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond)
+
+def match_eq(values, value):
+    if value is None and not values:
+        return True
+    return any(v == value for v in expand(values))
+
+def match_ops(values, ops):
+    """Match the values of a field against a dict of query operators"""
+    for op, arg in ops.items():
+        if op == '$eq':
+            ok = match_eq(values, arg)
+        elif op == '$ne':
+            ok = not match_eq(values, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            cmp = {'$gt': lambda a,b: a > b, '$gte': lambda a,b: a >= b,
+                   '$lt': lambda a,b: a < b, '$lte': lambda a,b: a <= b}[op]
+            ok = any(comparable(v, arg) and cmp(v, arg) for v in expand(values))
+        elif op == '$in':
+            ok = any(match_eq(values, a) for a in arg)
+        elif op == '$nin':
+            ok = not any(match_eq(values, a) for a in arg)
+        elif op == '$exists':
+            ok = bool(values) == bool(arg)
+        elif op == '$regex':
+            flags = 0
+            for c in ops.get('$options', ''):
+                flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(c, 0)
+            r = re.compile(arg, flags)
+            ok = any(isinstance(v, (str, type(u''))) and r.search(v)
+                     for v in expand(values))
+        elif op == '$options':
+            continue
+        elif op == '$all':
+            ok = all(match_eq(values, a) for a in arg)
+        elif op == '$size':
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == '$not':
+            ok = not match_ops(values, arg)
+        elif op == '$elemMatch':
+            elements = [e for v in values if isinstance(v, list) for e in v]
+            if is_operator_dict(arg):
+                ok = any(match_ops([e], arg) for e in elements)
+            else:
+                ok = any(isinstance(e, dict) and match(e, arg) for e in elements)
+        else:
+            raise Exception('unsupported query operator %r' % op)
+        if not ok:
+            return False
+    return True
+
+def match(doc, query):
+    """Whether `doc` matches the mongodb `query`"""
+    for key, cond in query.items():
+        if key == '$and':
+            ok = all(match(doc, q) for q in cond)
+        elif key == '$or':
+            ok = any(match(doc, q) for q in cond)
+        elif key == '$nor':
+            ok = not any(match(doc, q) for q in cond)
+        elif key.startswith('$'):
+            raise Exception('unsupported query operator %r' % key)
+        elif is_operator_dict(cond):
+            ok = match_ops(get_path(doc, key), cond)
+        else:
+            ok = match_eq(get_path(doc, key), cond)
+        if not ok:
+            return False
+    return True
+
+def index_keys(value):
+    """Hashable index keys for a field value (list elements are indexed too)"""
+    values = value if isinstance(value, list) else [value]
+    ret = []
+    for v in values:
+        try:
+            hash(v)
+            ret.append(v)
+        except TypeError:
+            ret.append(repr(v))
+    return ret
+
+def prepare_filters(filters):
+    """Rename `mongo_id` to `_id` and convert it to an `ObjectId`"""
+    filters = dict(filters) if filters else {}
+    if 'mongo_id' in filters:
+        filters['_id'] = filters.pop('mongo_id')
+    if '_id' in filters and not isinstance(filters['_id'], dict):
+        filters['_id'] = ObjectId(filters['_id'])
+    return filters
+
+class Memory(Backend):
+    """In-memory storage with hash indexes on `_id`, `uid` and `checksum`"""
+
+    # fields with a hash index, besides `_id`
+    INDEXES = ('uid', 'checksum')
+
+    def __init__(self, stats=None, slow_log=None):
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.indexes = {f: defaultdict(set) for f in self.INDEXES}
+        self.stats = stats
+        self.slow_log = slow_log
+        self.counters = {}
+        self.reconciled = None
+        self.jobs = {}
+        self.job_results = defaultdict(dict)
+
+    def _count(self, old, new):
+        """Update the statistics counters for replacing `old` by `new`"""
+        if self.stats:
+            catalog_stats.apply_delta(self.counters, self.stats.delta(old, new))
+
+    def _index(self, doc):
+        for f in self.INDEXES:
+            if f in doc:
+                for k in index_keys(doc[f]):
+                    self.indexes[f][k].add(doc['_id'])
+
+    def _unindex(self, doc):
+        for f in self.INDEXES:
+            if f in doc:
+                for k in index_keys(doc[f]):
+                    ids = self.indexes[f][k]
+                    ids.discard(doc['_id'])
+                    if not ids:
+                        del self.indexes[f][k]
+
+    def _candidates(self, query):
+        """The `_id`s of documents that may match `query`, using an index if possible"""
+        for f in ('_id',)+self.INDEXES:
+            if f not in query:
+                continue
+            cond = query[f]
+            if is_operator_dict(cond):
+                if '$eq' in cond:
+                    keys = [cond['$eq']]
+                elif '$in' in cond:
+                    keys = cond['$in']
+                else:
+                    continue
+            else:
+                keys = [cond]
+            ids = set()
+            for k in keys:
+                if f == '_id':
+                    if isinstance(k, ObjectId) and k in self.docs:
+                        ids.add(k)
+                else:
+                    for key in index_keys(k):
+                        ids |= self.indexes[f].get(key, set())
+            return sorted(ids)
+        return sorted(self.docs)
+
+    @run_now
+    def sort_indexes(self, ctx=None):
+        # documents are sorted in memory; allow the indexed fields
+        return [[('_id', 1)]] + [[(f, 1)] for f in self.INDEXES]
+
+    def _find(self, query):
+        """Iterate over the stored documents matching `query`, in `_id` order"""
+        for _id in self._candidates(query):
+            doc = self.docs.get(_id)
+            if doc is not None and match(doc, query):
+                yield doc
+
+    @run_now
+    def find_files(self, query={}, limit=None, start=0, fields=None, sort=None,
+                   ctx=None):
+        query = prepare_filters(query)
+        end = None if limit is None else start + limit
+        ret = []
+        begin = time.time()
+        with self.lock:
+            docs = self._find(query)
+            if sort and end is not None:
+                # top-k instead of a full sort
+                docs = heapq.nsmallest(end, docs, key=sort_order(sort))
+            elif sort:
+                docs = sorted(docs, key=sort_order(sort))
+            for i,doc in enumerate(docs):
+                if end is not None and i >= end:
+                    break
+                if i >= start:
+                    row = copy.deepcopy(project(doc, fields)) if fields else {}
+                    row.pop('_id', None)
+                    row['mongo_id'] = str(doc['_id'])
+                    if 'uid' in doc:
+                        row['uid'] = doc['uid']
+                    ret.append(row)
+        if self.slow_log:
+            self.slow_log.record(query, 1000.0*(time.time()-begin), len(ret))
+        return ret
+
+    @run_now
+    def create_file(self, metadata, ctx=None):
+        doc = copy.deepcopy(metadata)
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        with self.lock:
+            if doc['_id'] in self.docs:
+                raise Exception('duplicate _id')
+            self.docs[doc['_id']] = doc
+            self._index(doc)
+            self._count(None, doc)
+        return str(doc['_id'])
+
+    @run_now
+    def get_file(self, filters, ctx=None):
+        filters = prepare_filters(filters)
+        with self.lock:
+            for doc in self._find(filters):
+                ret = copy.deepcopy(doc)
+                ret['mongo_id'] = str(ret.pop('_id'))
+                return ret
+        return None
+
+    def _replace(self, metadata_id, new_doc):
+        """Replace a stored document, raising if nothing changed"""
+        with self.lock:
+            old = self.docs.get(metadata_id)
+            if old is None or old == new_doc:
+                logger.warn('updated 0 files with id %r', metadata_id)
+                raise Exception('did not update')
+            self._unindex(old)
+            self.docs[metadata_id] = new_doc
+            self._index(new_doc)
+            self._count(old, new_doc)
+
+    @run_now
+    def update_file(self, metadata, ctx=None):
+        metadata = prepare_filters(metadata)
+        metadata_id = metadata.pop('_id')
+        with self.lock:
+            doc = copy.deepcopy(self.docs.get(metadata_id, {}))
+            doc.update(copy.deepcopy(metadata))
+            self._replace(metadata_id, doc)
+
+    @run_now
+    def replace_file(self, metadata, ctx=None):
+        metadata = prepare_filters(metadata)
+        doc = copy.deepcopy(metadata)
+        self._replace(doc['_id'], doc)
+
+    @run_now
+    def delete_file(self, filters, ctx=None):
+        filters = prepare_filters(filters)
+        with self.lock:
+            for doc in self._find(filters):
+                self._unindex(doc)
+                del self.docs[doc['_id']]
+                self._count(doc, None)
+                return
+        logger.warn('deleted 0 files with filter %r', filters)
+        raise Exception('did not delete')
+
+    @run_now
+    def count_files(self, query={}, ctx=None):
+        query = prepare_filters(query)
+        with self.lock:
+            return sum(1 for doc in self._find(query))
+
+    @run_now
+    def delete_files(self, query, limit, ctx=None):
+        query = prepare_filters(query)
+        with self.lock:
+            docs = list(islice(self._find(query), limit))
+            for doc in docs:
+                self._unindex(doc)
+                del self.docs[doc['_id']]
+                self._count(doc, None)
+        return len(docs)
+
+    @run_now
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        query = prepare_filters(query)
+        after = ObjectId(after) if after else None
+        modified = 0
+        with self.lock:
+            docs = list(islice((doc for doc in self._find(query)
+                                if after is None or doc['_id'] > after), limit))
+            for doc in docs:
+                new = apply_update(copy.deepcopy(doc), update)
+                if new != doc:
+                    self._replace(doc['_id'], new)
+                    modified += 1
+        if not docs:
+            return 0, 0, None
+        return len(docs), modified, str(docs[-1]['_id'])
+
+    @run_now
+    def save_job(self, job, owner=None):
+        with self.lock:
+            if owner is not None:
+                old = self.jobs.get(job['id'])
+                if not old or old['state'] != 'running' or old.get('owner') != owner:
+                    return False
+            self.jobs[job['id']] = copy.deepcopy(job)
+            return True
+
+    @run_now
+    def claim_job(self, job_id, owner, stale_before):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job or not job_claimable(job, stale_before):
+                return None
+            job.update(state='running', owner=owner, heartbeat=time.time())
+            return copy.deepcopy(job)
+
+    @run_now
+    def get_job(self, job_id):
+        with self.lock:
+            return copy.deepcopy(self.jobs.get(job_id))
+
+    @run_now
+    def find_jobs(self, state=None):
+        with self.lock:
+            jobs = [copy.deepcopy(job) for job in self.jobs.values()
+                    if state is None or job['state'] == state]
+        return sorted(jobs, key=lambda job: job['created'], reverse=True)
+
+    @run_now
+    def delete_job(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.job_results.pop(job_id, None)
+
+    @run_now
+    def save_job_result(self, job_id, seq, data):
+        with self.lock:
+            self.job_results[job_id][seq] = data
+
+    @run_now
+    def get_job_results(self, job_id, start=0, limit=10):
+        with self.lock:
+            chunks = self.job_results.get(job_id, {})
+            return [chunks[seq] for seq in sorted(chunks) if seq >= start][:limit]
+
+    @run_now
+    def ping(self, ctx=None):
+        pass
+
+    @run_now
+    def get_stats(self, ctx=None):
+        with self.lock:
+            return catalog_stats.summary(((g, k, f, b) for (g, k),(f, b)
+                                          in self.counters.items()),
+                                         self.reconciled)
+
+    def reconcile_stats(self):
+        with self.lock:
+            self.counters = self.stats.count(self.docs.values())
+            self.reconciled = datetime.datetime.utcnow()
+
+    def export_cursor(self, query=None, projection=None, after=None,
+                      batch_size=10000, ctx=None):
+        query = prepare_filters(query)
+        after = ObjectId(after) if after else None
+        return MemoryCursor(self, query, projection, after)
+
+    @run_now
+    def next_batch(self, cursor, size, transform=None, ctx=None):
+        docs = cursor.next_batch(size)
+        return transform(docs) if transform else docs
+
+class MemoryCursor(object):
+    """Iterates over a `Memory` backend in `_id` order, in batches"""
+    def __init__(self, db, query, projection, after):
+        self.db = db
+        self.query = query
+        self.projection = projection
+        self.after = after
+
+    def next_batch(self, size):
+        ret = []
+        with self.db.lock:
+            for doc in self.db._find(self.query):
+                if self.after is not None and doc['_id'] <= self.after:
+                    continue
+                if self.projection:
+                    doc = {k: doc[k] for k in list(self.projection)+['_id'] if k in doc}
+                ret.append(copy.deepcopy(doc))
+                if len(ret) >= size:
+                    break
+        if ret:
+            self.after = ret[-1]['_id']
+        return ret
+
+    def __iter__(self):
+        while True:
+            docs = self.next_batch(1000)
+            if not docs:
+                break
+            for doc in docs:
+                yield doc
+
+    def close(self):
+        pass
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+from collections import defaultdict
+
+class Histogram(object):
+    """Running summary of observed values, bucketed by powers of two"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = defaultdict(int)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = 1
+        while bucket < value:
+            bucket *= 2
+        self.buckets[bucket] += 1
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'buckets': {'le_%s'%k: v for k,v in self.buckets.items()},
+        }
+
+class Metrics(object):
+    """A thread-safe registry of counters and histograms"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """Returns a JSON-serializable copy of all metrics"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {k: h.summary() for k,h in self.histograms.items()},
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+# process-wide registry
+metrics = Metrics()
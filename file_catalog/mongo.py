@@ -1,30 +1,454 @@
 from __future__ import absolute_import, division, print_function
 
+import time
+import base64
 import logging
+import datetime
+from itertools import islice
+from functools import partial
+from contextlib import contextmanager
 
-from pymongo import MongoClient
+from pymongo import (MongoClient, InsertOne, UpdateOne, ReplaceOne,
+                     ReadPreference, ReturnDocument)
 from pymongo.errors import BulkWriteError
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from bson import BSON
 from bson.objectid import ObjectId
 
-from concurrent.futures import ThreadPoolExecutor
-from tornado.concurrent import run_on_executor
+from concurrent.futures import Future, ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+from file_catalog.metrics import metrics
+from file_catalog.executor import (BoundedExecutor, WorkloadExecutors, DeadlineExceeded,
+                                   Rendezvous, run_on_executor)
+from file_catalog.backend import Backend
+from file_catalog.prefixes import LocationPrefixes, DecodedCursor
+from file_catalog import stats as catalog_stats
 
 logger = logging.getLogger('mongo')
 
-class Mongo(object):
+def prepare_filters(filters):
+    """Rename `mongo_id` to `_id` and convert it to an `ObjectId`"""
+    filters = dict(filters) if filters else {}
+    if 'mongo_id' in filters:
+        filters['_id'] = filters.pop('mongo_id')
+    if '_id' in filters and not isinstance(filters['_id'], dict):
+        filters['_id'] = ObjectId(filters['_id'])
+    return filters
+
+class WriteCoalescer(object):
+    """
+    Group-commit for single-document writes.
+
+    Writes submitted within `window` seconds of each other (or until
+    `max_batch` writes are pending) are sent as one unordered
+    `bulk_write`. Each caller gets its own future, resolved with its
+    own result or error.
+
+    If `start_session` is given, the batch runs in that session and
+    every caller's `RequestContext` receives its causal token.
+
+    If `stats` is given, the statistics changes of the batch are passed
+    to `count` after the write.
+
+    If `prefixes` is given, locations are written in their compact form.
+
+    `insert()` and `update()` must be called from the IOLoop thread.
+    """
+    def __init__(self, collection, executor, window=0.003, max_batch=100,
+                 start_session=None, stats=None, count=None, prefixes=None):
+        self.collection = collection
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.start_session = start_session
+        self.stats = stats
+        self.count = count
+        self.prefixes = prefixes
+        self.pending = []
+        self.timeout = None
+
+    def insert(self, metadata, ctx=None):
+        """Queue an insert. The future resolves to the new `mongo_id`."""
+        # assign the id up front so each caller knows its own result
+        if '_id' not in metadata:
+            metadata['_id'] = ObjectId()
+        return self._submit(InsertOne(metadata), metadata['_id'], ctx, metadata)
+
+    def update(self, metadata_id, fields, ctx=None):
+        """Queue a `$set` of `fields` on one document. The future resolves to `None`."""
+        return self._submit(UpdateOne({'_id': metadata_id}, {'$set': fields}),
+                            metadata_id, ctx, fields)
+
+    def _submit(self, request, metadata_id, ctx, doc):
+        future = Future()
+        self.pending.append((request, metadata_id, ctx, future, doc))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = IOLoop.current().call_later(self.window, self.flush)
+        return future
+
+    def flush(self):
+        """Send all pending writes"""
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        metrics.incr('mongo.coalesce.batches')
+        metrics.observe('mongo.coalesce.batch_size', len(batch))
+        try:
+            self.executor.submit(self._write, batch)
+        except Exception as e:
+            for entry in batch:
+                entry[3].set_exception(e)
+
+    def _write(self, batch):
+        # writes whose request deadline passed while queued are dropped
+        live = []
+        for entry in batch:
+            if entry[2] is not None and entry[2].expired():
+                entry[3].set_exception(DeadlineExceeded('request deadline exceeded'))
+            else:
+                live.append(entry)
+        batch = live
+        if not batch:
+            return
+
+        # old versions of the updated documents, for the statistics
+        old = {}
+        if self.stats:
+            ids = [b[1] for b in batch if isinstance(b[0], UpdateOne)]
+            if ids:
+                old = {d['_id']: self.prefixes.decoded(d) if self.prefixes else d
+                       for d in self.collection.find({'_id': {'$in': ids}}, self.stats.fields)}
+
+        requests = [b[0] for b in batch]
+        if self.prefixes:
+            # encoding may add prefixes, so it is not done on the IOLoop
+            requests = [InsertOne(self.prefixes.encode_doc(doc)) if isinstance(request, InsertOne)
+                        else UpdateOne({'_id': metadata_id},
+                                       {'$set': self.prefixes.encode_doc(doc)})
+                        for request, metadata_id, _, _, doc in batch]
+
+        session = self.start_session() if self.start_session else None
+        errors = {}
+        start = time.time()
+        try:
+            result = self.collection.bulk_write(requests,
+                                                ordered=False,
+                                                session=session)
+            matched = result.matched_count
+        except BulkWriteError as e:
+            for err in e.details['writeErrors']:
+                errors[err['index']] = err
+            matched = e.details['nMatched']
+        except Exception as e:
+            logger.warn('bulk write of %d documents failed', len(batch),
+                        exc_info=True)
+            for entry in batch:
+                entry[3].set_exception(e)
+            return
+        finally:
+            for entry in batch:
+                if entry[2] is not None:
+                    entry[2].timings.add('db', time.time()-start)
+            if session:
+                token = dump_causal_token(session)
+                for entry in batch:
+                    if entry[2] is not None:
+                        entry[2].causal_token = token
+                session.end_session()
+
+        # the bulk result only has a total match count, so find out
+        # which updates (if any) did not hit a document
+        updates = [b[1] for i,b in enumerate(batch)
+                   if isinstance(b[0], UpdateOne) and i not in errors]
+        missing = set()
+        if matched < len(updates):
+            found = self.collection.find({'_id': {'$in': updates}}, ['_id'])
+            missing = set(updates) - set(row['_id'] for row in found)
+
+        delta = {}
+        for i,(request, metadata_id, _, future, doc) in enumerate(batch):
+            if i in errors:
+                logger.warn('coalesced write failed for id %r: %s',
+                            metadata_id, errors[i].get('errmsg'))
+                future.set_exception(Exception(errors[i].get('errmsg', 'write failed')))
+            elif isinstance(request, InsertOne):
+                if self.stats:
+                    catalog_stats.apply_delta(delta, self.stats.delta(None, doc))
+                future.set_result(str(metadata_id))
+            elif metadata_id in missing:
+                logger.warn('updated 0 files with id %r', metadata_id)
+                future.set_exception(Exception('did not update'))
+            else:
+                if self.stats and metadata_id in old:
+                    new = dict(old[metadata_id])
+                    new.update(doc)
+                    catalog_stats.apply_delta(delta, self.stats.delta(old[metadata_id], new))
+                future.set_result(None)
+        if delta:
+            self.count(delta)
+
+def dump_causal_token(session):
+    """
+    Encode the cluster and operation time of a causally consistent
+    session as an opaque, url-safe token. Returns `None` if the
+    deployment does not report them (e.g. a standalone server).
+    """
+    if session.cluster_time is None or session.operation_time is None:
+        return None
+    data = BSON.encode({'c': session.cluster_time, 'o': session.operation_time})
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def load_causal_token(session, token):
+    """Advance `session` to the point in time recorded in `token`"""
+    data = BSON(base64.urlsafe_b64decode(str(token))).decode()
+    session.advance_cluster_time(data['c'])
+    session.advance_operation_time(data['o'])
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+class Mongo(Backend):
     """A ThreadPoolExecutor-based MongoDB client"""
-    def __init__(self, host=None):
-        kwargs = {}
-        if host:
+    def __init__(self, host=None, uri=None, replica_set=None,
+                 read_preference='primary', read_concern=None,
+                 write_concern=None, causal_consistency=True,
+                 min_pool_size=0, max_pool_size=100,
+                 max_workers=10, max_queue=100, pools=None,
+                 coalesce_window_ms=0, coalesce_max_batch=100,
+                 compact_locations=False, location_prefix_depth=3, stats=None,
+                 slow_log=None):
+        kwargs = {
+            'minPoolSize': min_pool_size,
+            'maxPoolSize': max_pool_size,
+        }
+        if uri:
+            kwargs['host'] = uri
+        elif host and host.startswith('mongodb://'):
+            kwargs['host'] = host
+        elif host:
             parts = host.split(':')
             if len(parts) == 2:
                 kwargs['port'] = int(parts[1])
             kwargs['host'] = parts[0]
-        self.client = MongoClient(**kwargs).file_catalog
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        if replica_set:
+            kwargs['replicaSet'] = replica_set
+        self.mongo_client = MongoClient(**kwargs)
+        self.min_pool_size = min_pool_size
+
+        # writes (and reads that must see them) go to the primary
+        db_kwargs = {}
+        if write_concern not in (None, ''):
+            db_kwargs['write_concern'] = WriteConcern(w=write_concern)
+        self.client = self.mongo_client.get_database('file_catalog', **db_kwargs)
+
+        # reads of read-only requests may be routed to secondaries
+        if read_preference not in READ_PREFERENCES:
+            raise Exception('unknown read preference %r' % read_preference)
+        read_kwargs = {'read_preference': READ_PREFERENCES[read_preference]}
+        if read_concern:
+            read_kwargs['read_concern'] = ReadConcern(read_concern)
+        self.read_files = self.client.get_collection('files', **read_kwargs)
+
+        # causal sessions are only needed if reads can hit a secondary
+        self.causal_consistency = (causal_consistency
+                                   and read_preference != 'primary')
+
+        self.executor = BoundedExecutor(max_workers=max_workers,
+                                        max_queue=max_queue,
+                                        name='mongo.executor')
+        # thread pools of their own for some kinds of calls
+        self.executors = WorkloadExecutors(self.executor, pools, name='mongo')
+
+        # counters of the catalog statistics
+        self.stats = stats
+
+        # cost of `find_files` queries by shape
+        self.slow_log = slow_log
+
+        # cached `(time, key patterns)` of the sortable indexes
+        self.sort_indexes_cache = None
+
+        # optional dictionary encoding of location prefixes
+        self.prefixes = None
+        if compact_locations:
+            self.prefixes = LocationPrefixes(self.client.location_prefixes,
+                                             depth=location_prefix_depth)
+
+        # optional group-commit of single-file writes
+        self.coalescer = None
+        if coalesce_window_ms > 0:
+            start_session = None
+            if self.causal_consistency:
+                start_session = partial(self.mongo_client.start_session,
+                                        causal_consistency=True)
+            self.coalescer = WriteCoalescer(self.client.files, self.executors.get('write'),
+                                            window=coalesce_window_ms/1000.0,
+                                            max_batch=coalesce_max_batch,
+                                            start_session=start_session,
+                                            stats=stats, count=self._count,
+                                            prefixes=self.prefixes)
+
+    def ensure_indexes(self):
+        """
+        Create the indexes the catalog relies on (blocking). They are
+        built in the background, so the collections stay usable.
+        """
+        files = self.client.files
+        try:
+            files.create_index('uid', unique=True, background=True)
+        except Exception:
+            logger.warn('cannot create unique index on `uid`', exc_info=True)
+        files.create_index('checksum', background=True)
+        files.create_index('meta_modify_date', background=True)
+        self.client.job_results.create_index([('job', 1), ('seq', 1)], background=True)
+        if self.prefixes:
+            self.prefixes.ensure_indexes()
+
+    def reconfigure(self, **options):
+        live = ['max_queue']
+        if self.coalescer:
+            # coalescing itself can only be turned on or off by a restart
+            live += ['coalesce_window_ms', 'coalesce_max_batch']
+        if 'max_queue' in options:
+            self.executor.max_queue = options['max_queue']
+        if 'pools' in options and self.executors.set_queues(options['pools']):
+            # only the queue lengths changed
+            live.append('pools')
+        if self.coalescer and 'coalesce_window_ms' in options:
+            self.coalescer.window = options['coalesce_window_ms']/1000.0
+        if self.coalescer and 'coalesce_max_batch' in options:
+            self.coalescer.max_batch = options['coalesce_max_batch']
+        return sorted(set(options) - set(live))
+
+    # indexes that must exist for queries to be served at full speed
+    REQUIRED_INDEXES = ('uid', 'checksum', 'meta_modify_date')
+
+    @run_on_executor(workload='point')
+    def ping(self, ctx=None):
+        self.mongo_client.admin.command('ping')
+
+    def warmup(self, prefetch=0):
+        self.mongo_client.admin.command('ping')
+
+        # only check: building indexes on a large collection would keep
+        # the server from reporting ready (the server builds them after)
+        indexed = set(info['key'][0][0] for info in
+                      self.client.files.index_information().values())
+        missing = [f for f in self.REQUIRED_INDEXES if f not in indexed]
+        if missing:
+            logger.warn('missing indexes on %s', ', '.join(missing))
+
+        # start every executor thread, and have as many connections as
+        # threads (or `min_pool_size`, if more) in use at once, so that
+        # they are all open and back in the pool afterwards
+        executors = self.executors.all()
+        workers = sum(e.max_workers for e in executors)
+        connections = max(self.min_pool_size, workers)
+        rendezvous = Rendezvous(connections)
+        def ping():
+            rendezvous.wait()
+            self.mongo_client.admin.command('ping')
+        futures = [e.submit(ping) for e in executors for _ in range(e.max_workers)]
+        if connections > workers:
+            extra = ThreadPoolExecutor(max_workers=connections-workers)
+            futures += [extra.submit(ping) for _ in range(connections-workers)]
+            extra.shutdown(wait=False)
+        for f in futures:
+            f.result()
+
+        self.sort_indexes_cache = None
+        self.sort_indexes().result()
+        if self.prefixes:
+            self.prefixes.load()
+        if prefetch > 0:
+            # the recently modified files are the likely ones to be read
+            for doc in self.read_files.find({}, sort=[('meta_modify_date', -1)],
+                                            limit=prefetch):
+                pass
+
+    # seconds to cache the list of indexes
+    SORT_INDEXES_TTL = 60
+
+    @run_on_executor(workload='point')
+    def sort_indexes(self, ctx=None):
+        cached = self.sort_indexes_cache
+        if cached and time.time() - cached[0] < self.SORT_INDEXES_TTL:
+            return cached[1]
+        ret = []
+        for info in self.client.files.index_information().values():
+            keys = []
+            for field, direction in info['key']:
+                # text, hashed and geo indexes do not sort
+                if direction not in (1, -1):
+                    break
+                keys.append((field, int(direction)))
+            if keys:
+                ret.append(keys)
+        self.sort_indexes_cache = (time.time(), ret)
+        return ret
 
-    @run_on_executor
-    def find_files(self, query={}, limit=None, start=0):
+    def _query(self, query):
+        """`query` on the stored form of the files"""
+        return self.prefixes.encode_query(query) if self.prefixes else query
+
+    def _stored(self, metadata):
+        """The stored form of `metadata`"""
+        return self.prefixes.encode_doc(metadata) if self.prefixes else metadata
+
+    def _loaded(self, doc):
+        """Turn a stored document back into the metadata, in place"""
+        return self.prefixes.decode_doc(doc) if self.prefixes else doc
+
+    def _delta(self, old, new):
+        """The statistics changes from the stored `old` to `new`"""
+        if self.prefixes:
+            old, new = self.prefixes.decoded(old), self.prefixes.decoded(new)
+        return self.stats.delta(old, new)
+
+    def _files(self, ctx):
+        """The collection to read from for the request `ctx`"""
+        if ctx is not None and ctx.read_only:
+            return self.read_files
+        return self.client.files
+
+    @contextmanager
+    def _session(self, ctx):
+        """
+        A causally consistent session continuing from the causal token
+        of `ctx`. On exit, the token is advanced past the operations
+        run in the session, so that a client presenting it later reads
+        its own writes even from a secondary.
+        """
+        if not (self.causal_consistency and ctx is not None):
+            yield None
+            return
+        session = self.mongo_client.start_session(causal_consistency=True)
+        try:
+            if ctx.causal_token:
+                try:
+                    load_causal_token(session, ctx.causal_token)
+                except Exception:
+                    logger.info('ignoring invalid causal token', exc_info=True)
+            yield session
+            ctx.causal_token = dump_causal_token(session)
+        finally:
+            session.end_session()
+
+    @run_on_executor(workload='list')
+    def find_files(self, query={}, limit=None, start=0, fields=None, sort=None,
+                   ctx=None):
         if 'mongo_id' in query:
             query['_id'] = query['mongo_id']
             del query['mongo_id']
@@ -32,9 +456,8 @@ class Mongo(object):
         if '_id' in query and not isinstance(query['_id'], dict):
             query['_id'] = ObjectId(query['_id'])
 
-        projection = ('_id', 'uid')
+        projection = ['_id', 'uid'] + [f for f in fields or [] if f != '_id']
 
-        result = self.client.files.find(query, projection)
         ret = []
 
         # `limit` and `skip` are ignored by __getitem__:
@@ -46,22 +469,198 @@ class Mongo(object):
         if limit is not None:
             end = start + limit
 
-        for row in result[start:end]:
-            row['mongo_id'] = str(row['_id'])
-            del row['_id']
-            ret.append(row)
+        begin = time.time()
+        stored_query = self._query(query)
+        with self._session(ctx) as session:
+            result = self._files(ctx).find(stored_query, projection, session=session)
+            if sort:
+                result = result.sort([(f, d) for f,d in sort])
+            for row in result[start:end]:
+                row['mongo_id'] = str(row['_id'])
+                del row['_id']
+                ret.append(self._loaded(row))
+        if self.slow_log:
+            ms = 1000.0*(time.time()-begin)
+            examined = None
+            if self.slow_log.explain and self.slow_log.is_slow(ms):
+                examined = self._examined(ctx, stored_query, projection, start, limit)
+            self.slow_log.record(query, ms, len(ret), examined)
         return ret
 
-    @run_on_executor
-    def create_file(self, metadata):
-        result = self.client.files.insert_one(metadata)
+    def _examined(self, ctx, query, projection, skip, limit):
+        """Documents examined by a query, according to explain"""
+        try:
+            plan = self._files(ctx).find(query, projection, skip=skip,
+                                         limit=limit or 0).explain()
+            return plan.get('executionStats', {}).get('totalDocsExamined')
+        except Exception:
+            logger.info('cannot explain query', exc_info=True)
+            return None
+
+    @run_on_executor(workload='list')
+    def count_files(self, query={}, ctx=None):
+        query = self._query(prepare_filters(query))
+        with self._session(ctx) as session:
+            return self._files(ctx).count_documents(query, session=session)
+
+    @run_on_executor(workload='bulk')
+    def delete_files(self, query, limit, ctx=None):
+        query = self._query(prepare_filters(query))
+        projection = ['_id'] + (self.stats.fields if self.stats else [])
+        docs = list(self.client.files.find(query, projection, limit=limit))
+        if not docs:
+            return 0
+        ids = [doc['_id'] for doc in docs]
+        # files changed in the meantime must still match
+        result = self.client.files.delete_many({'$and': [query, {'_id': {'$in': ids}}]})
+        if self.stats:
+            if result.deleted_count != len(docs):
+                left = set(d['_id'] for d in self.client.files.find(
+                        {'_id': {'$in': ids}}, ['_id']))
+                docs = [doc for doc in docs if doc['_id'] not in left]
+            delta = {}
+            for doc in docs:
+                catalog_stats.apply_delta(delta, self._delta(doc, None))
+            self._count(delta)
+        return result.deleted_count
+
+    @run_on_executor(workload='bulk')
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        query = self._query(prepare_filters(query))
+        if self.prefixes:
+            update = self.prefixes.encode_update(update)
+        if after:
+            query = {'$and': [query, {'_id': {'$gt': ObjectId(after)}}]}
+        projection = ['_id'] + (self.stats.fields if self.stats else [])
+        docs = list(self.client.files.find(query, projection, sort=[('_id', 1)],
+                                           limit=limit))
+        if not docs:
+            return 0, 0, None
+        ids = [doc['_id'] for doc in docs]
+        result = self.client.files.update_many({'$and': [query, {'_id': {'$in': ids}}]},
+                                               update)
+        if self.stats and result.modified_count:
+            new = {doc['_id']: doc for doc in
+                   self.client.files.find({'_id': {'$in': ids}}, projection)}
+            delta = {}
+            for doc in docs:
+                catalog_stats.apply_delta(delta, self._delta(doc, new.get(doc['_id'])))
+            self._count(delta)
+        return len(docs), result.modified_count, str(ids[-1])
+
+    @run_on_executor(workload='bulk')
+    def save_job(self, job, owner=None):
+        doc = dict(job)
+        doc['_id'] = doc.pop('id')
+        if owner is None:
+            self.client.jobs.replace_one({'_id': doc['_id']}, doc, upsert=True)
+            return True
+        result = self.client.jobs.replace_one({'_id': doc['_id'], 'state': 'running',
+                                               'owner': owner}, doc)
+        return result.matched_count == 1
+
+    @run_on_executor(workload='bulk')
+    def claim_job(self, job_id, owner, stale_before):
+        doc = self.client.jobs.find_one_and_update(
+                {'_id': job_id, '$or': [
+                    {'state': 'queued'},
+                    # also jobs saved before heartbeats were kept
+                    {'state': 'running', 'heartbeat': {'$not': {'$gte': stale_before}}},
+                ]},
+                {'$set': {'state': 'running', 'owner': owner, 'heartbeat': time.time()}},
+                return_document=ReturnDocument.AFTER)
+        return self._job(doc) if doc else None
+
+    @staticmethod
+    def _job(doc):
+        doc['id'] = doc.pop('_id')
+        return doc
+
+    @run_on_executor(workload='point')
+    def get_job(self, job_id):
+        doc = self.client.jobs.find_one({'_id': job_id})
+        return self._job(doc) if doc else None
+
+    @run_on_executor(workload='point')
+    def find_jobs(self, state=None):
+        query = {'state': state} if state else {}
+        return [self._job(doc) for doc in
+                self.client.jobs.find(query, sort=[('created', -1)])]
+
+    @run_on_executor(workload='bulk')
+    def delete_job(self, job_id):
+        self.client.job_results.delete_many({'job': job_id})
+        self.client.jobs.delete_one({'_id': job_id})
+
+    @run_on_executor(workload='bulk')
+    def save_job_result(self, job_id, seq, data):
+        self.client.job_results.replace_one({'_id': '%s:%d' % (job_id, seq)},
+                                            {'job': job_id, 'seq': seq, 'data': data},
+                                            upsert=True)
+
+    @run_on_executor(workload='bulk')
+    def get_job_results(self, job_id, start=0, limit=10):
+        return [doc['data'] for doc in
+                self.client.job_results.find({'job': job_id, 'seq': {'$gte': start}},
+                                             sort=[('seq', 1)], limit=limit)]
+
+    def export_cursor(self, query=None, projection=None, after=None,
+                      batch_size=10000, ctx=None):
+        """
+        A single cursor over full documents in `_id` order, starting
+        after the `mongo_id` `after`. Nothing is read until the cursor
+        is iterated, so this can be called outside the executor.
+        """
+        query = dict(query) if query else {}
+        if 'mongo_id' in query:
+            query['_id'] = query['mongo_id']
+            del query['mongo_id']
+
+        if '_id' in query and not isinstance(query['_id'], dict):
+            query['_id'] = ObjectId(query['_id'])
+        query = self._query(query)
+
+        if after:
+            after_filter = {'_id': {'$gt': ObjectId(after)}}
+            query = {'$and': [query, after_filter]} if query else after_filter
+
+        if projection:
+            # `_id` is always needed to resume
+            projection = list(projection)+['_id']
+
+        cursor = self._files(ctx).find(query, projection,
+                                       batch_size=batch_size,
+                                       no_cursor_timeout=True,
+                                       sort=[('_id', 1)])
+        return DecodedCursor(cursor, self.prefixes) if self.prefixes else cursor
+
+    @run_on_executor(workload='bulk')
+    def next_batch(self, cursor, size, transform=None, ctx=None):
+        """
+        Read up to `size` documents from `cursor`. If given, `transform`
+        is applied to the list of documents on the executor thread.
+        """
+        docs = list(islice(cursor, size))
+        return transform(docs) if transform else docs
+
+    def create_file(self, metadata, ctx=None):
+        if self.coalescer:
+            return self.coalescer.insert(metadata, ctx=ctx)
+        return self._create_file(metadata, ctx=ctx)
+
+    @run_on_executor(workload='write')
+    def _create_file(self, metadata, ctx=None):
+        with self._session(ctx) as session:
+            result = self.client.files.insert_one(self._stored(metadata), session=session)
         if (not result) or (not result.inserted_id):
             logger.warn('did not insert file')
             raise Exception('did not insert new file')
+        if self.stats:
+            self._count(self.stats.delta(None, metadata))
         return str(result.inserted_id)
 
-    @run_on_executor
-    def get_file(self, filters):
+    @run_on_executor(workload='point')
+    def get_file(self, filters, ctx=None):
         if 'mongo_id' in filters:
             filters['_id'] = filters['mongo_id']
             del filters['mongo_id']
@@ -69,16 +668,16 @@ class Mongo(object):
         if '_id' in filters and not isinstance(filters['_id'], dict):
             filters['_id'] = ObjectId(filters['_id'])
 
-        ret = self.client.files.find_one(filters)
+        with self._session(ctx) as session:
+            ret = self._files(ctx).find_one(self._query(filters), session=session)
 
         if ret and '_id' in ret:
             ret['mongo_id'] = str(ret['_id'])
             del ret['_id']
 
-        return ret
+        return self._loaded(ret)
 
-    @run_on_executor
-    def update_file(self, metadata):
+    def update_file(self, metadata, ctx=None):
         # don't change the original dict
         metadata_cpy = metadata.copy()
 
@@ -94,8 +693,31 @@ class Mongo(object):
         # _id cannot be updated. Remove _id 
         del metadata_cpy['_id']
 
-        result = self.client.files.update_one({'_id': metadata_id},
-                                              {'$set': metadata_cpy})
+        if self.coalescer:
+            return self.coalescer.update(metadata_id, metadata_cpy, ctx=ctx)
+        return self._update_file(metadata_id, metadata_cpy, ctx=ctx)
+
+    @run_on_executor(workload='write')
+    def _update_file(self, metadata_id, metadata_cpy, ctx=None):
+        metadata_cpy = self._stored(metadata_cpy)
+        if self.stats:
+            # the old version is needed to update the statistics
+            with self._session(ctx) as session:
+                old = self.client.files.find_one_and_update(
+                        {'_id': metadata_id}, {'$set': metadata_cpy},
+                        return_document=ReturnDocument.BEFORE, session=session)
+            new = dict(old or {})
+            new.update(metadata_cpy)
+            if old is None or new == old:
+                logger.warn('updated 0 files with id %r', metadata_id)
+                raise Exception('did not update')
+            self._count(self._delta(old, new))
+            return
+
+        with self._session(ctx) as session:
+            result = self.client.files.update_one({'_id': metadata_id},
+                                                  {'$set': metadata_cpy},
+                                                  session=session)
 
         if result.modified_count is None:
             logger.warn('Cannot determine if document has been modified since `result.modified_count` has the value `None`. `result.matched_count` is %s' % result.matched_count)
@@ -104,8 +726,8 @@ class Mongo(object):
                         result.modified_count, metadata_id)
             raise Exception('did not update')
 
-    @run_on_executor
-    def replace_file(self, metadata):
+    @run_on_executor(workload='write')
+    def replace_file(self, metadata, ctx=None):
         if 'mongo_id' in metadata:
             metadata['_id'] = metadata['mongo_id']
             del metadata['mongo_id']
@@ -116,11 +738,24 @@ class Mongo(object):
             metadata_id = ObjectId(metadata_id)
 
         # _id cannot be updated. Make a copy and remove _id 
-        metadata_cpy = metadata.copy()
+        metadata_cpy = self._stored(metadata.copy())
         del metadata_cpy['_id']
 
-        result = self.client.files.replace_one({'_id': metadata_id},
-                                               metadata_cpy)
+        if self.stats:
+            with self._session(ctx) as session:
+                old = self.client.files.find_one_and_replace(
+                        {'_id': metadata_id}, metadata_cpy,
+                        return_document=ReturnDocument.BEFORE, session=session)
+            if old is None or dict(metadata_cpy, _id=metadata_id) == old:
+                logger.warn('updated 0 files with id %r', metadata_id)
+                raise Exception('did not update')
+            self._count(self._delta(old, metadata_cpy))
+            return
+
+        with self._session(ctx) as session:
+            result = self.client.files.replace_one({'_id': metadata_id},
+                                                   metadata_cpy,
+                                                   session=session)
 
         if result.modified_count is None:
             logger.warn('Cannot determine if document has been modified since `result.modified_count` has the value `None`. `result.matched_count` is %s' % result.matched_count)
@@ -129,8 +764,8 @@ class Mongo(object):
                         result.modified_count, metadata_id)
             raise Exception('did not update')
 
-    @run_on_executor
-    def delete_file(self, filters):
+    @run_on_executor(workload='write')
+    def delete_file(self, filters, ctx=None):
         if 'mongo_id' in filters:
             filters['_id'] = filters['mongo_id']
             del filters['mongo_id']
@@ -138,9 +773,80 @@ class Mongo(object):
         if '_id' in filters and not isinstance(filters['_id'], dict):
             filters['_id'] = ObjectId(filters['_id'])
 
-        result = self.client.files.delete_one(filters)
+        filters = self._query(filters)
+        if self.stats:
+            with self._session(ctx) as session:
+                old = self.client.files.find_one_and_delete(
+                        filters, projection=self.stats.fields, session=session)
+            if old is None:
+                logger.warn('deleted 0 files with filter %r', filters)
+                raise Exception('did not delete')
+            self._count(self._delta(old, None))
+            return
+
+        with self._session(ctx) as session:
+            result = self.client.files.delete_one(filters, session=session)
 
         if result.deleted_count != 1:
             logger.warn('deleted %d files with filter %r',
                         result.deleted_count, filter)
             raise Exception('did not delete')
+
+    def _count(self, delta):
+        """
+        Apply the statistics changes `delta` to the `stats` collection.
+        The file write already happened, so failures are only logged;
+        the next reconciliation corrects the counters.
+        """
+        requests = [UpdateOne({'_id': catalog_stats.counter_id(group, key)},
+                              {'$inc': {'files': files, 'bytes': size},
+                               '$setOnInsert': {'group': group, 'key': key}},
+                              upsert=True)
+                    for (group, key), (files, size) in delta.items()]
+        if not requests:
+            return
+        try:
+            self.client.stats.bulk_write(requests, ordered=False)
+        except Exception:
+            metrics.incr('mongo.stats.errors')
+            logger.warn('cannot update statistics', exc_info=True)
+
+    @run_on_executor(workload='point')
+    def get_stats(self, ctx=None):
+        reconciled = None
+        counters = []
+        for doc in self.client.stats.find():
+            if doc['_id'] == 'reconciled':
+                reconciled = doc.get('date')
+            elif doc.get('files') or doc.get('bytes'):
+                counters.append((doc.get('group'), doc.get('key'),
+                                 doc.get('files', 0), doc.get('bytes', 0)))
+        return catalog_stats.summary(counters, reconciled)
+
+    def reconcile_stats(self):
+        """
+        Recount the statistics with a scan over the needed fields of
+        all files, and overwrite the counters (blocking).
+
+        Counter updates racing with the scan may be lost or counted
+        twice; the next reconciliation corrects them.
+        """
+        start = datetime.datetime.utcnow()
+        docs = self.client.files.find({}, self.stats.fields, batch_size=10000)
+        counters = self.stats.count(self._loaded(doc) for doc in docs)
+        ids = []
+        requests = []
+        for (group, key), (files, size) in counters.items():
+            ids.append(catalog_stats.counter_id(group, key))
+            requests.append(ReplaceOne({'_id': ids[-1]},
+                                       {'group': group, 'key': key,
+                                        'files': files, 'bytes': size},
+                                       upsert=True))
+        requests.append(ReplaceOne({'_id': 'reconciled'}, {'date': start}, upsert=True))
+        old = self.client.stats.find_one({'_id': 'total'}) or {}
+        self.client.stats.bulk_write(requests, ordered=False)
+        self.client.stats.delete_many({'_id': {'$nin': ids+['reconciled']}})
+        total = counters.get(('total', None), [0, 0])
+        if old.get('files') != total[0]:
+            logger.info('statistics reconciled: %d files (counter was %r)',
+                        total[0], old.get('files'))
@@ -0,0 +1,462 @@
+"""
+Dictionary encoding of location prefixes.
+
+Most locations share a few long prefixes (scheme, host and the first
+directories, like `gsiftp://gridftp.icecube.wisc.edu/data/exp/`). With
+`compact_locations` enabled in `[mongo]`, each prefix is stored once in
+the `location_prefixes` collection under a small number, and locations
+are stored as
+
+    MARKER + hex(number) + MARKER + rest of the location
+
+The `Mongo` backend encodes locations on writes, decodes them on reads,
+and rewrites conditions on `locations` in queries, so the REST API only
+ever sees full locations. Documents written before, or by a server
+without the option, keep plain locations; both forms are matched by
+queries, and the `compact-locations` command converts them.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import time
+import logging
+import argparse
+import threading
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from bson import BSON
+
+try:
+    str_types = (basestring,)
+except NameError:
+    str_types = (str,)
+
+logger = logging.getLogger('prefixes')
+
+# starts and ends the prefix number of an encoded location
+MARKER = u'\x01'
+
+# id of the document holding the last prefix number
+COUNTER_ID = 'next'
+
+# characters with a special meaning in regular expressions
+REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+def split_location(location, depth):
+    """
+    Split `location` after the scheme and host (if a URL) and `depth`
+    directories. Returns `(prefix, rest)`.
+    """
+    start = location.find('://')
+    start = location.find('/', start+3) if start >= 0 else location.find('/')
+    if start < 0:
+        return '', location
+    end = start
+    for _ in range(depth):
+        pos = location.find('/', end+1)
+        if pos < 0:
+            break
+        end = pos
+    return location[:end+1], location[end+1:]
+
+def literal_prefix(pattern):
+    """
+    Split a regex anchored with `^` into the literal text it starts
+    with and the remaining pattern, or return `None`.
+    """
+    if not pattern.startswith('^'):
+        return None
+    literal = []
+    i = 1
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i+1 >= len(pattern) or pattern[i+1].isalnum():
+                break
+            c, step = pattern[i+1], 2
+        elif c in REGEX_SPECIAL:
+            break
+        else:
+            step = 1
+        if pattern[i+step:i+step+1] in ('*', '+', '?', '{'):
+            # a quantified character is not literal
+            break
+        literal.append(c)
+        i += step
+    return ''.join(literal), pattern[i:]
+
+class LocationPrefixes(object):
+    """
+    The prefix dictionary of one database, cached in this process.
+
+    Args:
+        collection: the pymongo collection of the prefixes, or None to
+            keep them in this process only (e.g. for size estimates)
+        depth: directories after the host that make up a prefix
+        min_length: shorter prefixes are not worth encoding
+        reload_interval: seconds between reloads of the dictionary when
+            a query needs a prefix that is not cached
+    """
+    def __init__(self, collection, depth=3, min_length=12, reload_interval=5):
+        self.collection = collection
+        self.depth = depth
+        self.min_length = min_length
+        self.reload_interval = reload_interval
+        self.by_prefix = {}
+        self.by_tag = {}
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.collection.create_index('prefix', unique=True, sparse=True, background=True)
+
+    @staticmethod
+    def tag(number):
+        return u'%s%x%s' % (MARKER, number, MARKER)
+
+    def _add(self, prefix, number):
+        tag = self.tag(number)
+        self.by_prefix[prefix] = tag
+        self.by_tag[tag] = prefix
+
+    def load(self):
+        """Read the whole dictionary (blocking)"""
+        with self.lock:
+            if self.collection is not None:
+                for doc in self.collection.find({'prefix': {'$exists': True}}):
+                    self._add(doc['prefix'], doc['_id'])
+            self.loaded = time.time()
+
+    def _create(self, prefix):
+        """The tag of a new `prefix`, numbered from a shared counter"""
+        if self.collection is None:
+            with self.lock:
+                self._add(prefix, len(self.by_prefix)+1)
+            return self.by_prefix[prefix]
+        number = self.collection.find_one_and_update(
+                {'_id': COUNTER_ID}, {'$inc': {'n': 1}}, upsert=True,
+                return_document=ReturnDocument.AFTER)['n']
+        try:
+            self.collection.insert_one({'_id': number, 'prefix': prefix})
+        except DuplicateKeyError:
+            # another process added it first
+            number = self.collection.find_one({'prefix': prefix})['_id']
+        with self.lock:
+            self._add(prefix, number)
+        return self.tag(number)
+
+    def encode(self, location, create=True):
+        """
+        The stored form of `location`. Unknown prefixes are added if
+        `create`, else the location stays plain.
+        """
+        if location.startswith(MARKER):
+            return location
+        prefix, rest = split_location(location, self.depth)
+        if len(prefix) < self.min_length:
+            return location
+        tag = self.by_prefix.get(prefix)
+        if tag is None:
+            if create:
+                tag = self._create(prefix)
+            else:
+                if time.time() - self.loaded > self.reload_interval:
+                    self.load()
+                tag = self.by_prefix.get(prefix)
+                if tag is None:
+                    return location
+        return tag + rest
+
+    def decode(self, location):
+        """The full location of a stored one"""
+        if not location.startswith(MARKER):
+            return location
+        end = location.find(MARKER, 1) + 1
+        tag = location[:end]
+        prefix = self.by_tag.get(tag)
+        if prefix is None:
+            # added by another process
+            self.load()
+            prefix = self.by_tag.get(tag)
+            if prefix is None:
+                logger.warn('unknown location prefix %r', tag)
+                return location
+        return prefix + location[end:]
+
+    def encode_doc(self, doc):
+        """A copy of `doc` with encoded `locations`"""
+        locations = doc.get('locations')
+        if not isinstance(locations, list):
+            return doc
+        return dict(doc, locations=[self.encode(l) if isinstance(l, str_types) else l
+                                    for l in locations])
+
+    def decode_doc(self, doc):
+        """Decode the `locations` of `doc` in place, returning it"""
+        locations = doc.get('locations') if doc else None
+        if isinstance(locations, list):
+            doc['locations'] = [self.decode(l) if isinstance(l, str_types) else l
+                                for l in locations]
+        return doc
+
+    def decoded(self, doc):
+        """A copy of `doc` with decoded `locations`"""
+        return self.decode_doc(dict(doc)) if doc else doc
+
+    def both(self, value):
+        """The plain and the encoded form of a location in a query"""
+        if not isinstance(value, str_types):
+            return [value]
+        encoded = self.encode(value, create=False)
+        return [value] if encoded == value else [value, encoded]
+
+    def encode_query(self, query):
+        """A copy of `query` matching the stored form of `locations`"""
+        if not isinstance(query, dict):
+            return query
+        ret = {}
+        clauses = []
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                ret[key] = [self.encode_query(q) for q in value]
+            elif key == 'locations':
+                clauses.extend(self.location_clauses(value))
+            else:
+                ret[key] = value
+        if not clauses:
+            return ret
+        if ret:
+            clauses.insert(0, ret)
+        return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+    def location_clauses(self, cond):
+        """Query clauses matching stored locations like `{'locations': cond}`"""
+        if not isinstance(cond, dict) or not any(k.startswith('$') for k in cond):
+            if isinstance(cond, list):
+                return [{'locations': [self.encode(v, create=False) if isinstance(v, str_types)
+                                       else v for v in cond]}]
+            return [{'locations': {'$in': self.both(cond)}}]
+        ret = []
+        simple = {}
+        for op, value in cond.items():
+            if op == '$eq':
+                ret.append({'locations': {'$in': self.both(value)}})
+            elif op == '$ne':
+                simple['$nin'] = simple.get('$nin', []) + self.both(value)
+            elif op in ('$in', '$nin'):
+                simple[op] = simple.get(op, []) + [v for x in value for v in self.both(x)]
+            elif op == '$all':
+                simple[op] = [self.encode(v, create=False) if isinstance(v, str_types) else v
+                              for v in value]
+            elif op == '$elemMatch':
+                simple[op] = self.element_condition(value)
+            elif op == '$regex':
+                ret.append(self.regex_clause(value, cond.get('$options', '')))
+            elif op in ('$options', '$exists', '$size', '$type'):
+                if op != '$options':
+                    simple[op] = value
+            else:
+                raise Exception('unsupported operator %s on locations' % op)
+        if simple:
+            ret.insert(0, {'locations': simple})
+        return ret
+
+    def element_condition(self, cond):
+        """The `$elemMatch` condition `cond` on stored locations"""
+        if not isinstance(cond, dict):
+            return cond
+        ret = {}
+        for op, value in cond.items():
+            if op in ('$eq', '$ne'):
+                ret['$in' if op == '$eq' else '$nin'] = self.both(value)
+            elif op in ('$in', '$nin'):
+                ret[op] = [v for x in value for v in self.both(x)]
+            elif op in ('$exists', '$type'):
+                ret[op] = value
+            else:
+                raise Exception('unsupported operator %s in $elemMatch on locations' % op)
+        return ret
+
+    def regex_clause(self, pattern, options=''):
+        """
+        A clause matching stored locations whose full form matches the
+        regex `pattern`. Regexes anchored at a literal text are
+        rewritten per prefix (and can use an index), others are
+        evaluated on the decoded locations with `$expr` (MongoDB 4.2+).
+        """
+        if hasattr(pattern, 'pattern'):
+            pattern = pattern.pattern
+        if time.time() - self.loaded > self.reload_interval:
+            self.load()
+        prefixes = list(self.by_prefix.items())
+        clauses = [{'locations': {'$regex': pattern, '$options': options}}]
+        split = literal_prefix(pattern) if not options else None
+        if split is not None:
+            literal, rest = split
+            for prefix, tag in prefixes:
+                if literal.startswith(prefix):
+                    regex = '^' + re.escape(tag) + re.escape(literal[len(prefix):]) + rest
+                elif prefix.startswith(literal) and not rest:
+                    regex = '^' + re.escape(tag)
+                elif prefix.startswith(literal):
+                    split = None
+                    break
+                else:
+                    continue
+                clauses.append({'locations': {'$regex': regex}})
+        if split is None:
+            clauses = clauses[:1] + [{'$expr': self.regex_expr(prefixes, pattern, options)}]
+        return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+    @staticmethod
+    def regex_expr(prefixes, pattern, options):
+        """Aggregation expression of any decoded location matching `pattern`"""
+        end = {'$indexOfCP': ['$$l', MARKER, 1]}
+        tag = {'$substrCP': ['$$l', 0, {'$add': [end, 1]}]}
+        rest = {'$substrCP': ['$$l', {'$add': [end, 1]}, {'$strLenCP': '$$l'}]}
+        prefix = {'$switch': {'branches': [{'case': {'$eq': [tag, t]}, 'then': p}
+                                           for p, t in prefixes],
+                              'default': ''}}
+        decoded = {'$cond': [{'$eq': [{'$substrCP': ['$$l', 0, 1]}, MARKER]},
+                             {'$concat': [prefix, rest]}, '$$l']}
+        return {'$anyElementTrue': [{'$map': {
+            'input': {'$ifNull': ['$locations', []]}, 'as': 'l',
+            'in': {'$regexMatch': {'input': decoded, 'regex': pattern, 'options': options}},
+        }}]}
+
+    def encode_update(self, update):
+        """A copy of the update operators `update` with encoded locations"""
+        ret = {}
+        for op, fields in update.items():
+            if isinstance(fields, dict) and 'locations' in fields:
+                value = fields['locations']
+                if op in ('$set', '$setOnInsert'):
+                    value = [self.encode(v) for v in value]
+                elif op in ('$addToSet', '$push'):
+                    if isinstance(value, dict) and '$each' in value:
+                        value = dict(value, **{'$each': [self.encode(v) for v in value['$each']]})
+                    else:
+                        value = self.encode(value)
+                elif op == '$pull':
+                    if isinstance(value, dict) and '$in' in value:
+                        value = {'$in': [v for x in value['$in'] for v in self.both(x)]}
+                    elif not isinstance(value, dict):
+                        value = {'$in': self.both(value)}
+                elif op == '$pullAll':
+                    value = [v for x in value for v in self.both(x)]
+                fields = dict(fields, locations=value)
+            ret[op] = fields
+        return ret
+
+class DecodedCursor(object):
+    """A pymongo cursor returning documents with decoded locations"""
+    def __init__(self, cursor, prefixes):
+        self.cursor = cursor
+        self.prefixes = prefixes
+
+    def __iter__(self):
+        for doc in self.cursor:
+            yield self.prefixes.decode_doc(doc)
+
+    def close(self):
+        self.cursor.close()
+
+def doc_size(doc):
+    return len(BSON.encode(doc))
+
+def compact_locations(files, prefixes, batch_size=1000, pause=0, decode=False,
+                      dry_run=False, progress_interval=10):
+    """
+    Convert the plain locations in the pymongo collection `files` to
+    the stored form of `prefixes` (or back, with `decode`), in
+    `_id` batches with `pause` seconds between them.
+
+    A document only changes if its locations are still the ones read,
+    so the server can keep writing; an interrupted run continues when
+    started again. Returns the counters `checked`, `converted` and the
+    BSON `bytes_before` and `bytes_after` of the converted documents.
+    """
+    counts = {'checked': 0, 'converted': 0, 'bytes_before': 0, 'bytes_after': 0}
+    start = last_report = time.time()
+    after = None
+    while True:
+        query = {'locations': {'$exists': True}}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        batch = list(files.find(query, sort=[('_id', 1)], limit=batch_size))
+        if not batch:
+            break
+        after = batch[-1]['_id']
+        counts['checked'] += len(batch)
+
+        requests = []
+        for doc in batch:
+            old = doc['locations']
+            if not isinstance(old, list):
+                continue
+            new = (prefixes.decoded(doc) if decode else prefixes.encode_doc(doc))['locations']
+            if new == old:
+                continue
+            counts['converted'] += 1
+            counts['bytes_before'] += doc_size(doc)
+            counts['bytes_after'] += doc_size(dict(doc, locations=new))
+            requests.append(UpdateOne({'_id': doc['_id'], 'locations': old},
+                                      {'$set': {'locations': new}}))
+        if requests and not dry_run:
+            files.bulk_write(requests, ordered=False)
+
+        now = time.time()
+        if now - last_report > progress_interval:
+            logger.info('%d documents checked, %d converted (%.0f docs/s)',
+                        counts['checked'], counts['converted'],
+                        counts['checked']/(now-start))
+            last_report = now
+        if pause:
+            time.sleep(pause)
+    return counts
+
+def main(argv=None):
+    from file_catalog.config import Config
+    from file_catalog.backend import create_backend
+
+    parser = argparse.ArgumentParser(prog='file_catalog compact-locations',
+            description='Convert stored locations to or from the prefix dictionary')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents read and updated at once')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to wait between batches')
+    parser.add_argument('--decode', action='store_true', default=False,
+                        help='restore plain locations (before disabling compact_locations)')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only count the documents to convert and the bytes saved')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+    config = Config(args.config)
+    # the dictionary is needed even if the option is still off
+    mongo = dict(config.get('mongo', {}), compact_locations=True)
+    config['mongo'] = mongo
+    db = create_backend(config, args.db_host or config['server']['db_host'])
+    shards = getattr(db, 'shards', [db])
+    if not all(getattr(shard, 'prefixes', None) for shard in shards):
+        raise Exception('compact locations need the mongo backend')
+
+    total = {}
+    for shard in shards:
+        shard.prefixes.ensure_indexes()
+        shard.prefixes.load()
+        counts = compact_locations(shard.client.files, shard.prefixes,
+                                   batch_size=args.batch_size, pause=args.pause,
+                                   decode=args.decode, dry_run=args.dry_run)
+        for k, v in counts.items():
+            total[k] = total.get(k, 0) + v
+    saved = total['bytes_before'] - total['bytes_after']
+    logger.info('done: %d documents checked, %d converted, %d bytes saved (%.1f%% of them), '
+                '%d prefixes', total['checked'], total['converted'], saved,
+                100.0*saved/total['bytes_before'] if total['bytes_before'] else 0,
+                sum(len(shard.prefixes.by_prefix) for shard in shards))
+    return total
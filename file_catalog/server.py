@@ -2,25 +2,40 @@ from __future__ import absolute_import, division, print_function
 
 import sys
 import os
+import time
+import signal
 import logging
 from functools import wraps
 from pkgutil import get_loader
 from collections import OrderedDict
 
-import datetime
+import json
 
 import pymongo.errors
 
 import tornado.ioloop
 import tornado.web
-from tornado.escape import json_encode,json_decode
-from tornado.gen import coroutine
+from tornado.httpclient import AsyncHTTPClient
+from tornado.escape import json_decode,utf8
+from tornado.gen import coroutine, sleep, Return
+from concurrent.futures import ThreadPoolExecutor
 
 from file_catalog.validation import Validation
+from file_catalog.config import LiveConfig
 
 import file_catalog
-from file_catalog.mongo import Mongo
+from file_catalog.backend import create_backend, sort_is_indexed
+from file_catalog.singleflight import SingleFlight
+from file_catalog.metrics import metrics
+from file_catalog.executor import Overloaded
+from file_catalog.context import RequestContext
 from file_catalog import urlargparse
+from file_catalog import export
+from file_catalog.dates import add_modified_filter, set_last_modification_date
+from file_catalog.compression import Compression
+from file_catalog.timing import Timings, ProfileSampler
+from file_catalog.jobs import (JobManager, ACTIVE_STATES, dump_query, load_query,
+                               update_filter)
 
 logger = logging.getLogger('server')
 
@@ -49,8 +64,17 @@ def tornado_logger(handler):
     else:
         log_method = logger.error
     request_time = 1000.0 * handler.request.request_time()
-    log_method("%d %s %.2fms", handler.get_status(),
-            handler._request_summary(), request_time)
+    ctx = getattr(handler, 'ctx', None)
+    if ctx is not None and ctx.timings.items():
+        log_method("%d %s %.2fms (%s)", handler.get_status(),
+                handler._request_summary(), request_time, ctx.timings)
+    else:
+        log_method("%d %s %.2fms", handler.get_status(),
+                handler._request_summary(), request_time)
+
+def json_encode(value):
+    """Like tornado's `json_encode`, also writing dates and ids as strings"""
+    return json.dumps(value, default=export.json_default).replace("</", "<\\/")
 
 def sort_dict(d):
     """
@@ -67,13 +91,50 @@ def sort_dict(d):
 
     return od
 
-def set_last_modification_date(d):
-    d['meta_modify_date'] = str(datetime.datetime.utcnow())
+def check_sort(sort):
+    """
+    Check a `sort` argument: a list of `[field, direction]` pairs with
+    direction 1 (ascending) or -1 (descending). Returns it as a list
+    of tuples.
+    """
+    if not isinstance(sort, list):
+        raise Exception('sort is not a list')
+    ret = []
+    for item in sort:
+        if (not isinstance(item, list) or len(item) != 2
+            or not isinstance(item[0], basestring) or item[1] not in (1, -1)):
+            raise Exception('invalid sort item %r' % (item,))
+        ret.append((item[0], item[1]))
+    return ret
+
+def parse_sort(value):
+    """
+    Parse the `sort` query parameter, a comma separated list of fields,
+    each prefixed by `-` for descending order (e.g. `-meta_modify_date,uid`).
+    """
+    ret = []
+    for field in str(value).split(','):
+        field = field.strip()
+        direction = 1
+        if field[:1] in ('-', '+'):
+            direction = -1 if field[0] == '-' else 1
+            field = field[1:].strip()
+        if not field:
+            raise Exception('empty sort field')
+        ret.append((field, direction))
+    return ret
+
+class Health(object):
+    """Whether the server is ready to serve, and what it is doing if not"""
+    def __init__(self):
+        self.started = time.time()
+        self.ready = False
+        self.status = 'starting'
 
 class Server(object):
     """A file_catalog server instance"""
 
-    def __init__(self, config, port=8888, db_host='localhost', debug=False):
+    def __init__(self, config, port=8888, db_host='localhost', debug=False, db=None):
         static_path = get_pkgdata_filename('file_catalog', 'data/www')
         if static_path is None:
             raise Exception('bad static path')
@@ -91,27 +152,191 @@ class Server(object):
             'debug': debug,
         }
 
+        compression = Compression(**config.get('compression', {}))
+        profiler = ProfileSampler(**config.get('profile', {}))
+
+        if db is None:
+            db = create_backend(config, db_host)
+        backend = db
+        # identical concurrent reads share one database call
+        db = SingleFlight(backend, **config.get('singleflight', {}))
+        jobs = JobManager(db, **config.get('jobs', {}))
+        health = Health()
+
+        # sections and options that can change without a restart (see
+        # `LiveConfig`): those read by handlers on each request, and
+        # those of the components below
+        components = {
+            'compression': compression,
+            'profile': profiler,
+            'jobs': jobs,
+            'singleflight': db,
+            config.get('server', {}).get('backend', 'mongo'): backend,
+        }
+        if db.slow_log:
+            components['slow_queries'] = db.slow_log
+        live_config = LiveConfig(config, components=components, per_request={
+            'server': ('request_timeout', 'retry_after'),
+            'filelist': None,
+            'export': None,
+            'metadata': None,
+        })
+
         api_args = main_args.copy()
         api_args.update({
-            'db': Mongo(db_host),
-            'config': config,
+            'db': db,
+            'config': live_config,
+            'compression': compression,
+            'profiler': profiler,
+            'jobs': jobs,
+            'health': health,
         })
 
-        app = tornado.web.Application([
+        self.live_config = live_config
+        self.port = port
+        self.db = db
+        self.jobs = jobs
+        self.health = health
+        self.app = tornado.web.Application([
                 (r"/", MainHandler, main_args),
                 (r"/api", HATEOASHandler, api_args),
                 (r"/api/files", FilesHandler, api_args),
+                (r"/api/files/query", FilesQueryHandler, api_args),
                 (r"/api/files/(.*)", SingleFileHandler, api_args),
+                (r"/api/export", ExportHandler, api_args),
+                (r"/api/stats", StatsHandler, api_args),
+                (r"/api/jobs", JobListHandler, api_args),
+                (r"/api/jobs/export", JobExportHandler, api_args),
+                (r"/api/jobs/delete", JobDeleteHandler, api_args),
+                (r"/api/jobs/update", JobUpdateHandler, api_args),
+                (r"/api/jobs/([0-9a-f]+)/result", JobResultHandler, api_args),
+                (r"/api/jobs/([0-9a-f]+)", JobHandler, api_args),
+                # the first bulk operations were served under /api/bulk
+                (r"/api/bulk", JobListHandler, api_args),
+                (r"/api/bulk/delete", JobDeleteHandler, api_args),
+                (r"/api/bulk/update", JobUpdateHandler, api_args),
+                (r"/api/bulk/([0-9a-f]+)", JobHandler, api_args),
+                (r"/api/admin/metrics", MetricsHandler, api_args),
+                (r"/api/admin/slow_queries", SlowQueriesHandler, api_args),
+                (r"/api/admin/config", ConfigHandler, api_args),
+                (r"/health/live", LiveHandler, api_args),
+                (r"/health/ready", ReadyHandler, api_args),
             ],
             static_path=static_path,
             template_path=template_path,
             log_function=tornado_logger,
+            transforms=[compression.transform],
         )
-        app.listen(port)
 
     def run(self):
+        # listen right away so that /health/live answers, while
+        # /health/ready reports 503 until the warmup is done
+        self.app.listen(self.port)
+        tornado.ioloop.IOLoop.current().add_callback(self.start)
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+                tornado.ioloop.IOLoop.current().add_callback_from_signal(self.reload_config))
         tornado.ioloop.IOLoop.current().start()
 
+    def reload_config(self):
+        """Re-read the configuration file (on SIGHUP)"""
+        try:
+            self.live_config.reload()
+        except Exception:
+            logger.warn('cannot reload the configuration', exc_info=True)
+
+    @coroutine
+    def warmup(self):
+        """
+        Warm up the backend on a separate thread, retrying every
+        `retry_interval` seconds until the database can be reached,
+        and render the main page and API root once. Then report ready.
+        """
+        warmup_config = self.live_config.current.get('warmup', {})
+        start = time.time()
+        if warmup_config.get('enabled', True):
+            executor = ThreadPoolExecutor(max_workers=1)
+            retry_interval = warmup_config.get('retry_interval', 5)
+            while True:
+                self.health.status = 'warming up'
+                try:
+                    yield executor.submit(self.db.warmup,
+                                          prefetch=warmup_config.get('prefetch', 0))
+                    break
+                except Exception:
+                    logger.warn('warmup failed, retrying in %ss', retry_interval,
+                                exc_info=True)
+                    self.health.status = 'database unreachable'
+                    yield sleep(retry_interval)
+            executor.shutdown(wait=False)
+
+            # compile the templates and exercise the request path
+            if self.port:
+                client = AsyncHTTPClient()
+                for path in ('/', '/api'):
+                    yield client.fetch('http://localhost:%s%s' % (self.port, path),
+                                       raise_error=False)
+
+        metrics.observe('server.warmup_ms', 1000.0*(time.time()-start))
+        logger.info('ready after %.1fs of warmup', time.time()-start)
+        self.health.status = 'ready'
+        self.health.ready = True
+
+    @coroutine
+    def start(self):
+        """Warm up, then start the background tasks using the database"""
+        yield self.warmup()
+        self.start_index_build()
+        if self.db.stats and self.db.stats.reconcile_interval > 0:
+            self.start_reconciliation(self.db.stats.reconcile_interval)
+        # continue jobs interrupted by a restart (of any server sharing
+        # them), and remove old ones
+        tornado.ioloop.IOLoop.current().add_callback(self.jobs.resume)
+        if self.jobs.lease > 0:
+            tornado.ioloop.PeriodicCallback(self.jobs.resume,
+                                            self.jobs.lease*1000).start()
+        if self.jobs.gc_interval > 0:
+            tornado.ioloop.PeriodicCallback(self.jobs.collect,
+                                            self.jobs.gc_interval*1000).start()
+
+    def start_index_build(self):
+        """Create any missing indexes in a background thread"""
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def run():
+            start = time.time()
+            try:
+                self.db.ensure_indexes()
+            except Exception:
+                logger.warn('cannot create the indexes', exc_info=True)
+            else:
+                logger.info('indexes checked or built in %.1fs', time.time()-start)
+
+        executor.submit(run)
+        executor.shutdown(wait=False)
+
+    def start_reconciliation(self, interval):
+        """
+        Recount the catalog statistics in a background thread now and
+        then every `interval` seconds, skipping a round if the previous
+        one is still running.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        running = []
+
+        def run():
+            try:
+                self.db.reconcile_stats()
+            except Exception:
+                logger.warn('statistics reconciliation failed', exc_info=True)
+
+        def reconcile():
+            if not running:
+                running.append(executor.submit(run))
+                running[0].add_done_callback(running.remove)
+
+        reconcile()
+        tornado.ioloop.PeriodicCallback(reconcile, interval*1000).start()
+
 class MainHandler(tornado.web.RequestHandler):
     """Main HTML handler"""
     def initialize(self, base_url='/', debug=False):
@@ -151,6 +376,9 @@ def catch_error(method):
     def wrapper(self, *args, **kwargs):
         try:
             return method(self, *args, **kwargs)
+        except Overloaded:
+            # let tornado turn this into a 503 via `write_error`
+            raise
         except Exception as e:
             logger.warn('Error in api handler', exc_info=True)
             kwargs = {'message':'Internal error in '+self.__class__.__name__}
@@ -161,11 +389,19 @@ def catch_error(method):
 
 class APIHandler(tornado.web.RequestHandler):
     """Base class for API handlers"""
-    def initialize(self, config, db=None, base_url='/', debug=False, rate_limit=10):
+    def initialize(self, config, db=None, base_url='/', debug=False, rate_limit=10,
+                   compression=None, profiler=None, jobs=None, health=None):
         self.db = db
+        self.jobs = jobs
+        self.health = health
         self.base_url = base_url
         self.debug = debug
-        self.config = config
+        # the whole request sees the configuration as it is now
+        self.live_config = config
+        self.config = config.current
+        self.compression = compression
+        self.profiler = profiler
+        self.profile = None
         
         # subtract 1 to test before current connection is added
         self.rate_limit = rate_limit-1
@@ -174,7 +410,23 @@ class APIHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
         self.set_header('Content-Type', 'application/hal+json; charset=UTF-8')
 
+    @property
+    def timings(self):
+        """Phase timers of this request"""
+        ctx = getattr(self, 'ctx', None)
+        return ctx.timings if ctx is not None else Timings()
+
     def prepare(self):
+        if self.profiler:
+            self.profile = self.profiler.start()
+
+        # database calls must start before the request deadline
+        server_config = self.config.get('server', {})
+        self.ctx = RequestContext.from_timeout(server_config.get('request_timeout'),
+                start=time.time()-self.request.request_time(),
+                read_only=(self.request.method in ('GET','HEAD')),
+                causal_token=self.request.headers.get('X-Causal-Token'))
+
         # implement rate limiting
         ip = self.request.remote_ip
         if ip in self.rate_limit_data:
@@ -186,25 +438,85 @@ class APIHandler(tornado.web.RequestHandler):
             self.rate_limit_data[ip] = 1
 
     def on_finish(self):
+        if self.profile:
+            self.profiler.stop(self.profile)
         ip = self.request.remote_ip
         self.rate_limit_data[ip] -= 1
         if self.rate_limit_data[ip] <= 0:
             del self.rate_limit_data[ip]
 
+    def finish(self, *args, **kwargs):
+        # hand the client a token to read its own writes with
+        ctx = getattr(self, 'ctx', None)
+        if ctx is not None and ctx.causal_token:
+            self.set_header('X-Causal-Token', ctx.causal_token)
+        if ctx is not None and not self._headers_written:
+            self.set_header('Server-Timing', ', '.join(filter(None, [
+                    ctx.timings.header(),
+                    'total;dur=%.2f' % (1000.0*self.request.request_time())])))
+        return super(APIHandler, self).finish(*args, **kwargs)
+
     def write(self, chunk):
         # override write so we don't output a json header
         if isinstance(chunk, dict):
-            chunk = json_encode(sort_dict(chunk))
+            timings = self.timings
+            with timings.phase('sort'):
+                chunk = sort_dict(chunk)
+            with timings.phase('encode'):
+                chunk = json_encode(chunk)
         super(APIHandler, self).write(chunk)
 
+    @coroutine
+    def write_large(self, chunk):
+        """
+        Like `write()` for responses that can get large: the dict `chunk`
+        is JSON-encoded on the compression thread pool, and compressed
+        there too if it exceeds the offload length.
+        """
+        compression = self.compression
+        if not compression:
+            self.write(chunk)
+            return
+        encoding = compression.negotiate(self.request.headers.get('Accept-Encoding', ''))
+        timings = self.timings
+
+        def encode():
+            with timings.phase('sort'):
+                data = sort_dict(chunk)
+            with timings.phase('encode'):
+                data = utf8(json_encode(data))
+            if encoding and len(data) >= compression.offload_length:
+                with timings.phase('compress'):
+                    return compression.compress(data, encoding), encoding
+            return data, None
+
+        data, used = yield compression.executor.submit(encode)
+        if used:
+            # the output transform leaves encoded responses alone
+            self.set_header('Content-Encoding', used)
+        super(APIHandler, self).write(data)
+
     def write_error(self,status_code=500,**kwargs):
         """Write out custom error page."""
+        exc_info = kwargs.pop('exc_info',None)
+        if exc_info and isinstance(exc_info[1], Overloaded):
+            # shed load: tell the client to come back later
+            status_code = 503
+            kwargs['message'] = str(exc_info[1])
+            self.set_header('Retry-After',
+                            str(self.config.get('server', {}).get('retry_after', 1)))
         self.set_status(status_code)
-        kwargs.pop('exc_info',None)
         if kwargs:
             self.write(kwargs)
         self.finish()
 
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, Overloaded):
+            metrics.incr('server.shed')
+            logger.info('shedding load: %s %s', value, self._request_summary())
+        else:
+            super(APIHandler, self).log_exception(typ, value, tb)
+
 class HATEOASHandler(APIHandler):
     def initialize(self, **kwargs):
         super(HATEOASHandler, self).initialize(**kwargs)
@@ -215,6 +527,8 @@ class HATEOASHandler(APIHandler):
                 'self': {'href': self.base_url},
             },
             'files': {'href': os.path.join(self.base_url,'files')},
+            'stats': {'href': os.path.join(self.base_url,'stats')},
+            'jobs': {'href': os.path.join(self.base_url,'jobs')},
         }
 
     @catch_error
@@ -227,30 +541,95 @@ class FilesHandler(APIHandler):
         self.files_url = os.path.join(self.base_url,'files')
         self.validation = Validation(self.config)
 
+    def check_paging(self, kwargs):
+        """Check `limit` and `start` in `kwargs`, capping `limit` at `max_files`"""
+        if 'limit' in kwargs:
+            kwargs['limit'] = int(kwargs['limit'])
+            if kwargs['limit'] < 1:
+                raise Exception('limit is not positive')
+
+            # check with config
+            if kwargs['limit'] > self.config['filelist']['max_files']:
+                kwargs['limit'] = self.config['filelist']['max_files']
+        else:
+            # if no limit has been defined, set max limit
+            kwargs['limit'] = self.config['filelist']['max_files']
+
+        if 'start' in kwargs:
+            kwargs['start'] = int(kwargs['start'])
+            if kwargs['start'] < 0:
+                raise Exception('start is negative')
+
+    def check_modified(self, kwargs):
+        """
+        Turn `modified_since` and `modified_before` in `kwargs` into a
+        range on `meta_modify_date` in the query.
+        """
+        since = kwargs.pop('modified_since', None)
+        before = kwargs.pop('modified_before', None)
+        if since is not None or before is not None:
+            kwargs['query'] = add_modified_filter(kwargs.get('query'),
+                                                  since=since, before=before)
+
+    @coroutine
+    def check_sort_index(self, kwargs):
+        """
+        Check that the `sort` in `kwargs` is backed by an index, so that
+        the database can return the first `limit` files without sorting
+        all matches. Depending on `unindexed_sort`, other sorts are
+        refused (resolves to `False` after sending a 400) or get their
+        `limit` capped.
+        """
+        if not kwargs.get('sort'):
+            raise Return(True)
+        indexes = yield self.db.sort_indexes(ctx=self.ctx)
+        if sort_is_indexed(kwargs['sort'], indexes, kwargs.get('query')):
+            raise Return(True)
+        metrics.incr('files.sort.unindexed')
+        filelist_config = self.config['filelist']
+        if filelist_config.get('unindexed_sort', 'cap') == 'refuse':
+            self.send_error(400, message='sort is not supported by an index')
+            raise Return(False)
+        kwargs['limit'] = min(kwargs['limit'],
+                              filelist_config.get('unindexed_sort_limit', 1000))
+        raise Return(True)
+
+    @coroutine
+    def write_files(self, files, next_url=None, next_start=None):
+        """
+        Write the list of files found by `find_files`, linking the next
+        page (with the `start` to send in the body of a POST, if given)
+        """
+        links = {
+            'self': {'href': self.files_url},
+            'parent': {'href': self.base_url},
+        }
+        if next_url:
+            links['next'] = {'href': next_url}
+            if next_start is not None:
+                links['next']['start'] = next_start
+        yield self.write_large({
+            '_links': links,
+            '_embedded':{
+                'files': files,
+            },
+            'files': [os.path.join(self.files_url,f['mongo_id']) for f in files],
+        })
+
     @catch_error
     @coroutine
     def get(self):
         try:
-            kwargs = urlargparse.parse(self.request.query)
-            if 'limit' in kwargs:
-                kwargs['limit'] = int(kwargs['limit'])
-                if kwargs['limit'] < 1:
-                    raise Exception('limit is not positive')
-
-                # check with config
-                if kwargs['limit'] > self.config['filelist']['max_files']:
-                    kwargs['limit'] = self.config['filelist']['max_files']
-            else:
-                # if no limit has been defined, set max limit
-                kwargs['limit'] = self.config['filelist']['max_files']
+            with self.timings.phase('parse'):
+                kwargs = urlargparse.parse(self.request.query)
+            self.check_paging(kwargs)
 
-            if 'start' in kwargs:
-                kwargs['start'] = int(kwargs['start'])
-                if kwargs['start'] < 0:
-                    raise Exception('start is negative')
+            if 'sort' in kwargs:
+                kwargs['sort'] = parse_sort(kwargs['sort'])
 
             if 'query' in kwargs:
-                kwargs['query'] = json_decode(kwargs['query'])
+                with self.timings.phase('parse'):
+                    kwargs['query'] = json_decode(kwargs['query'])
                 
                 # _id and mongo_id means the same (mongo_id will be renamed to _id in self.db.find_files())
                 # make sure that not both keys are in query
@@ -258,33 +637,36 @@ class FilesHandler(APIHandler):
                     logging.warn('`query` contains `_id` and `mongo_id`', exc_info=True)
                     self.send_error(400, message='`query` contains `_id` and `mongo_id`')
                     return
+            self.check_modified(kwargs)
         except:
             logging.warn('query parameter error', exc_info=True)
             self.send_error(400, message='invalid query parameters')
             return
-        files = yield self.db.find_files(**kwargs)
-        self.write({
-            '_links':{
-                'self': {'href': self.files_url},
-                'parent': {'href': self.base_url},
-            },
-            '_embedded':{
-                'files': files,
-            },
-            'files': [os.path.join(self.files_url,f['mongo_id']) for f in files],
-        })
+        if not (yield self.check_sort_index(kwargs)):
+            return
+        files = yield self.db.find_files(ctx=self.ctx, **kwargs)
+        next_url = None
+        if len(files) >= kwargs['limit']:
+            # a full page: the same arguments, starting after it
+            args = urlargparse.parse(self.request.query)
+            args['start'] = kwargs.get('start', 0) + len(files)
+            next_url = self.files_url + '?' + urlargparse.encode(args)
+        yield self.write_files(files, next_url)
 
     @catch_error
     @coroutine
     def post(self):
-        metadata = json_decode(self.request.body)
+        with self.timings.phase('parse'):
+            metadata = json_decode(self.request.body)
 
-        if not self.validation.validate_metadata_creation(self, metadata):
+        with self.timings.phase('validate'):
+            valid = self.validation.validate_metadata_creation(self, metadata)
+        if not valid:
             return
 
         set_last_modification_date(metadata)
 
-        ret = yield self.db.get_file({'uid':metadata['uid']})
+        ret = yield self.db.get_file({'uid':metadata['uid']}, ctx=self.ctx)
 
         if ret:
             # file uid already exists, check checksum
@@ -302,11 +684,11 @@ class FilesHandler(APIHandler):
                 # add replica
                 ret['locations'].extend(metadata['locations'])
 
-                yield self.db.update_file(ret)
+                yield self.db.update_file(ret, ctx=self.ctx)
                 self.set_status(200)
                 ret = ret['mongo_id']
         else:
-            ret = yield self.db.create_file(metadata)
+            ret = yield self.db.create_file(metadata, ctx=self.ctx)
             self.set_status(201)
         self.write({
             '_links':{
@@ -316,6 +698,64 @@ class FilesHandler(APIHandler):
             'file': os.path.join(self.files_url, ret),
         })
 
+class FilesQueryHandler(FilesHandler):
+    """
+    File list for queries too large for a URL: takes `query`, `fields`,
+    `sort`, `start`, `limit`, `modified_since` and `modified_before` as
+    a JSON object in the request body.
+    """
+    ARGUMENTS = ('query', 'fields', 'sort', 'start', 'limit',
+                 'modified_since', 'modified_before')
+
+    def prepare(self):
+        super(FilesQueryHandler, self).prepare()
+        # only reads, so it may be served like a GET
+        self.ctx.read_only = True
+
+    def get(self):
+        raise tornado.web.HTTPError(405)
+
+    @catch_error
+    @coroutine
+    def post(self):
+        try:
+            with self.timings.phase('parse'):
+                body = json_decode(self.request.body) if self.request.body else {}
+            if not isinstance(body, dict):
+                raise Exception('body is not an object')
+            unknown = set(body) - set(self.ARGUMENTS)
+            if unknown:
+                raise Exception('unknown arguments %r' % sorted(unknown))
+            kwargs = {k: body[k] for k in self.ARGUMENTS if body.get(k) is not None}
+            self.check_paging(kwargs)
+
+            if 'query' in kwargs:
+                if not isinstance(kwargs['query'], dict):
+                    raise Exception('query is not an object')
+                if '_id' in kwargs['query'] and 'mongo_id' in kwargs['query']:
+                    self.send_error(400, message='`query` contains `_id` and `mongo_id`')
+                    return
+            self.check_modified(kwargs)
+            if 'fields' in kwargs:
+                if (not isinstance(kwargs['fields'], list)
+                    or not all(isinstance(f, basestring) for f in kwargs['fields'])):
+                    raise Exception('fields is not a list of strings')
+            if 'sort' in kwargs:
+                kwargs['sort'] = check_sort(kwargs['sort'])
+        except:
+            logging.warn('query parameter error', exc_info=True)
+            self.send_error(400, message='invalid query parameters')
+            return
+        if not (yield self.check_sort_index(kwargs)):
+            return
+        files = yield self.db.find_files(ctx=self.ctx, **kwargs)
+        if len(files) >= kwargs['limit']:
+            # a full page: the same body, starting after it
+            yield self.write_files(files, os.path.join(self.files_url, 'query'),
+                                   kwargs.get('start', 0) + len(files))
+        else:
+            yield self.write_files(files)
+
 class SingleFileHandler(APIHandler):
     def initialize(self, **kwargs):
         super(SingleFileHandler, self).initialize(**kwargs)
@@ -326,7 +766,7 @@ class SingleFileHandler(APIHandler):
     @coroutine
     def get(self, mongo_id):
         try:
-            ret = yield self.db.get_file({'mongo_id':mongo_id})
+            ret = yield self.db.get_file({'mongo_id':mongo_id}, ctx=self.ctx)
     
             if ret:
                 ret['_links'] = {
@@ -344,9 +784,11 @@ class SingleFileHandler(APIHandler):
     @coroutine
     def delete(self, mongo_id):
         try:
-            yield self.db.delete_file({'mongo_id':mongo_id})
+            yield self.db.delete_file({'mongo_id':mongo_id}, ctx=self.ctx)
         except pymongo.errors.InvalidId:
             self.send_error(400, message='Not a valid mongo_id')
+        except Overloaded:
+            raise
         except:
             self.send_error(404, message='not found')
         else:
@@ -355,9 +797,12 @@ class SingleFileHandler(APIHandler):
     @catch_error
     @coroutine
     def patch(self, mongo_id):
-        metadata = json_decode(self.request.body)
+        with self.timings.phase('parse'):
+            metadata = json_decode(self.request.body)
 
-        if self.validation.has_forbidden_attributes_modification(self, metadata):
+        with self.timings.phase('validate'):
+            forbidden = self.validation.has_forbidden_attributes_modification(self, metadata)
+        if forbidden:
             return
 
         set_last_modification_date(metadata)
@@ -368,7 +813,7 @@ class SingleFileHandler(APIHandler):
         }
 
         try:
-            ret = yield self.db.get_file({'mongo_id':mongo_id})
+            ret = yield self.db.get_file({'mongo_id':mongo_id}, ctx=self.ctx)
         except pymongo.errors.InvalidId:
             self.send_error(400, message='Not a valid mongo_id')
             return
@@ -384,10 +829,12 @@ class SingleFileHandler(APIHandler):
             if same:
                 ret.update(metadata)
 
-                if not self.validation.validate_metadata_modification(self, ret):
+                with self.timings.phase('validate'):
+                    valid = self.validation.validate_metadata_modification(self, ret)
+                if not valid:
                     return
 
-                yield self.db.update_file(ret.copy())
+                yield self.db.update_file(ret.copy(), ctx=self.ctx)
                 ret['_links'] = links
                 self.write(ret)
                 self.set_etag_header()
@@ -400,11 +847,14 @@ class SingleFileHandler(APIHandler):
     @catch_error
     @coroutine
     def put(self, mongo_id):
-        metadata = json_decode(self.request.body)
+        with self.timings.phase('parse'):
+            metadata = json_decode(self.request.body)
 
         # check if user wants to set forbidden fields
         # `uid` is not allowed to be changed
-        if self.validation.has_forbidden_attributes_modification(self, metadata):
+        with self.timings.phase('validate'):
+            forbidden = self.validation.has_forbidden_attributes_modification(self, metadata)
+        if forbidden:
             return
 
         set_last_modification_date(metadata)
@@ -418,7 +868,7 @@ class SingleFileHandler(APIHandler):
         }
 
         try:
-            ret = yield self.db.get_file({'mongo_id':mongo_id})
+            ret = yield self.db.get_file({'mongo_id':mongo_id}, ctx=self.ctx)
         except pymongo.errors.InvalidId:
             self.send_error(400, message='Not a valid mongo_id')
             return
@@ -436,10 +886,12 @@ class SingleFileHandler(APIHandler):
             same = self.check_etag_header()
             self._write_buffer = []
             if same:
-                if not self.validation.validate_metadata_modification(self, metadata):
+                with self.timings.phase('validate'):
+                    valid = self.validation.validate_metadata_modification(self, metadata)
+                if not valid:
                     return
 
-                yield self.db.replace_file(metadata.copy())
+                yield self.db.replace_file(metadata.copy(), ctx=self.ctx)
                 metadata['_links'] = links
                 self.write(metadata)
                 self.set_etag_header()
@@ -450,3 +902,390 @@ class SingleFileHandler(APIHandler):
             self.send_error(404, message='not found')
 
 
+
+class ExportHandler(APIHandler):
+    """
+    Streams full file documents as NDJSON in `mongo_id` order,
+    gzip-compressed if the client accepts it.
+
+    An interrupted export is resumed by passing the last received
+    `mongo_id` as `after`.
+    """
+    def initialize(self, **kwargs):
+        super(ExportHandler, self).initialize(**kwargs)
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    @catch_error
+    @coroutine
+    def get(self):
+        try:
+            with self.timings.phase('parse'):
+                kwargs = urlargparse.parse(self.request.query)
+                query = json_decode(kwargs['query']) if 'query' in kwargs else None
+            projection = export.parse_fields(kwargs.get('fields'))
+            batch_size = int(kwargs.get('batch_size',
+                    self.config.get('export', {}).get('batch_size', 10000)))
+            if batch_size < 1:
+                raise Exception('batch_size is not positive')
+            cursor = self.db.export_cursor(query=query, projection=projection,
+                                           after=kwargs.get('after'),
+                                           batch_size=batch_size, ctx=self.ctx)
+        except:
+            logging.warn('query parameter error', exc_info=True)
+            self.send_error(400, message='invalid query parameters')
+            return
+
+        stream = None
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            stream = export.GzipStream()
+            self.set_header('Content-Encoding', 'gzip')
+        self.set_header('Content-Type', 'application/x-ndjson')
+
+        def encode(docs):
+            data = ''.join(export.to_ndjson(d) for d in docs)
+            return len(docs), (stream.compress(data) if stream else data)
+
+        try:
+            while not self.closed:
+                count, data = yield self.db.next_batch(cursor, batch_size,
+                        transform=encode, ctx=self.ctx)
+                if not count:
+                    break
+                # only the first batch has to meet the request deadline
+                self.ctx.deadline = None
+                self.write(data)
+                yield self.flush()
+            if stream and not self.closed:
+                self.write(stream.finish())
+        finally:
+            cursor.close()
+
+class StatsHandler(APIHandler):
+    """
+    Catalog totals: files and bytes, overall, per dataset and per site.
+
+    The counters are maintained on every write, so this does not scan
+    the catalog.
+    """
+    @catch_error
+    @coroutine
+    def get(self):
+        if not self.db.stats:
+            self.send_error(404, message='statistics are disabled')
+            return
+        ret = yield self.db.get_stats(ctx=self.ctx)
+        ret['_links'] = {
+            'self': {'href': os.path.join(self.base_url,'stats')},
+            'parent': {'href': self.base_url},
+        }
+        self.write(ret)
+
+def job_output(base_url, job):
+    """The API representation of `job`"""
+    ret = dict(job)
+    ret['query'] = load_query(job['query'])
+    if 'update' in job:
+        ret['update'] = load_query(job['update'])
+    ret['_links'] = {
+        'self': {'href': os.path.join(base_url,'jobs',job['id'])},
+        'parent': {'href': os.path.join(base_url,'jobs')},
+    }
+    if job['type'] == 'export':
+        ret['_links']['result'] = {'href': os.path.join(base_url,'jobs',job['id'],'result')}
+    return ret
+
+class JobSubmitHandler(FilesHandler):
+    """
+    Base class of the job submissions, taking `query`, `modified_since`,
+    `modified_before`, `dry_run`, `batch_size` and `rate` (files per
+    second) as a JSON object in the request body.
+    """
+    ARGUMENTS = ('query', 'modified_since', 'modified_before',
+                 'dry_run', 'batch_size', 'rate')
+
+    # whether an empty query (all files) is refused
+    REQUIRE_QUERY = True
+
+    def parse_body(self):
+        """The checked arguments of the request body"""
+        with self.timings.phase('parse'):
+            body = json_decode(self.request.body) if self.request.body else {}
+        if not isinstance(body, dict):
+            raise Exception('body is not an object')
+        unknown = set(body) - set(self.ARGUMENTS)
+        if unknown:
+            raise Exception('unknown arguments %r' % sorted(unknown))
+        kwargs = {k: body[k] for k in self.ARGUMENTS if body.get(k) is not None}
+        query = kwargs.setdefault('query', {})
+        if not isinstance(query, dict):
+            raise Exception('query is not an object')
+        if self.REQUIRE_QUERY and not query:
+            # never touch the whole catalog by accident
+            raise Exception('query must not be empty')
+        if '_id' in query and 'mongo_id' in query:
+            raise Exception('`query` contains `_id` and `mongo_id`')
+        self.check_modified(kwargs)
+        kwargs['batch_size'], kwargs['rate'] = self.jobs.check_limits(
+                kwargs.get('batch_size'), kwargs.get('rate'))
+        return kwargs
+
+    @coroutine
+    def submit(self, kind, kwargs, **extra):
+        """
+        Submit a job of type `kind` and answer with a 202 and its
+        location, or with the number of matching files for a dry run.
+        """
+        if kwargs.get('dry_run'):
+            matched = yield self.db.count_files(kwargs['query'], ctx=self.ctx)
+            self.write({'dry_run': True, 'matched': matched})
+            return
+        job = self.jobs.new_job(kind, kwargs['query'],
+                                batch_size=kwargs['batch_size'],
+                                rate=kwargs['rate'], **extra)
+        job = yield self.jobs.submit(job)
+        ret = job_output(self.base_url, job)
+        self.set_status(202)
+        self.set_header('Location', ret['_links']['self']['href'])
+        self.write(ret)
+
+class JobExportHandler(JobSubmitHandler):
+    """
+    Exports the files matching a query (all files by default) as NDJSON,
+    optionally only the given `fields`, to the result of a job
+    """
+    ARGUMENTS = JobSubmitHandler.ARGUMENTS + ('fields',)
+    REQUIRE_QUERY = False
+
+    @catch_error
+    @coroutine
+    def post(self):
+        try:
+            kwargs = self.parse_body()
+            fields = kwargs.get('fields')
+            if fields is not None and (not isinstance(fields, list)
+                    or not all(isinstance(f, basestring) for f in fields)):
+                raise Exception('fields is not a list of strings')
+        except:
+            logging.warn('export job parameter error', exc_info=True)
+            self.send_error(400, message='invalid export job parameters')
+            return
+        yield self.submit('export', kwargs, fields=fields, after=None,
+                          chunks=0, bytes=0)
+
+class JobDeleteHandler(JobSubmitHandler):
+    """Deletes all files matching a query, in throttled batches"""
+    @catch_error
+    @coroutine
+    def post(self):
+        try:
+            kwargs = self.parse_body()
+        except:
+            logging.warn('bulk delete parameter error', exc_info=True)
+            self.send_error(400, message='invalid bulk delete parameters')
+            return
+        yield self.submit('delete', kwargs)
+
+class JobUpdateHandler(JobSubmitHandler):
+    """
+    Applies an update (`$set`, `$unset`, and `$addToSet` or `$pull` on
+    `locations`) to all files matching a query, in throttled batches
+    """
+    ARGUMENTS = JobSubmitHandler.ARGUMENTS + ('update',)
+
+    @catch_error
+    @coroutine
+    def post(self):
+        try:
+            kwargs = self.parse_body()
+        except:
+            logging.warn('bulk update parameter error', exc_info=True)
+            self.send_error(400, message='invalid bulk update parameters')
+            return
+        update = kwargs.get('update')
+        with self.timings.phase('validate'):
+            error = self.validation.update_error(update)
+        if error:
+            self.send_error(400, message=error, file=self.files_url)
+            return
+        kwargs['query'] = update_filter(kwargs['query'], update)
+        yield self.submit('update', kwargs, update=dump_query(update),
+                          modified=0, after=None)
+
+class JobListHandler(APIHandler):
+    """The jobs, newest first"""
+    @catch_error
+    @coroutine
+    def get(self):
+        jobs = yield self.db.find_jobs(state=self.get_argument('state', None))
+        self.write({
+            '_links': {
+                'self': {'href': os.path.join(self.base_url,'jobs')},
+                'parent': {'href': self.base_url},
+            },
+            'jobs': [job_output(self.base_url, job) for job in jobs],
+        })
+
+class JobHandler(APIHandler):
+    """State and progress of one job. DELETE cancels it."""
+    @catch_error
+    @coroutine
+    def get(self, job_id):
+        job = yield self.db.get_job(job_id)
+        if not job:
+            self.send_error(404, message='job not found')
+            return
+        self.write(job_output(self.base_url, job))
+
+    @catch_error
+    @coroutine
+    def delete(self, job_id):
+        job = yield self.db.get_job(job_id)
+        if not job:
+            self.send_error(404, message='job not found')
+            return
+        if job['state'] not in ACTIVE_STATES:
+            self.send_error(409, message='job has ended')
+            return
+        yield self.jobs.cancel(job)
+        self.set_status(202)
+        self.write(job_output(self.base_url, job))
+
+class JobResultHandler(APIHandler):
+    """
+    Streams the result of an export job as NDJSON, gzip-compressed if
+    the client accepts it. While the job runs, the stream follows it
+    until it ends; the client should check that it ended as `done`.
+    """
+    # seconds between checks for new chunks of a running job
+    POLL_INTERVAL = 0.5
+
+    def initialize(self, **kwargs):
+        super(JobResultHandler, self).initialize(**kwargs)
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    @catch_error
+    @coroutine
+    def get(self, job_id):
+        job = yield self.db.get_job(job_id)
+        if not job:
+            self.send_error(404, message='job not found')
+            return
+        if job['type'] != 'export':
+            self.send_error(404, message='job has no result')
+            return
+
+        stream = None
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            stream = export.GzipStream()
+            self.set_header('Content-Encoding', 'gzip')
+        self.set_header('Content-Type', 'application/x-ndjson')
+
+        seq = 0
+        while not self.closed:
+            # chunks written before the job ended are visible after it
+            ended = job['state'] not in ACTIVE_STATES
+            chunks = yield self.db.get_job_results(job_id, seq)
+            if chunks:
+                seq += len(chunks)
+                for data in chunks:
+                    self.write(stream.compress(data) if stream else data)
+                yield self.flush()
+            elif ended:
+                break
+            else:
+                yield sleep(self.POLL_INTERVAL)
+                job = (yield self.db.get_job(job_id)) or dict(job, state='failed')
+        if stream and not self.closed:
+            self.write(stream.finish())
+
+class SlowQueriesHandler(APIHandler):
+    """The query shapes with the highest total time"""
+    @catch_error
+    def get(self):
+        slow_log = self.db.slow_log
+        if not slow_log:
+            self.send_error(404, message='slow query log is disabled')
+            return
+        try:
+            limit = int(self.get_argument('limit', 20))
+        except ValueError:
+            self.send_error(400, message='invalid query parameters')
+            return
+        self.write({
+            '_links': {
+                'self': {'href': os.path.join(self.base_url,'admin','slow_queries')},
+                'parent': {'href': self.base_url},
+            },
+            'threshold_ms': slow_log.threshold_ms,
+            'queries': slow_log.top(limit),
+        })
+
+    @catch_error
+    def delete(self):
+        if self.db.slow_log:
+            self.db.slow_log.reset()
+        self.set_status(204)
+
+class ConfigHandler(APIHandler):
+    """Reload the configuration file"""
+    @catch_error
+    def post(self):
+        try:
+            ret = self.live_config.reload()
+        except Exception as e:
+            logger.warn('cannot reload the configuration', exc_info=True)
+            self.send_error(400, message=str(e))
+            return
+        ret['_links'] = {
+            'self': {'href': os.path.join(self.base_url,'admin','config')},
+            'parent': {'href': self.base_url},
+        }
+        self.write(ret)
+
+class MetricsHandler(APIHandler):
+    @catch_error
+    def get(self):
+        ret = metrics.snapshot()
+        ret['_links'] = {
+            'self': {'href': os.path.join(self.base_url,'admin','metrics')},
+            'parent': {'href': self.base_url},
+        }
+        self.write(ret)
+
+class LiveHandler(APIHandler):
+    """Liveness probe: the process is up and its IOLoop responds"""
+    @catch_error
+    def get(self):
+        self.write({
+            'status': 'live',
+            'uptime': time.time()-self.health.started,
+        })
+
+class ReadyHandler(APIHandler):
+    """
+    Readiness probe: 200 once the server has warmed up and while the
+    database answers, 503 otherwise, so that a load balancer only sends
+    traffic to instances that can serve it at full speed.
+    """
+    @catch_error
+    @coroutine
+    def get(self):
+        status = self.health.status
+        if self.health.ready:
+            try:
+                yield self.db.ping(ctx=self.ctx)
+            except Overloaded:
+                raise
+            except Exception:
+                logger.warn('readiness check: database unreachable', exc_info=True)
+                status = 'database unreachable'
+        if status != 'ready':
+            self.send_error(503, status=status)
+            return
+        self.write({'status': status})
@@ -0,0 +1,458 @@
+"""
+Client-side sharding over independent MongoDB instances.
+
+Files are placed on a shard by consistent hashing of their `uid`. The
+`mongo_id` of a new file records the shard it was created on (in the
+first of the random bytes of the ObjectId), so requests by `mongo_id`
+go straight to that shard. Queries on anything but a single `uid` or
+`mongo_id` run on all shards in parallel, and the results are merged.
+
+Shards are numbered by their position in `hosts` of `[sharding]`, so
+new shards must be appended. Adding one moves the files of about
+1/(n+1) of the uids to it; `main()` moves them while the server keeps
+running (with `fallback = True` until it is done):
+
+    python -m file_catalog rebalance --config server.cfg
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import time
+import bisect
+import hashlib
+import logging
+import argparse
+from heapq import merge
+from itertools import islice
+
+from bson.objectid import ObjectId
+from tornado.gen import coroutine, Return
+
+from file_catalog.backend import Backend, project
+from file_catalog.memory import sort_order
+from file_catalog import stats as catalog_stats
+
+logger = logging.getLogger('sharded')
+
+# byte of the ObjectId holding the shard number
+SHARD_BYTE = 4
+
+MAX_SHARDS = 256
+
+def key_hash(key):
+    """A stable 64 bit hash of `key`"""
+    if isinstance(key, type(u'')):
+        key = key.encode('utf-8')
+    elif not isinstance(key, str):
+        key = str(key)
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto `shards` shards, each owning
+    `vnodes` points of the ring. Adding a shard only moves keys to it.
+    """
+    def __init__(self, shards, vnodes=100):
+        points = sorted((key_hash('%d:%d' % (shard, v)), shard)
+                        for shard in range(shards) for v in range(vnodes))
+        self.hashes = [p[0] for p in points]
+        self.shards = [p[1] for p in points]
+
+    def shard(self, key):
+        """The shard of `key`"""
+        i = bisect.bisect(self.hashes, key_hash(key)) % len(self.hashes)
+        return self.shards[i]
+
+def new_id(shard):
+    """A new ObjectId recording `shard`"""
+    data = bytearray(ObjectId().binary)
+    data[SHARD_BYTE] = shard
+    return ObjectId(bytes(data))
+
+def id_shard(mongo_id):
+    """The shard recorded in `mongo_id`, or `None` if it is not a valid id"""
+    try:
+        return bytearray(ObjectId(mongo_id).binary)[SHARD_BYTE]
+    except Exception:
+        return None
+
+def plain_value(query, field):
+    """The value `query` requires `field` to equal, or `None`"""
+    value = query.get(field) if isinstance(query, dict) else None
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    return value
+
+class MergedCursor(object):
+    """Merges cursors that each return documents in `_id` order"""
+    def __init__(self, cursors):
+        self.cursors = cursors
+        def keyed(shard, cursor):
+            for doc in cursor:
+                yield doc['_id'], shard, doc
+        self.docs = (entry[2] for entry in
+                     merge(*[keyed(i, c) for i, c in enumerate(cursors)]))
+
+    def __iter__(self):
+        return self.docs
+
+    def next_batch(self, size):
+        return list(islice(self.docs, size))
+
+    def close(self):
+        for cursor in self.cursors:
+            cursor.close()
+
+class Sharded(Backend):
+    """
+    Files spread over independent backends by consistent hashing of `uid`.
+
+    Args:
+        shards: the backends, numbered by their position
+        vnodes: points of each shard on the hash ring
+        fallback: look for a `uid` missing from its shard on all shards
+                  (needed while rebalancing)
+        stats: the `Stats` the shards maintain
+        slow_log: the `SlowQueryLog` the shards record in
+    """
+    def __init__(self, shards, vnodes=100, fallback=False, stats=None, slow_log=None):
+        if not 0 < len(shards) <= MAX_SHARDS:
+            raise Exception('between 1 and %d shards are supported' % MAX_SHARDS)
+        self.shards = shards
+        self.ring = HashRing(len(shards), vnodes)
+        self.fallback = fallback
+        self.stats = stats
+        self.slow_log = slow_log
+
+    def _valid_shard(self, shard):
+        return shard if shard is not None and shard < len(self.shards) else None
+
+    def _shard_of(self, query):
+        """The shard to look at first for `query`, or `None` for all of them"""
+        mongo_id = plain_value(query, 'mongo_id') or plain_value(query, '_id')
+        if mongo_id is not None:
+            return self._valid_shard(id_shard(mongo_id))
+        uid = plain_value(query, 'uid')
+        if uid is not None:
+            return self.ring.shard(uid)
+        return None
+
+    def _only_on_shard(self, query):
+        """Whether files matching `query` can only be on `_shard_of(query)`"""
+        # files moved by a rebalance keep their `mongo_id`
+        return (plain_value(query, 'mongo_id') is None
+                and plain_value(query, '_id') is None
+                and plain_value(query, 'uid') is not None
+                and not self.fallback)
+
+    def _shards_for(self, query):
+        """The shards with files that may match `query`"""
+        if self._only_on_shard(query):
+            return [self._shard_of(query)]
+        return range(len(self.shards))
+
+    @coroutine
+    def _gather(self, futures):
+        """The results of `futures`, which run concurrently"""
+        ret = []
+        for future in futures:
+            ret.append((yield future))
+        raise Return(ret)
+
+    @coroutine
+    def find_files(self, query={}, limit=None, start=0, fields=None, sort=None,
+                   ctx=None):
+        shards = self._shards_for(query)
+        if len(shards) == 1:
+            ret = yield self.shards[shards[0]].find_files(query, limit=limit, start=start,
+                    fields=fields, sort=sort, ctx=ctx)
+            raise Return(ret)
+
+        # each shard returns its first `start+limit` files in order,
+        # with the sort fields to merge them by
+        sort = list(sort or [('_id', 1)])
+        fields = list(fields or [])
+        extra = [f for f,d in sort if f not in fields and f not in ('_id', 'mongo_id', 'uid')]
+        end = None if limit is None else start+limit
+        results = yield self._gather([
+                self.shards[s].find_files(copy.deepcopy(query), limit=end, start=0,
+                                          fields=fields+extra, sort=sort, ctx=ctx)
+                for s in shards])
+        ret = [row for rows in results for row in rows]
+        order = [('mongo_id' if f == '_id' else f, d) for f,d in sort] + [('mongo_id', 1)]
+        ret.sort(key=sort_order(order))
+        ret = ret[start:end]
+        if extra:
+            ret = [project(row, ['mongo_id', 'uid']+fields) for row in ret]
+        raise Return(ret)
+
+    @coroutine
+    def count_files(self, query={}, ctx=None):
+        counts = yield self._gather([self.shards[s].count_files(copy.deepcopy(query), ctx=ctx)
+                                     for s in self._shards_for(query)])
+        raise Return(sum(counts))
+
+    def create_file(self, metadata, ctx=None):
+        shard = self.ring.shard(metadata['uid'])
+        metadata['_id'] = new_id(shard)
+        return self.shards[shard].create_file(metadata, ctx=ctx)
+
+    @coroutine
+    def get_file(self, filters, ctx=None):
+        first = self._shard_of(filters)
+        if first is not None:
+            ret = yield self.shards[first].get_file(copy.deepcopy(filters), ctx=ctx)
+            if ret is not None or self._only_on_shard(filters):
+                raise Return(ret)
+        results = yield self._gather([shard.get_file(copy.deepcopy(filters), ctx=ctx)
+                                      for i, shard in enumerate(self.shards) if i != first])
+        for ret in results:
+            if ret is not None:
+                raise Return(ret)
+        raise Return(None)
+
+    @coroutine
+    def _locate(self, mongo_id, ctx=None):
+        """The shard holding the file `mongo_id`, or `None`"""
+        counts = yield self._gather([shard.count_files({'mongo_id': mongo_id}, ctx=ctx)
+                                     for shard in self.shards])
+        for shard, count in enumerate(counts):
+            if count:
+                raise Return(shard)
+        raise Return(None)
+
+    @coroutine
+    def _on_file_shard(self, method, arg, ctx=None):
+        """
+        Call `method` with `arg` on the shard of the file `arg` refers
+        to by `mongo_id`: the one recorded in it, or wherever the file
+        was moved to if the call fails there.
+        """
+        mongo_id = arg.get('mongo_id', arg.get('_id'))
+        first = self._valid_shard(id_shard(mongo_id))
+        error = None
+        if first is not None:
+            try:
+                ret = yield getattr(self.shards[first], method)(copy.deepcopy(arg), ctx=ctx)
+            except Exception as e:
+                error = e
+            else:
+                raise Return(ret)
+        shard = yield self._locate(mongo_id, ctx=ctx)
+        if shard is None or shard == first:
+            if error is not None:
+                raise error
+            raise Exception('file %s not found' % mongo_id)
+        ret = yield getattr(self.shards[shard], method)(copy.deepcopy(arg), ctx=ctx)
+        raise Return(ret)
+
+    def update_file(self, metadata, ctx=None):
+        return self._on_file_shard('update_file', metadata, ctx=ctx)
+
+    def replace_file(self, metadata, ctx=None):
+        return self._on_file_shard('replace_file', metadata, ctx=ctx)
+
+    def delete_file(self, filters, ctx=None):
+        if plain_value(filters, 'mongo_id') is None and plain_value(filters, '_id') is None:
+            return self._delete_first(filters, ctx=ctx)
+        return self._on_file_shard('delete_file', filters, ctx=ctx)
+
+    @coroutine
+    def _delete_first(self, filters, ctx=None):
+        for shard in self._shards_for(filters):
+            n = yield self.shards[shard].delete_files(copy.deepcopy(filters), 1, ctx=ctx)
+            if n:
+                return
+        raise Exception('did not delete')
+
+    @coroutine
+    def delete_files(self, query, limit, ctx=None):
+        # one shard after the other, up to `limit` files in total
+        total = 0
+        for shard in self._shards_for(query):
+            total += yield self.shards[shard].delete_files(copy.deepcopy(query),
+                                                           limit-total, ctx=ctx)
+            if total >= limit:
+                break
+        raise Return(total)
+
+    @coroutine
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        """
+        Like `Backend.update_files`, going through one shard after the
+        other. The position `after` is `shard:mongo_id`.
+        """
+        shard, last = 0, None
+        if after:
+            shard, last = after.split(':', 1)
+            shard, last = int(shard), last or None
+        while shard < len(self.shards):
+            n, modified, last = yield self.shards[shard].update_files(
+                    copy.deepcopy(query), update, limit, after=last, ctx=ctx)
+            if n:
+                raise Return((n, modified, '%d:%s' % (shard, last)))
+            shard, last = shard+1, None
+        raise Return((0, 0, None))
+
+    # jobs are kept on the first shard
+
+    def save_job(self, job, owner=None):
+        return self.shards[0].save_job(job, owner=owner)
+
+    def claim_job(self, job_id, owner, stale_before):
+        return self.shards[0].claim_job(job_id, owner, stale_before)
+
+    def get_job(self, job_id):
+        return self.shards[0].get_job(job_id)
+
+    def find_jobs(self, state=None):
+        return self.shards[0].find_jobs(state=state)
+
+    def delete_job(self, job_id):
+        return self.shards[0].delete_job(job_id)
+
+    def save_job_result(self, job_id, seq, data):
+        return self.shards[0].save_job_result(job_id, seq, data)
+
+    def get_job_results(self, job_id, start=0, limit=10):
+        return self.shards[0].get_job_results(job_id, start=start, limit=limit)
+
+    def export_cursor(self, query=None, projection=None, after=None,
+                      batch_size=10000, ctx=None):
+        return MergedCursor([shard.export_cursor(query=copy.deepcopy(query),
+                                                 projection=projection, after=after,
+                                                 batch_size=batch_size, ctx=ctx)
+                             for shard in self.shards])
+
+    def next_batch(self, cursor, size, transform=None, ctx=None):
+        return self.shards[0].next_batch(cursor, size, transform=transform, ctx=ctx)
+
+    @coroutine
+    def get_stats(self, ctx=None):
+        summaries = yield self._gather([shard.get_stats(ctx=ctx) for shard in self.shards])
+        raise Return(catalog_stats.merge_summaries(summaries))
+
+    def reconcile_stats(self):
+        for shard in self.shards:
+            shard.reconcile_stats()
+
+    @coroutine
+    def sort_indexes(self, ctx=None):
+        # the shards sort, so an index helps only if all have it
+        indexes = yield self._gather([shard.sort_indexes(ctx=ctx) for shard in self.shards])
+        raise Return([keys for keys in indexes[0]
+                      if all(keys in other for other in indexes[1:])])
+
+    def ensure_indexes(self):
+        for shard in self.shards:
+            shard.ensure_indexes()
+
+    def reconfigure(self, **options):
+        restart = set()
+        for shard in self.shards:
+            restart.update(shard.reconfigure(**options))
+        return sorted(restart)
+
+    @coroutine
+    def ping(self, ctx=None):
+        yield self._gather([shard.ping(ctx=ctx) for shard in self.shards])
+
+    def warmup(self, prefetch=0):
+        for shard in self.shards:
+            shard.warmup(prefetch=prefetch)
+
+def move_file(doc, source, target):
+    """
+    Copy `doc` (with `_id`) from the backend `source` to `target`, then
+    delete it from `source` if it is unchanged (same `meta_modify_date`).
+    If it did change, the copy is removed again and `False` returned.
+    """
+    mongo_id = str(doc['_id'])
+    metadata = dict(doc, mongo_id=mongo_id)
+    del metadata['_id']
+    existing = target.get_file({'mongo_id': mongo_id}).result()
+    if existing is None:
+        target.create_file(dict(doc)).result()
+    elif existing != metadata:
+        target.replace_file(metadata).result()
+    try:
+        source.delete_file({'mongo_id': mongo_id,
+                            'meta_modify_date': doc.get('meta_modify_date')}).result()
+    except Exception:
+        target.delete_file({'mongo_id': mongo_id}).result()
+        return False
+    return True
+
+def rebalance(db, batch_size=1000, pause=0, dry_run=False):
+    """
+    Move the files of the `Sharded` backend `db` that are not on the
+    shard of their `uid`, keeping their `mongo_id`.
+
+    Files modified while being moved stay where they are; running the
+    rebalance again moves them. Returns the counters `checked`, `moved`,
+    `changed` (modified concurrently) and `failed`.
+    """
+    counts = {'checked': 0, 'moved': 0, 'changed': 0, 'failed': 0}
+    start = time.time()
+    for source, shard in enumerate(db.shards):
+        cursor = shard.export_cursor(batch_size=batch_size)
+        try:
+            while True:
+                docs = shard.next_batch(cursor, batch_size).result()
+                if not docs:
+                    break
+                for doc in docs:
+                    counts['checked'] += 1
+                    target = db.ring.shard(doc.get('uid'))
+                    if target == source:
+                        continue
+                    if dry_run:
+                        counts['moved'] += 1
+                        continue
+                    try:
+                        if move_file(doc, shard, db.shards[target]):
+                            counts['moved'] += 1
+                        else:
+                            counts['changed'] += 1
+                    except Exception:
+                        logger.warn('cannot move %s from shard %d to %d', doc['_id'],
+                                    source, target, exc_info=True)
+                        counts['failed'] += 1
+                elapsed = time.time() - start
+                logger.info('shard %d: %d checked, %d moved, %d changed, %d failed '
+                            '(%.0f docs/s)', source, counts['checked'], counts['moved'],
+                            counts['changed'], counts['failed'],
+                            counts['checked'] / elapsed if elapsed > 0 else 0)
+                if pause:
+                    time.sleep(pause)
+        finally:
+            cursor.close()
+    return counts
+
+def main(argv=None):
+    from file_catalog.config import Config
+    from file_catalog.backend import create_backend
+
+    parser = argparse.ArgumentParser(prog='file_catalog rebalance',
+            description='Move files to the shard of their uid')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents read at once')
+    parser.add_argument('--pause', type=float, default=0.1,
+                        help='seconds to sleep between batches, to limit the load')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only count the files to move')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+    config = Config(args.config)
+    # writes must not wait for the IOLoop of a server
+    config.setdefault('mongo', {})['coalesce_window_ms'] = 0
+    db = create_backend(config)
+    if not isinstance(db, Sharded):
+        raise Exception('no shards configured (hosts in [sharding])')
+    counts = rebalance(db, batch_size=args.batch_size, pause=args.pause,
+                       dry_run=args.dry_run)
+    logger.info('done: %d checked, %d moved, %d changed concurrently, %d failed',
+                counts['checked'], counts['moved'], counts['changed'], counts['failed'])
@@ -0,0 +1,127 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import copy
+import itertools
+
+from tornado.gen import coroutine, Return
+from tornado.concurrent import (Future, future_set_result_unless_cancelled,
+                                future_set_exc_info)
+
+from file_catalog.config import set_options
+from file_catalog.metrics import metrics
+
+def freeze(value):
+    """A hashable key equal for equal (JSON-like) arguments"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(freeze(v) for v in value)
+    # repr keeps apart values that compare equal (1, 1.0, True)
+    return repr(value)
+
+class SingleFlight(object):
+    """
+    Request coalescing for a backend: while a read is in flight,
+    identical reads wait for its result instead of querying again.
+
+    Only reads of read-only requests (`ctx.read_only`) with the same
+    arguments and causal token share a call, and each caller gets its
+    own copy of the result. A read never joins a call that started
+    before a write through this object finished, so clients still
+    read their own writes.
+
+    Every other attribute is the wrapped backend's. Counters are
+    reported as `singleflight.<method>.calls` (database calls made)
+    and `singleflight.<method>.coalesced` (reads served by another's
+    call).
+
+    Args:
+        db: the backend
+        enabled: coalesce reads at all
+    """
+    # reads that may be shared
+    READS = ('get_file', 'find_files')
+
+    def __init__(self, db, enabled=True):
+        self.db = db
+        self.enabled = enabled
+        # {key: [(future, ctx)]} of the reads in flight and their waiters
+        self.flights = {}
+        # changes once each write is done; part of the key of reads
+        self.counter = itertools.count(1)
+        self.generation = 0
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def reconfigure(self, **options):
+        """Apply new settings; returns the names of those needing a restart"""
+        return set_options(self, options, ('enabled',))
+
+    def get_file(self, filters, ctx=None):
+        return self._read('get_file', (filters,), {}, ctx)
+
+    def find_files(self, *args, **kwargs):
+        ctx = kwargs.pop('ctx', None)
+        return self._read('find_files', args, kwargs, ctx)
+
+    @coroutine
+    def _read(self, method, args, kwargs, ctx):
+        call = getattr(self.db, method)
+        if not self.enabled or ctx is None or not ctx.read_only:
+            ret = yield call(*args, ctx=ctx, **kwargs)
+            raise Return(ret)
+
+        key = (method, freeze(args), freeze(kwargs), ctx.causal_token, self.generation)
+        if key in self.flights:
+            metrics.incr('singleflight.%s.coalesced' % method)
+            future = Future()
+            self.flights[key].append((future, ctx))
+            with ctx.timings.phase('db'):
+                ret = yield future
+            raise Return(ret)
+
+        metrics.incr('singleflight.%s.calls' % method)
+        waiters = self.flights[key] = []
+        try:
+            ret = yield call(*args, ctx=ctx, **kwargs)
+        except Exception:
+            del self.flights[key]
+            exc_info = sys.exc_info()
+            for future, _ in waiters:
+                future_set_exc_info(future, exc_info)
+            raise
+        del self.flights[key]
+        # copies for the waiters before the caller can modify the result
+        for future, waiter_ctx in waiters:
+            waiter_ctx.causal_token = ctx.causal_token
+            future_set_result_unless_cancelled(future, copy.deepcopy(ret))
+        raise Return(ret)
+
+    def _invalidate(self, future=None):
+        # new reads do not join those in flight
+        self.generation = next(self.counter)
+
+    def _write(self, method, *args, **kwargs):
+        future = getattr(self.db, method)(*args, **kwargs)
+        future.add_done_callback(self._invalidate)
+        return future
+
+    def create_file(self, metadata, ctx=None):
+        return self._write('create_file', metadata, ctx=ctx)
+
+    def update_file(self, metadata, ctx=None):
+        return self._write('update_file', metadata, ctx=ctx)
+
+    def replace_file(self, metadata, ctx=None):
+        return self._write('replace_file', metadata, ctx=ctx)
+
+    def delete_file(self, filters, ctx=None):
+        return self._write('delete_file', filters, ctx=ctx)
+
+    def delete_files(self, query, limit, ctx=None):
+        return self._write('delete_files', query, limit, ctx=ctx)
+
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        return self._write('update_files', query, update, limit, after=after, ctx=ctx)
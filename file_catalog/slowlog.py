@@ -0,0 +1,121 @@
+"""
+Slow query log.
+
+Queries are reduced to their shape: field names and operators stay,
+literal values become `?`. The time, number of documents returned and
+(if the backend knows it) examined are added up per shape, so the
+expensive shapes, and the indexes they lack, stand out.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import threading
+
+from file_catalog.config import set_options
+
+logger = logging.getLogger('slowlog')
+
+def query_shape(query):
+    """
+    The shape of a mongodb `query`, with literal values replaced by
+    `?`. Lists of values (`$in`, `$all`, ...) collapse to `[?]`, while
+    the clauses of `$and`, `$or` and `$nor` keep their own shapes.
+    """
+    if isinstance(query, dict):
+        ret = {}
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor') and isinstance(value, list):
+                ret[key] = [query_shape(v) for v in value]
+            else:
+                ret[key] = query_shape(value)
+        return ret
+    if isinstance(query, (list, tuple)):
+        return ['?']
+    return '?'
+
+def shape_key(query):
+    """A canonical string for the shape of `query`"""
+    return json.dumps(query_shape(query or {}), sort_keys=True, separators=(',',':'))
+
+class ShapeStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.returned = 0
+        self.examined = 0
+        self.slow = 0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'slow': self.slow,
+            'total_ms': self.total_ms,
+            'mean_ms': self.total_ms / self.count if self.count else None,
+            'max_ms': self.max_ms,
+            'returned': self.returned,
+            'examined': self.examined,
+        }
+
+class SlowQueryLog(object):
+    """
+    Logs queries slower than `threshold_ms` and aggregates the cost of
+    every query by shape.
+
+    Args:
+        enabled: record queries at all
+        threshold_ms: queries taking at least this long are logged
+        max_shapes: shapes to keep; the cheapest are dropped beyond that
+        explain: re-run slow queries with explain to find the documents
+                 examined (costs another execution of the query)
+    """
+    def __init__(self, enabled=True, threshold_ms=100, max_shapes=1000, explain=False):
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        self.max_shapes = max_shapes
+        self.explain = explain
+        self.lock = threading.Lock()
+        self.shapes = {}
+
+    def reconfigure(self, **options):
+        """Apply new settings; returns the names of those needing a restart"""
+        return set_options(self, options, ('threshold_ms', 'max_shapes', 'explain'))
+
+    def is_slow(self, ms):
+        return ms >= self.threshold_ms
+
+    def record(self, query, ms, returned, examined=None):
+        """Record one execution of `query`"""
+        shape = shape_key(query)
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    cheapest = min(self.shapes, key=lambda s: self.shapes[s].total_ms)
+                    del self.shapes[cheapest]
+                stats = self.shapes[shape] = ShapeStats()
+            stats.count += 1
+            stats.total_ms += ms
+            stats.max_ms = max(stats.max_ms, ms)
+            stats.returned += returned
+            if examined is not None:
+                stats.examined += examined
+            if self.is_slow(ms):
+                stats.slow += 1
+        if self.is_slow(ms):
+            logger.warn('slow query %s: %.1fms, %d returned, %s examined',
+                        shape, ms, returned,
+                        'unknown' if examined is None else examined)
+
+    def top(self, n=20):
+        """The `n` shapes with the highest total time"""
+        with self.lock:
+            items = sorted(self.shapes.items(), key=lambda i: i[1].total_ms,
+                           reverse=True)[:n]
+            return [dict(s.summary(), shape=shape) for shape,s in items]
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
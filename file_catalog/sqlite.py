@@ -0,0 +1,678 @@
+"""
+SQLite storage backend, for small sites without a MongoDB deployment.
+
+Every document is stored as JSON in the `data` column. The hot fields
+`uid`, `checksum` and `meta_modify_date` are copied into indexed
+columns. Mongo-style queries are translated to SQL, using the JSON1
+functions for arbitrary metadata fields.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import json
+import time
+import sqlite3
+import logging
+import numbers
+import datetime
+import threading
+
+from bson.objectid import ObjectId
+
+from file_catalog.backend import Backend, project, apply_update, job_claimable
+from file_catalog.executor import BoundedExecutor, Rendezvous, run_on_executor
+from file_catalog import stats as catalog_stats
+
+logger = logging.getLogger('sqlite')
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS files (
+        id TEXT PRIMARY KEY,
+        uid TEXT,
+        checksum TEXT,
+        meta_modify_date TEXT,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS files_uid ON files (uid)",
+    "CREATE INDEX IF NOT EXISTS files_checksum ON files (checksum)",
+    "CREATE INDEX IF NOT EXISTS files_meta_modify_date ON files (meta_modify_date)",
+    # statistics counters, keyed by group and JSON-encoded key
+    """CREATE TABLE IF NOT EXISTS stats (
+        grp TEXT NOT NULL,
+        key TEXT NOT NULL,
+        files INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        PRIMARY KEY (grp, key)
+    )""",
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+    # jobs, as JSON, and the chunks of their results
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        created TEXT NOT NULL,
+        data TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_results (
+        job TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (job, seq)
+    )""",
+]
+
+# fields copied into their own indexed column
+HOT_FIELDS = ('uid', 'checksum', 'meta_modify_date')
+
+def json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return str(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def to_json(doc):
+    return json.dumps(doc, default=json_default, separators=(',',':'))
+
+def sql_value(value):
+    """Convert a query argument to what is stored in the database"""
+    if isinstance(value, (ObjectId, datetime.datetime)):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        return to_json(value)
+    return value
+
+_regexps = {}
+
+def regexp(pattern, value):
+    """The REGEXP function of the connections"""
+    if value is None:
+        return False
+    r = _regexps.get(pattern)
+    if r is None:
+        r = _regexps[pattern] = re.compile(pattern)
+    return r.search(value) is not None
+
+def json_path(field):
+    """JSON1 path of a dotted field name"""
+    parts = []
+    for part in field.split('.'):
+        if part.isdigit():
+            parts.append('[%s]' % part)
+        elif re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', part):
+            parts.append('.'+part)
+        else:
+            parts.append('."%s"' % part.replace('"', ''))
+    return '$'+''.join(parts)
+
+def type_filter(value):
+    """
+    SQL condition restricting a json_each value `e` to the type class
+    of `value`, since mongodb only compares values of the same type
+    """
+    if isinstance(value, bool):
+        return "e.type IN ('true','false')"
+    if isinstance(value, numbers.Number):
+        return "e.type IN ('integer','real')"
+    return "e.type = 'text'"
+
+class QueryTranslator(object):
+    """
+    Translates the supported subset of mongodb queries to a SQL WHERE
+    clause over the `files` table, collecting its parameters.
+    """
+    COMPARE = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+    def __init__(self):
+        self.params = []
+
+    def translate(self, query):
+        """Returns the WHERE clause for `query` (with `mongo_id` renamed to `_id`)"""
+        clauses = []
+        for key, cond in query.items():
+            if key in ('$and', '$or', '$nor'):
+                subs = [self.translate(q) for q in cond]
+                if key == '$and':
+                    clauses.append('(%s)' % ' AND '.join(subs or ['1']))
+                elif key == '$or':
+                    clauses.append('(%s)' % ' OR '.join(subs or ['0']))
+                else:
+                    clauses.append('NOT (%s)' % ' OR '.join(subs or ['0']))
+            elif key.startswith('$'):
+                raise Exception('unsupported query operator %r' % key)
+            elif isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+                clauses.append(self.field_ops(key, cond))
+            else:
+                clauses.append(self.field_eq(key, cond))
+        return ' AND '.join(clauses) if clauses else '1'
+
+    def column(self, field):
+        """Indexed column of a field, or `None`"""
+        if field == '_id':
+            return 'id'
+        if field in HOT_FIELDS:
+            return field
+        return None
+
+    def each(self, field, cond, *params):
+        """Condition `cond` on any value `e` of `field`, including array elements"""
+        self.params.append(json_path(field))
+        self.params.extend(params)
+        return 'EXISTS (SELECT 1 FROM json_each(files.data, ?) AS e WHERE %s)' % cond
+
+    def field_eq(self, field, value):
+        if value is None:
+            self.params.extend([json_path(field)]*2)
+            return "(json_type(files.data, ?) IS NULL OR json_type(files.data, ?) = 'null')"
+        if isinstance(value, (dict, list)):
+            self.params.extend([json_path(field), to_json(value)])
+            return 'json_extract(files.data, ?) = json(?)'
+        if isinstance(value, bool):
+            return self.each(field, 'e.type = ?', 'true' if value else 'false')
+        column = self.column(field)
+        if column:
+            self.params.append(sql_value(value))
+            return '%s = ?' % column
+        return self.each(field, '%s AND e.value = ?' % type_filter(value),
+                         sql_value(value))
+
+    def field_ops(self, field, ops):
+        clauses = []
+        column = self.column(field)
+        for op, arg in ops.items():
+            if op == '$eq':
+                clauses.append(self.field_eq(field, arg))
+            elif op == '$ne':
+                clauses.append('NOT (%s)' % self.field_eq(field, arg))
+            elif op in self.COMPARE:
+                if column:
+                    self.params.append(sql_value(arg))
+                    clauses.append('%s %s ?' % (column, self.COMPARE[op]))
+                else:
+                    clauses.append(self.each(field, '%s AND e.value %s ?'
+                                             % (type_filter(arg), self.COMPARE[op]),
+                                             sql_value(arg)))
+            elif op == '$in':
+                subs = [self.field_eq(field, a) for a in arg]
+                clauses.append('(%s)' % ' OR '.join(subs or ['0']))
+            elif op == '$nin':
+                subs = [self.field_eq(field, a) for a in arg]
+                clauses.append('NOT (%s)' % ' OR '.join(subs or ['0']))
+            elif op == '$exists':
+                self.params.append(json_path(field))
+                clauses.append('json_type(files.data, ?) IS %sNULL' % ('NOT ' if arg else ''))
+            elif op == '$regex':
+                flags = ''.join(c for c in ops.get('$options', '') if c in 'imsx')
+                pattern = ('(?%s)' % flags if flags else '') + arg
+                clauses.append(self.each(field, "e.type = 'text' AND e.value REGEXP ?",
+                                         pattern))
+            elif op == '$options':
+                continue
+            elif op == '$all':
+                subs = [self.field_eq(field, a) for a in arg]
+                clauses.append('(%s)' % ' AND '.join(subs or ['1']))
+            elif op == '$size':
+                self.params.extend([json_path(field), arg])
+                clauses.append('json_array_length(files.data, ?) = ?')
+            elif op == '$not':
+                clauses.append('NOT %s' % self.field_ops(field, arg))
+            elif op == '$elemMatch':
+                clauses.append(self.elem_match(field, arg))
+            else:
+                raise Exception('unsupported query operator %r' % op)
+        return '(%s)' % ' AND '.join(clauses or ['1'])
+
+    def elem_match(self, field, ops):
+        """`$elemMatch` with comparisons of the (scalar) array elements"""
+        if not isinstance(ops, dict) or not all(k.startswith('$') for k in ops):
+            raise Exception('unsupported $elemMatch %r' % (ops,))
+        conds = []
+        params = []
+        def eq(value):
+            params.append(sql_value(value))
+            return '(%s AND e.value = ?)' % type_filter(value)
+        for op, arg in ops.items():
+            if op == '$eq':
+                conds.append(eq(arg))
+            elif op == '$ne':
+                conds.append('NOT %s' % eq(arg))
+            elif op in ('$in', '$nin'):
+                subs = ' OR '.join([eq(a) for a in arg] or ['0'])
+                conds.append(('(%s)' if op == '$in' else 'NOT (%s)') % subs)
+            elif op in self.COMPARE:
+                params.append(sql_value(arg))
+                conds.append('(%s AND e.value %s ?)' % (type_filter(arg), self.COMPARE[op]))
+            else:
+                raise Exception('unsupported $elemMatch operator %r' % op)
+        self.params.append(json_path(field))
+        return "(json_type(files.data, ?) = 'array' AND %s)" % self.each(
+                field, ' AND '.join(conds), *params)
+
+def translate(query):
+    """Translate a mongodb `query` into a `(where, params)` tuple"""
+    t = QueryTranslator()
+    return t.translate(query), t.params
+
+def order_by(sort):
+    """ORDER BY clause for a list of `(field, direction)` pairs"""
+    terms = []
+    for field, direction in sort or []:
+        column = QueryTranslator().column(field)
+        if column is None:
+            column = "json_extract(data, '%s')" % json_path(field).replace("'", "''")
+        terms.append('%s %s' % (column, 'DESC' if direction < 0 else 'ASC'))
+    terms.append('rowid')
+    return 'ORDER BY ' + ', '.join(terms)
+
+def prepare_filters(filters):
+    """Rename `mongo_id` to `_id`, validating it like mongodb would"""
+    filters = dict(filters) if filters else {}
+    if 'mongo_id' in filters:
+        filters['_id'] = filters.pop('mongo_id')
+    if '_id' in filters and not isinstance(filters['_id'], dict):
+        filters['_id'] = ObjectId(filters['_id'])
+    return filters
+
+class SQLite(Backend):
+    """
+    SQLite storage in WAL mode, with one connection per executor thread.
+
+    Args:
+        path: database file
+        max_workers: threads (and connections)
+        max_queue: calls that may wait for a thread
+        stats: `Stats` to maintain, in the same transaction as each write
+        slow_log: `SlowQueryLog` to record `find_files` queries in
+    """
+    def __init__(self, path='file_catalog.sqlite', max_workers=4, max_queue=100,
+                 stats=None, slow_log=None):
+        self.path = path
+        self.stats = stats
+        self.slow_log = slow_log
+        self.local = threading.local()
+        self.executor = BoundedExecutor(max_workers=max_workers,
+                                        max_queue=max_queue,
+                                        name='sqlite.executor')
+        self.ensure_indexes()
+
+    def _conn(self):
+        """The connection of the current thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # autocommit; transactions are started explicitly
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('REGEXP', 2, regexp)
+            self.local.conn = conn
+        return conn
+
+    def ensure_indexes(self):
+        conn = self._conn()
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+    def _row(self, metadata_id, doc):
+        return (str(metadata_id),) + tuple(
+            sql_value(doc[f]) if f in doc and not isinstance(doc[f], (dict, list)) else None
+            for f in HOT_FIELDS) + (to_json(doc),)
+
+    @staticmethod
+    def _load(row):
+        """Turn an `(id, data)` row into a document with `_id`"""
+        doc = json.loads(row[1])
+        doc['_id'] = ObjectId(row[0])
+        return doc
+
+    def _select(self, conn, query, columns='id, data', extra=''):
+        where, params = translate(query)
+        return conn.execute('SELECT %s FROM files WHERE %s %s' % (columns, where, extra),
+                            params)
+
+    @run_on_executor
+    def find_files(self, query={}, limit=None, start=0, fields=None, sort=None,
+                   ctx=None):
+        query = prepare_filters(query)
+        extra = '%s LIMIT %d OFFSET %d' % (order_by(sort),
+                                           -1 if limit is None else int(limit),
+                                           int(start))
+        begin = time.time()
+        ret = []
+        if fields:
+            for metadata_id, data in self._select(self._conn(), query, extra=extra):
+                doc = json.loads(data)
+                row = project(doc, fields)
+                row.pop('_id', None)
+                row['mongo_id'] = metadata_id
+                if 'uid' in doc:
+                    row['uid'] = doc['uid']
+                ret.append(row)
+        else:
+            rows = self._select(self._conn(), query,
+                                "id, json_extract(data, '$.uid')", extra)
+            for metadata_id, uid in rows:
+                row = {'mongo_id': metadata_id}
+                if uid is not None:
+                    row['uid'] = uid
+                ret.append(row)
+        if self.slow_log:
+            self.slow_log.record(query, 1000.0*(time.time()-begin), len(ret))
+        return ret
+
+    @run_on_executor
+    def sort_indexes(self, ctx=None):
+        return [[('_id', 1)]] + [[(f, 1)] for f in HOT_FIELDS]
+
+    def reconfigure(self, **options):
+        if 'max_queue' in options:
+            self.executor.max_queue = options['max_queue']
+        return sorted(set(options) - set(['max_queue']))
+
+    @run_on_executor
+    def ping(self, ctx=None):
+        self._conn().execute('SELECT 1').fetchone()
+
+    def warmup(self, prefetch=0):
+        # open the connection of every executor thread at once
+        workers = self.executor.max_workers
+        rendezvous = Rendezvous(workers)
+        def connect():
+            rendezvous.wait()
+            self._conn().execute('SELECT 1').fetchone()
+        for f in [self.executor.submit(connect) for _ in range(workers)]:
+            f.result()
+        if prefetch > 0:
+            # read the recently modified files into the page cache
+            self._conn().execute('SELECT data FROM files ORDER BY meta_modify_date DESC '
+                                 'LIMIT ?', (prefetch,)).fetchall()
+
+    def _count(self, conn, old, new):
+        """Update the statistics counters for replacing `old` by `new`"""
+        if not self.stats:
+            return
+        for (group, key), (files, size) in self.stats.delta(old, new).items():
+            key = json.dumps(key)
+            conn.execute('INSERT OR IGNORE INTO stats (grp, key, files, bytes) '
+                         'VALUES (?, ?, 0, 0)', (group, key))
+            conn.execute('UPDATE stats SET files = files + ?, bytes = bytes + ? '
+                         'WHERE grp = ? AND key = ?', (files, size, group, key))
+
+    @run_on_executor
+    def create_file(self, metadata, ctx=None):
+        doc = dict(metadata)
+        metadata_id = doc.pop('_id', None) or ObjectId()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT INTO files (id, uid, checksum, meta_modify_date, data) '
+                         'VALUES (?, ?, ?, ?, ?)', self._row(metadata_id, doc))
+            self._count(conn, None, json.loads(to_json(doc)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return str(metadata_id)
+
+    @run_on_executor
+    def get_file(self, filters, ctx=None):
+        filters = prepare_filters(filters)
+        row = self._select(self._conn(), filters, extra='LIMIT 1').fetchone()
+        if not row:
+            return None
+        ret = self._load(row)
+        ret['mongo_id'] = str(ret.pop('_id'))
+        return ret
+
+    def _replace(self, conn, metadata_id, update):
+        """
+        Replace the document `metadata_id` by `update(old_doc)` in one
+        transaction, raising if it does not exist or nothing changed.
+        """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT id, data FROM files WHERE id = ?',
+                               (str(metadata_id),)).fetchone()
+            old = json.loads(row[1]) if row else None
+            new = update(dict(old)) if old is not None else None
+            if old is None or new == old:
+                logger.warn('updated 0 files with id %r', metadata_id)
+                raise Exception('did not update')
+            conn.execute('UPDATE files SET uid = ?, checksum = ?, meta_modify_date = ?, '
+                         'data = ? WHERE id = ?',
+                         self._row(metadata_id, new)[1:]+(str(metadata_id),))
+            self._count(conn, old, new)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @run_on_executor
+    def update_file(self, metadata, ctx=None):
+        metadata = prepare_filters(metadata)
+        metadata_id = metadata.pop('_id')
+        def update(doc):
+            doc.update(json.loads(to_json(metadata)))
+            return doc
+        self._replace(self._conn(), metadata_id, update)
+
+    @run_on_executor
+    def replace_file(self, metadata, ctx=None):
+        metadata = prepare_filters(metadata)
+        metadata_id = metadata.pop('_id')
+        self._replace(self._conn(), metadata_id,
+                      lambda doc: json.loads(to_json(metadata)))
+
+    @run_on_executor
+    def delete_file(self, filters, ctx=None):
+        filters = prepare_filters(filters)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._select(conn, filters, extra='LIMIT 1').fetchone()
+            if not row:
+                logger.warn('deleted 0 files with filter %r', filters)
+                raise Exception('did not delete')
+            conn.execute('DELETE FROM files WHERE id = ?', (row[0],))
+            self._count(conn, json.loads(row[1]), None)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @run_on_executor
+    def count_files(self, query={}, ctx=None):
+        query = prepare_filters(query)
+        return self._select(self._conn(), query, 'COUNT(*)').fetchone()[0]
+
+    @run_on_executor
+    def delete_files(self, query, limit, ctx=None):
+        query = prepare_filters(query)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._select(conn, query, extra='LIMIT %d' % int(limit)).fetchall()
+            conn.executemany('DELETE FROM files WHERE id = ?', [(r[0],) for r in rows])
+            for row in rows:
+                self._count(conn, json.loads(row[1]), None)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    @run_on_executor
+    def update_files(self, query, update, limit, after=None, ctx=None):
+        query = prepare_filters(query)
+        if after:
+            query = {'$and': [query, {'_id': {'$gt': ObjectId(after)}}]}
+        conn = self._conn()
+        modified = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._select(conn, query, extra='%s LIMIT %d' % (
+                    order_by([('_id', 1)]), int(limit))).fetchall()
+            for metadata_id, data in rows:
+                old = json.loads(data)
+                new = json.loads(to_json(apply_update(json.loads(data), update)))
+                if new != old:
+                    conn.execute('UPDATE files SET uid = ?, checksum = ?, meta_modify_date = ?, '
+                                 'data = ? WHERE id = ?',
+                                 self._row(metadata_id, new)[1:]+(metadata_id,))
+                    self._count(conn, old, new)
+                    modified += 1
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if not rows:
+            return 0, 0, None
+        return len(rows), modified, rows[-1][0]
+
+    @run_on_executor
+    def save_job(self, job, owner=None):
+        conn = self._conn()
+        if owner is None:
+            conn.execute('INSERT OR REPLACE INTO jobs (id, state, created, data) '
+                         'VALUES (?, ?, ?, ?)',
+                         (job['id'], job['state'], job['created'], to_json(job)))
+            return True
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+            old = json.loads(row[0]) if row else None
+            saved = bool(old) and old['state'] == 'running' and old.get('owner') == owner
+            if saved:
+                conn.execute('UPDATE jobs SET state = ?, data = ? WHERE id = ?',
+                             (job['state'], to_json(job), job['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return saved
+
+    @run_on_executor
+    def claim_job(self, job_id, owner, stale_before):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else None
+            if job and job_claimable(job, stale_before):
+                job.update(state='running', owner=owner, heartbeat=time.time())
+                conn.execute('UPDATE jobs SET state = ?, data = ? WHERE id = ?',
+                             (job['state'], to_json(job), job_id))
+            else:
+                job = None
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return job
+
+    @run_on_executor
+    def get_job(self, job_id):
+        row = self._conn().execute('SELECT data FROM jobs WHERE id = ?',
+                                   (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @run_on_executor
+    def find_jobs(self, state=None):
+        sql = 'SELECT data FROM jobs'
+        params = ()
+        if state:
+            sql += ' WHERE state = ?'
+            params = (state,)
+        return [json.loads(row[0]) for row in
+                self._conn().execute(sql + ' ORDER BY created DESC', params)]
+
+    @run_on_executor
+    def delete_job(self, job_id):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM job_results WHERE job = ?', (job_id,))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @run_on_executor
+    def save_job_result(self, job_id, seq, data):
+        self._conn().execute('INSERT OR REPLACE INTO job_results (job, seq, data) '
+                             'VALUES (?, ?, ?)', (job_id, seq, data))
+
+    @run_on_executor
+    def get_job_results(self, job_id, start=0, limit=10):
+        return [row[0] for row in self._conn().execute(
+                'SELECT data FROM job_results WHERE job = ? AND seq >= ? '
+                'ORDER BY seq LIMIT ?', (job_id, start, limit))]
+
+    @run_on_executor
+    def get_stats(self, ctx=None):
+        conn = self._conn()
+        counters = [(group, json.loads(key), files, size) for group, key, files, size
+                    in conn.execute('SELECT grp, key, files, bytes FROM stats '
+                                    'WHERE files != 0 OR bytes != 0')]
+        row = conn.execute("SELECT value FROM meta WHERE name = 'stats_reconciled'").fetchone()
+        return catalog_stats.summary(counters, row[0] if row else None)
+
+    def reconcile_stats(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            docs = (json.loads(row[0]) for row in conn.execute('SELECT data FROM files'))
+            counters = self.stats.count(docs)
+            conn.execute('DELETE FROM stats')
+            conn.executemany('INSERT INTO stats (grp, key, files, bytes) VALUES (?, ?, ?, ?)',
+                             [(group, json.dumps(key), files, size)
+                              for (group, key), (files, size) in counters.items()])
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) "
+                         "VALUES ('stats_reconciled', ?)",
+                         (str(datetime.datetime.utcnow()),))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def export_cursor(self, query=None, projection=None, after=None,
+                      batch_size=10000, ctx=None):
+        return SQLiteCursor(self, prepare_filters(query), projection, after)
+
+    @run_on_executor
+    def next_batch(self, cursor, size, transform=None, ctx=None):
+        docs = cursor.next_batch(size)
+        return transform(docs) if transform else docs
+
+class SQLiteCursor(object):
+    """Keyset-paginated iteration over the `files` table in `_id` order"""
+    def __init__(self, db, query, projection, after):
+        self.db = db
+        self.query = query
+        self.projection = projection
+        self.after = str(ObjectId(after)) if after else ''
+
+    def next_batch(self, size):
+        where, params = translate(self.query)
+        rows = self.db._conn().execute('SELECT id, data FROM files WHERE id > ? AND %s '
+                                       'ORDER BY id LIMIT ?' % where,
+                                       [self.after]+params+[size]).fetchall()
+        docs = [SQLite._load(row) for row in rows]
+        if docs:
+            self.after = str(docs[-1]['_id'])
+        if self.projection:
+            docs = [{k: d[k] for k in list(self.projection)+['_id'] if k in d}
+                    for d in docs]
+        return docs
+
+    def __iter__(self):
+        while True:
+            docs = self.next_batch(1000)
+            if not docs:
+                break
+            for doc in docs:
+                yield doc
+
+    def close(self):
+        pass
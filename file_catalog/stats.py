@@ -0,0 +1,150 @@
+"""
+Catalog statistics, maintained incrementally.
+
+Every file contributes to a few counters: the catalog total, its
+dataset, and the site of each of its locations. A counter holds a
+number of files (replicas, for sites) and their bytes. The backends
+apply the difference between the old and new version of a document on
+each write, so reading the statistics does not depend on the size of
+the catalog. A periodic reconciliation recounts everything to correct
+drift (e.g. from writes that failed half-way).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numbers
+from collections import defaultdict
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    basestring_types = (basestring,)
+except NameError:
+    basestring_types = (str,)
+
+def site_of(location):
+    """The host name of a location URL, or `unknown` for plain paths"""
+    try:
+        host = urlparse(location).hostname
+    except Exception:
+        host = None
+    return host or 'unknown'
+
+def counter_id(group, key):
+    """Unique, printable id of the counter `(group, key)`"""
+    return group if group == 'total' else '%s:%s' % (group, key)
+
+class Stats(object):
+    """
+    Which statistics to keep, and how a file counts towards them.
+
+    Args:
+        enabled: maintain statistics at all
+        size_field: field with the file size in bytes
+        dataset_field: field with the dataset a file belongs to
+        reconcile_interval: seconds between reconciliations (0 to disable)
+    """
+    def __init__(self, enabled=True, size_field='file_size',
+                 dataset_field='dataset', reconcile_interval=3600):
+        self.enabled = enabled
+        self.size_field = size_field
+        self.dataset_field = dataset_field
+        self.reconcile_interval = reconcile_interval
+
+    @property
+    def fields(self):
+        """The fields needed to compute the contributions of a file"""
+        return [self.size_field, self.dataset_field, 'locations']
+
+    def contributions(self, doc):
+        """
+        The counters `doc` adds to, as a dict of
+        `(group, key): [files, bytes]`.
+        """
+        ret = {}
+        if not doc:
+            return ret
+        size = doc.get(self.size_field, 0)
+        if isinstance(size, bool) or not isinstance(size, numbers.Number):
+            size = 0
+        ret[('total', None)] = [1, size]
+        dataset = doc.get(self.dataset_field)
+        if isinstance(dataset, (numbers.Number, basestring_types)):
+            ret[('dataset', dataset)] = [1, size]
+        locations = doc.get('locations')
+        if isinstance(locations, list):
+            for loc in locations:
+                if isinstance(loc, basestring_types):
+                    c = ret.setdefault(('site', site_of(loc)), [0, 0])
+                    c[0] += 1
+                    c[1] += size
+        return ret
+
+    def delta(self, old, new):
+        """
+        The counter changes of replacing `old` by `new` (either may be
+        `None`), without the counters that do not change.
+        """
+        ret = defaultdict(lambda: [0, 0])
+        for key, (files, size) in self.contributions(new).items():
+            ret[key][0] += files
+            ret[key][1] += size
+        for key, (files, size) in self.contributions(old).items():
+            ret[key][0] -= files
+            ret[key][1] -= size
+        return {k: v for k,v in ret.items() if v[0] or v[1]}
+
+    def count(self, docs):
+        """Add up the contributions of all `docs` (for reconciliation)"""
+        ret = defaultdict(lambda: [0, 0])
+        for doc in docs:
+            for key, (files, size) in self.contributions(doc).items():
+                ret[key][0] += files
+                ret[key][1] += size
+        return dict(ret)
+
+def apply_delta(counters, delta):
+    """Apply `delta` to the dict `counters` in place, dropping empty ones"""
+    for key, (files, size) in delta.items():
+        c = counters.setdefault(key, [0, 0])
+        c[0] += files
+        c[1] += size
+        if not c[0] and not c[1]:
+            del counters[key]
+
+def summary(counters, reconciled=None):
+    """
+    The `/api/stats` response for an iterable of
+    `(group, key, files, bytes)` counters.
+    """
+    ret = {'files': 0, 'bytes': 0, 'datasets': {}, 'sites': {},
+           'reconciled': str(reconciled) if reconciled else None}
+    for group, key, files, size in counters:
+        if group == 'total':
+            ret['files'] = files
+            ret['bytes'] = size
+        elif group == 'dataset':
+            ret['datasets'][str(key)] = {'files': files, 'bytes': size}
+        elif group == 'site':
+            ret['sites'][key] = {'replicas': files, 'bytes': size}
+    return ret
+
+def merge_summaries(summaries):
+    """One `summary()` adding up those of several shards"""
+    ret = {'files': 0, 'bytes': 0, 'datasets': {}, 'sites': {}, 'reconciled': None}
+    for summary in summaries:
+        ret['files'] += summary['files']
+        ret['bytes'] += summary['bytes']
+        for group, count in (('datasets', 'files'), ('sites', 'replicas')):
+            for key, value in summary[group].items():
+                total = ret[group].setdefault(key, {count: 0, 'bytes': 0})
+                total[count] += value[count]
+                total['bytes'] += value['bytes']
+    # the counters are as old as the least recently reconciled shard
+    reconciled = [s['reconciled'] for s in summaries]
+    if reconciled and None not in reconciled:
+        ret['reconciled'] = min(reconciled)
+    return ret
@@ -0,0 +1,120 @@
+"""
+Per-request phase timers and sampled profiling.
+
+A `Timings` object travels with the `RequestContext`. The handlers and
+the backends add the time spent in each phase (parsing, validation,
+waiting for a database thread, the database call, sorting, encoding),
+which is sent to the client as a `Server-Timing` header and written to
+the access log.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import logging
+import threading
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+from file_catalog.config import set_options
+
+logger = logging.getLogger('timing')
+
+class Timings(object):
+    """Durations of the phases of one request, in order of first use"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = []
+        self.durations = {}
+
+    def add(self, name, seconds):
+        """Add `seconds` to phase `name` (phases may repeat, e.g. several db calls)"""
+        with self.lock:
+            if name not in self.durations:
+                self.phases.append(name)
+                self.durations[name] = 0.0
+            self.durations[name] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time()-start)
+
+    def items(self):
+        """`(name, milliseconds)` pairs"""
+        with self.lock:
+            return [(name, 1000.0*self.durations[name]) for name in self.phases]
+
+    def header(self):
+        """The value of a `Server-Timing` header"""
+        return ', '.join('%s;dur=%.2f' % item for item in self.items())
+
+    def __str__(self):
+        return ' '.join('%s=%.2fms' % item for item in self.items())
+
+class ProfileSampler(object):
+    """
+    Runs cProfile on one in `sample_every` requests.
+
+    The profile covers the IOLoop thread while the sampled request is in
+    flight; only one request is profiled at a time. Stats are aggregated
+    over all samples and written to `path` (readable with `pstats`)
+    every `dump_every` samples.
+
+    Args:
+        sample_every: profile one in this many requests (0 disables)
+        path: file to dump the aggregated stats to
+        dump_every: samples between dumps
+    """
+    def __init__(self, sample_every=0, path='file_catalog.prof', dump_every=10):
+        self.sample_every = sample_every
+        self.path = path
+        self.dump_every = dump_every
+        self.requests = 0
+        self.samples = 0
+        self.active = None
+        self.stats = None
+
+    def reconfigure(self, **options):
+        """Apply new settings; returns the names of those needing a restart"""
+        return set_options(self, options, ('sample_every', 'path', 'dump_every'))
+
+    def start(self):
+        """Maybe start profiling a request. Returns the profiler, or `None`."""
+        if self.sample_every <= 0 or self.active is not None:
+            return None
+        self.requests += 1
+        if self.requests % self.sample_every:
+            return None
+        self.active = cProfile.Profile()
+        self.active.enable()
+        return self.active
+
+    def stop(self, profile):
+        """Stop profiling the request `profile` (from `start()`)"""
+        if profile is None or profile is not self.active:
+            return
+        profile.disable()
+        self.active = None
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        self.samples += 1
+        if self.samples % self.dump_every == 0:
+            self.dump()
+
+    def dump(self):
+        if self.stats is None:
+            return
+        try:
+            tmp = self.path+'.tmp'
+            self.stats.dump_stats(tmp)
+            os.rename(tmp, self.path)
+        except Exception:
+            logger.warn('cannot write profile to %s', self.path, exc_info=True)
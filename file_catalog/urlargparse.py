@@ -1,34 +1,48 @@
 from tornado.escape import url_escape, url_unescape
 
+# first characters (after whitespace) of strings int() or float() may accept
+NUMBER_START = frozenset('+-.0123456789iInN')
+
 def get_type(val):
+    """Convert `val` to an int or float if it is one, else return it as is"""
+    s = val.lstrip()
+    if not s or not (s[0] in NUMBER_START or s[0].isdigit()):
+        return val
     try:
         return int(val)
-    except:
-        try:
-            return float(val)
-        except:
-            return val
+    except ValueError:
+        pass
+    try:
+        return float(val)
+    except ValueError:
+        return val
 
-def parse_one(key, value, ret, sym='['):
-    print('key',key,'value',value)
-    if key == '[]':
-        ret.append(value)
-    else:
+def parse_one(key, value, ret):
+    """
+    Store `value` in `ret` under the bracketed `key` (e.g. `a[b][]`),
+    creating the nested dicts and lists on the way.
+    """
+    sym = '['
+    while True:
+        if key == '[]':
+            ret.append(value)
+            return
         if key[0] == '[':
             key = key[1:]
         start = key.find(sym)
         if start < 0:
             ret[get_type(key)] = value
-        else:
-            val = get_type(key[:start])
-            if isinstance(ret,dict) and val not in ret:
-                ret[val] = [] if key[start+1:start+3] == '[]' else {}
-            elif isinstance(ret,list) and len(ret) <= val:
-                ret.append([] if key[start+1:start+3] == '[]' else {})
-            if not key[start+1:]:
-                ret[val] = value
-            else:
-                parse_one(key[start+1:],value,ret[val],sym=']')
+            return
+        val = get_type(key[:start])
+        rest = key[start+1:]
+        if isinstance(ret,dict) and val not in ret:
+            ret[val] = [] if rest[:2] == '[]' else {}
+        elif isinstance(ret,list) and len(ret) <= val:
+            ret.append([] if rest[:2] == '[]' else {})
+        if not rest:
+            ret[val] = value
+            return
+        key, ret, sym = rest, ret[val], ']'
 
 def parse(data):
     """Parse url-encoded data from jQuery.param()"""
@@ -36,11 +50,9 @@ def parse(data):
     for part in data.split('&'):
         if part:
             key, value = url_unescape(part).split('=',1)
-            value = get_type(value)
-            parse_one(key, value, ret)
+            parse_one(key, get_type(value), ret)
     return ret
 
-
 def encode(args):
     """Encode data using the jQuery.param() syntax"""
     ret = []
@@ -1,6 +1,14 @@
-
 import re
 
+# operators allowed in bulk updates
+UPDATE_OPERATORS = ('$set', '$unset', '$addToSet', '$pull')
+
+def update_values(value, operator):
+    """The values of an `$addToSet` (`$each`) or `$pull` (`$in`) argument"""
+    if isinstance(value, dict) and list(value) == [operator]:
+        return value[operator]
+    return [value]
+
 class Validation:
     def __init__(self, config):
         self.config = config
@@ -8,6 +16,117 @@ class Validation:
     def is_valid_sha512(self, hash_str):
         """Checks if `hash_str` is a valid SHA512 hash"""
         return re.match(r"[0-9a-f]{128}", str(hash_str), re.IGNORECASE) is not None
+
+    def forbidden_attributes_creation_error(self, metadata):
+        """
+        Checks if dict (`metadata`) has forbidden attributes.
+
+        Returns an error message if it has forbidden attributes, otherwise `None`.
+        """
+
+        if set(self.config.get_list('metadata', 'forbidden_fields_creation')) & set(metadata):
+            return 'forbidden attributes'
+
+    def forbidden_attributes_modification_error(self, metadata):
+        """
+        Same as `forbidden_attributes_creation_error()` but it has additional forbidden attributes.
+        """
+
+        if set(self.config.get_list('metadata', 'forbidden_fields_update')) & set(metadata):
+            return 'forbidden attributes'
+        else:
+            return self.forbidden_attributes_creation_error(metadata)
+
+    def metadata_error(self, metadata):
+        """
+        Checks mandatory fields, checksum and locations of `metadata`.
+
+        Returns an error message if validation failed, otherwise `None`.
+        """
+
+        if not set(self.config.get_list('metadata', 'mandatory_fields')).issubset(metadata):
+            # check metadata for mandatory fields
+            return 'mandatory metadata missing (mandatory fields: %s)' % self.config['metadata']['mandatory_fields']
+        if not self.is_valid_sha512(metadata['checksum']):
+            # force to use SHA512
+            return '`checksum` needs to be a SHA512 hash'
+        elif not isinstance(metadata['locations'], list):
+            # locations needs to be a list
+            return 'member `locations` must be a list'
+        elif not metadata['locations']:
+            # location needs have at least one entry
+            return 'member `locations` must be a list with at least one url'
+        elif not all(l for l in metadata['locations']):
+            # locations aren't allowed to be empty
+            return 'member `locations` must be a list with at least one non-empty url'
+
+    def locations_error(self, locations):
+        """
+        Checks that `locations` is a list of non-empty urls.
+
+        Returns an error message if validation failed, otherwise `None`.
+        """
+
+        if not isinstance(locations, list) or not all(l for l in locations):
+            return 'locations must be a list of non-empty urls'
+
+    def update_error(self, update):
+        """
+        Checks a bulk update document: `$set` and `$unset` of fields,
+        and `$addToSet` and `$pull` on `locations`. Forbidden fields
+        cannot be changed, and mandatory fields cannot be removed.
+
+        Returns an error message if validation failed, otherwise `None`.
+        """
+
+        if not isinstance(update, dict) or not update:
+            return 'update must be a non-empty object'
+        unknown = set(update) - set(UPDATE_OPERATORS)
+        if unknown:
+            return 'unsupported update operators: %s' % ', '.join(sorted(unknown))
+        forbidden = set(self.config.get_list('metadata', 'forbidden_fields_update')
+                        + self.config.get_list('metadata', 'forbidden_fields_creation'))
+        mandatory = set(self.config.get_list('metadata', 'mandatory_fields'))
+        updated = set()
+        for operator, fields in update.items():
+            if not isinstance(fields, dict) or not fields:
+                return '`%s` must be a non-empty object' % operator
+            for field in fields:
+                root = field.split('.')[0]
+                if not root or field.startswith('$'):
+                    return 'invalid field name `%s`' % field
+                if root in forbidden:
+                    return 'forbidden attributes'
+                if root in updated:
+                    return 'field `%s` is updated more than once' % root
+                updated.add(root)
+                if operator in ('$addToSet', '$pull'):
+                    if field != 'locations':
+                        return '`%s` is only supported on `locations`' % operator
+                elif root in mandatory and (operator == '$unset' or field != root):
+                    return 'mandatory field `%s` can only be set as a whole' % root
+
+        new = update.get('$set', {})
+        if 'checksum' in new and not self.is_valid_sha512(new['checksum']):
+            return '`checksum` needs to be a SHA512 hash'
+        if 'locations' in new:
+            if not isinstance(new['locations'], list) or not new['locations']:
+                return 'member `locations` must be a list with at least one url'
+            return self.locations_error(new['locations'])
+        if '$addToSet' in update:
+            return self.locations_error(update_values(update['$addToSet']['locations'], '$each'))
+        if '$pull' in update:
+            return self.locations_error(update_values(update['$pull']['locations'], '$in'))
+
+    def metadata_creation_error(self, metadata):
+        """
+        Validates metadata for creation without an API handler.
+
+        Returns an error message if validation failed, otherwise `None`.
+        """
+
+        return (self.forbidden_attributes_creation_error(metadata)
+                or self.metadata_error(metadata))
     
     def has_forbidden_attributes_creation(self, apihandler, metadata):
         """
@@ -16,9 +135,10 @@ class Validation:
         Returns `True` if it has forbidden attributes.
         """
     
-        if set(self.config.get_list('metadata', 'forbidden_fields_creation')) & set(metadata):
+        error = self.forbidden_attributes_creation_error(metadata)
+        if error:
             # forbidden fields
-            apihandler.send_error(400, message='forbidden attributes',
+            apihandler.send_error(400, message=error,
                             file=apihandler.files_url)
             return True
     
@@ -27,13 +147,12 @@ class Validation:
         Same as `has_forbidden_attributes_creation()` but it has additional forbidden attributes.
         """
     
-        if set(self.config.get_list('metadata', 'forbidden_fields_update')) & set(metadata):
+        error = self.forbidden_attributes_modification_error(metadata)
+        if error:
             # forbidden fields
-            apihandler.send_error(400, message='forbidden attributes',
+            apihandler.send_error(400, message=error,
                             file=apihandler.files_url)
             return True
-        else:
-            return self.has_forbidden_attributes_creation(apihandler, metadata)
     
     def validate_metadata_creation(self, apihandler, metadata):
         """
@@ -56,29 +175,9 @@ class Validation:
         If validation was successful, `True` is returned.
         """
     
-        if not set(self.config.get_list('metadata', 'mandatory_fields')).issubset(metadata):
-            # check metadata for mandatory fields
-            apihandler.send_error(400, message='mandatory metadata missing (mandatory fields: %s)' % self.config['metadata']['mandatory_fields'],
-                            file=apihandler.files_url)
-            return False
-        if not self.is_valid_sha512(metadata['checksum']):
-            # force to use SHA512
-            apihandler.send_error(400, message='`checksum` needs to be a SHA512 hash',
-                            file=apihandler.files_url)
-            return False
-        elif not isinstance(metadata['locations'], list):
-            # locations needs to be a list
-            apihandler.send_error(400, message='member `locations` must be a list',
-                            file=apihandler.files_url)
-            return False
-        elif not metadata['locations']:
-            # location needs have at least one entry
-            apihandler.send_error(400, message='member `locations` must be a list with at least one url',
-                            file=apihandler.files_url)
-            return False
-        elif not all(l for l in metadata['locations']):
-            # locations aren't allowed to be empty
-            apihandler.send_error(400, message='member `locations` must be a list with at least one non-empty url',
+        error = self.metadata_error(metadata)
+        if error:
+            apihandler.send_error(400, message=error,
                             file=apihandler.files_url)
             return False
     
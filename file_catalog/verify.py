@@ -0,0 +1,293 @@
+"""
+Checksum verification of local replicas.
+
+Walks the catalog entries with a location at one site, hashes the
+local files on a pool of worker processes, and records the outcome of
+each location in the `verified` list of the file:
+
+    {'site': ..., 'location': ..., 'date': ..., 'ok': True or False,
+     'error': ... (if not ok)}
+
+Run it on a host of the site, e.g. for files given as plain paths or
+`file://` URLs (site `unknown`):
+
+    python -m file_catalog verify --config server.cfg --site unknown --max-mb-per-sec 200
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import re
+import sys
+import mmap
+import time
+import hashlib
+import logging
+import argparse
+import datetime
+import multiprocessing
+from collections import deque
+
+try:
+    from urlparse import urlparse
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import urlparse, unquote
+
+from file_catalog.stats import site_of
+
+logger = logging.getLogger('verify')
+
+# read size of buffered hashing, and size from which files are mmapped
+BLOCK_SIZE = 4*1024*1024
+
+def site_filter(site, prefixes=None):
+    """
+    A query for files with a location at `site` (may match more),
+    stored plain or with one of the `LocationPrefixes` of the site.
+    """
+    if site == 'unknown':
+        pattern = '^(/|file:/)'
+    else:
+        pattern = '^[a-zA-Z][a-zA-Z0-9+.-]*://%s([:/]|$)' % re.escape(site)
+    query = {'locations': {'$regex': pattern}}
+    if prefixes:
+        tags = sorted(tag for prefix, tag in prefixes.by_prefix.items()
+                      if site_of(prefix) == site)
+        if tags:
+            query = {'$or': [query] + [{'locations': {'$regex': '^' + re.escape(tag)}}
+                                       for tag in tags]}
+    return query
+
+def local_path(location, mount=''):
+    """The local path of `location`, below the directory `mount`"""
+    path = unquote(urlparse(location).path) if '://' in location else location
+    return os.path.join(mount, path.lstrip('/')) if mount else path
+
+def verification_tasks(doc, site, mount='', verified_after=None):
+    """
+    The `(mongo_id, location, path, checksum)` to verify for `doc`: its
+    locations at `site`, unless verified since `verified_after`.
+    """
+    recent = set(v.get('location') for v in doc.get('verified', [])
+                 if verified_after and v.get('date') and v['date'] >= verified_after)
+    return [(doc['_id'], location, local_path(location, mount), doc['checksum'])
+            for location in doc.get('locations', [])
+            if site_of(location) == site and location not in recent]
+
+def hash_file(path, use_mmap=True, block_size=BLOCK_SIZE):
+    """The SHA512 hex digest and size of the file `path`"""
+    sha512 = hashlib.sha512()
+    with io.open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size >= block_size:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # hash in slices, so the pages read can be dropped again
+                for offset in range(0, size, 16*block_size):
+                    sha512.update(m[offset:offset+16*block_size])
+            finally:
+                m.close()
+        else:
+            buf = bytearray(block_size)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                sha512.update(view[:n])
+    return sha512.hexdigest(), size
+
+# options of the worker processes
+_worker = {}
+
+def _init_worker(use_mmap, block_size):
+    _worker['use_mmap'] = use_mmap
+    _worker['block_size'] = block_size
+
+def _verify(task):
+    """Hash one file, returning `(task, ok, error, bytes read)`"""
+    mongo_id, location, path, checksum = task
+    try:
+        digest, size = hash_file(path, _worker.get('use_mmap', True),
+                                 _worker.get('block_size', BLOCK_SIZE))
+    except (IOError, OSError) as e:
+        return task, False, str(e), 0
+    if digest != checksum:
+        return task, False, 'checksum mismatch', size
+    return task, True, None, size
+
+def record_requests(results, site, date=None):
+    """
+    The bulk write requests recording `results` of `_verify`. An entry
+    replaces the previous one for its location, and is only written if
+    the checksum of the file did not change in the meantime.
+    """
+    from pymongo import UpdateOne
+
+    date = date or datetime.datetime.utcnow()
+    requests = []
+    for (mongo_id, location, path, checksum), ok, error, size in results:
+        entry = {'site': site, 'location': location, 'date': date, 'ok': ok}
+        if error:
+            entry['error'] = error
+        match = {'_id': mongo_id, 'checksum': checksum}
+        requests.append(UpdateOne(match, {'$pull': {'verified': {'location': location}}}))
+        requests.append(UpdateOne(match, {'$push': {'verified': entry}}))
+    return requests
+
+class Throttle(object):
+    """Sleeps as needed to stay below `bytes_per_sec` and `files_per_sec` (0 for no limit)"""
+    def __init__(self, bytes_per_sec=0, files_per_sec=0):
+        self.bytes_per_sec = bytes_per_sec
+        self.files_per_sec = files_per_sec
+        self.start = time.time()
+        self.bytes = 0
+        self.files = 0
+
+    def delay(self):
+        """Seconds to wait before the next file"""
+        elapsed = time.time() - self.start
+        ret = 0
+        if self.bytes_per_sec > 0:
+            ret = max(ret, self.bytes / self.bytes_per_sec - elapsed)
+        if self.files_per_sec > 0:
+            ret = max(ret, self.files / self.files_per_sec - elapsed)
+        return ret
+
+    def add(self, size):
+        self.bytes += size
+        self.files += 1
+
+def verify_site(collections, site, workers=None, batch_size=1000, mount='',
+                verified_after=None, bytes_per_sec=0, files_per_sec=0,
+                use_mmap=True, block_size=BLOCK_SIZE, dry_run=False,
+                progress_interval=10, prefixes=None):
+    """
+    Verify the replicas at `site` of the files in the pymongo
+    `collections` (one per shard), whose compact locations are decoded
+    with the matching entry of `prefixes` (if given).
+
+    Files are read in `_id` order, `batch_size` at a time. Their
+    locations are hashed by `workers` processes with a bounded number
+    in flight, paced by the `Throttle` limits, and the results of each
+    batch are written with one ordered `bulk_write`.
+
+    Returns the counters `ok`, `mismatch`, `unreadable` and `bytes`.
+    """
+    counts = {'ok': 0, 'mismatch': 0, 'unreadable': 0, 'bytes': 0}
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(use_mmap, block_size))
+    throttle = Throttle(bytes_per_sec, files_per_sec)
+    last_report = time.time()
+    try:
+        for files, codec in zip(collections, prefixes or [None]*len(collections)):
+            after = None
+            while True:
+                query = site_filter(site, codec)
+                if after is not None:
+                    query = {'$and': [query, {'_id': {'$gt': after}}]}
+                batch = list(files.find(query, projection=['checksum', 'locations', 'verified'],
+                                        sort=[('_id', 1)], limit=batch_size))
+                if not batch:
+                    break
+                after = batch[-1]['_id']
+                if codec:
+                    for doc in batch:
+                        codec.decode_doc(doc)
+
+                tasks = deque(t for doc in batch for t in
+                              verification_tasks(doc, site, mount, verified_after))
+                pending = deque()
+                results = []
+                while tasks or pending:
+                    while tasks and len(pending) < 2*workers:
+                        time.sleep(max(0, throttle.delay()))
+                        pending.append(pool.apply_async(_verify, (tasks.popleft(),)))
+                    result = pending.popleft().get()
+                    throttle.add(result[3])
+                    results.append(result)
+                    task, ok, error, size = result
+                    counts['bytes'] += size
+                    if ok:
+                        counts['ok'] += 1
+                    elif size:
+                        counts['mismatch'] += 1
+                        logger.warn('%s: checksum mismatch (%s)', task[1], task[0])
+                    else:
+                        counts['unreadable'] += 1
+                        logger.warn('%s: %s (%s)', task[1], error, task[0])
+
+                if results and not dry_run:
+                    files.bulk_write(record_requests(results, site))
+
+                now = time.time()
+                if now - last_report > progress_interval:
+                    elapsed = now - throttle.start
+                    logger.info('%d ok, %d mismatch, %d unreadable (%.0f files/s, %.1f MB/s)',
+                                counts['ok'], counts['mismatch'], counts['unreadable'],
+                                throttle.files / elapsed, throttle.bytes / elapsed / 1e6)
+                    last_report = now
+    finally:
+        pool.terminate()
+        pool.join()
+    return counts
+
+def main(argv=None):
+    from file_catalog.config import Config
+    from file_catalog.backend import create_backend
+
+    parser = argparse.ArgumentParser(prog='file_catalog verify',
+            description='Verify the checksums of the replicas at a site')
+    parser.add_argument('--config', required=True, help='Path to config file')
+    parser.add_argument('--db_host', help='MongoDB host')
+    parser.add_argument('--site', required=True,
+                        help='site to verify (host name of the locations, or unknown '
+                             'for plain paths and file:// URLs)')
+    parser.add_argument('--mount', default='',
+                        help='directory the location paths are relative to')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='hashing processes (default: number of cpus)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='files read and updated at once')
+    parser.add_argument('--max-mb-per-sec', type=float, default=0,
+                        help='limit of the data read (0 for no limit)')
+    parser.add_argument('--max-files-per-sec', type=float, default=0,
+                        help='limit of the files read (0 for no limit)')
+    parser.add_argument('--skip-verified-days', type=float, default=0,
+                        help='skip locations verified in the last days')
+    parser.add_argument('--no-mmap', action='store_true', default=False,
+                        help='read with buffered reads only')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only hash, do not record the results')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level='INFO')
+    config = Config(args.config)
+    db = create_backend(config, args.db_host or config['server']['db_host'])
+    shards = getattr(db, 'shards', [db])
+    if not all(hasattr(shard, 'client') for shard in shards):
+        raise Exception('verification needs the mongo backend')
+
+    for shard in shards:
+        if shard.prefixes:
+            shard.prefixes.load()
+
+    verified_after = None
+    if args.skip_verified_days > 0:
+        verified_after = (datetime.datetime.utcnow()
+                          - datetime.timedelta(days=args.skip_verified_days))
+    counts = verify_site([shard.client.files for shard in shards], args.site,
+                         workers=args.workers, batch_size=args.batch_size,
+                         mount=args.mount, verified_after=verified_after,
+                         bytes_per_sec=args.max_mb_per_sec*1e6,
+                         files_per_sec=args.max_files_per_sec,
+                         use_mmap=not args.no_mmap, dry_run=args.dry_run,
+                         prefixes=[shard.prefixes for shard in shards])
+    logger.info('done: %d ok, %d mismatch, %d unreadable, %.1f GB read',
+                counts['ok'], counts['mismatch'], counts['unreadable'], counts['bytes']/1e9)
+    if counts['mismatch'] or counts['unreadable']:
+        sys.exit(1)
+    return counts
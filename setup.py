@@ -10,7 +10,7 @@ with open(path.join(here, 'README.md')) as f:
     long_description = f.read()
 
 
-install_requires = ['tornado>=4.2', 'pymongo>=3.3']
+install_requires = ['tornado>=5.0', 'pymongo>=3.7']
 if sys.version_info < (3, 2):
     install_requires.extend(['futures'])
 
@@ -34,6 +34,10 @@ setup(
     keywords='file catalog',
     packages=['file_catalog'],
     install_requires=install_requires,
+    extras_require={
+        'compression': ['brotli', 'zstandard'],
+        'client': ['pycurl'],
+    },
     package_data={
         'file_catalog':['data/www/*','data/www_templates/*'],
     },
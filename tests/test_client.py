@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import threading
+import unittest
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from file_catalog.config import Config
+from file_catalog.server import Server
+from file_catalog.memory import Memory
+from file_catalog.stats import Stats
+from file_catalog.client import Client, AsyncClient, FileCatalogError
+
+def make_file(i):
+    return {'uid': 'file_%d' % i, 'checksum': hashlib.sha512(str(i).encode('ascii')).hexdigest(),
+            'locations': ['/data/file_%d.dat' % i], 'dataset': i % 3}
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        # the blocking client needs the server on another thread
+        sock, port = bind_unused_port()
+        self.url = 'http://127.0.0.1:%d' % port
+        started = threading.Event()
+        loops = []
+
+        def serve():
+            loop = IOLoop()
+            loop.make_current()
+            config = Config('server.cfg')
+            # smaller than the lookup batches, which then take several pages
+            config['filelist']['max_files'] = 8
+            server = Server(config, port=None, db=Memory(stats=Stats()))
+            http_server = HTTPServer(server.app)
+            http_server.add_sockets([sock])
+            loops.append(loop)
+            loop.add_callback(started.set)
+            loop.start()
+            http_server.stop()
+            loop.close(all_fds=True)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        started.wait()
+        loop = loops[0]
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.add_callback, loop.stop)
+
+    def test_01_retry(self):
+        client = Client(self.url, retries=2, backoff=1, max_backoff=3)
+        self.assertEqual(client.retry_delay(0, '2'), 2)
+        self.assertEqual(client.retry_delay(0, '60'), 3)
+        self.assertTrue(0.5 <= client.retry_delay(0) <= 1)
+        self.assertTrue(1.5 <= client.retry_delay(5) <= 3)
+
+        responses = [(503, {'Retry-After': '0'}, b''), (429, {'Retry-After': '0'}, b''),
+                     (200, {'X-Causal-Token': 't'}, b'{"files": []}')]
+        client.send = lambda *args: responses.pop(0)
+        self.assertEqual(client.request('GET', 'files'), {'files': []})
+        self.assertEqual(client.causal_token, 't')
+        responses = [(503, {'Retry-After': '0'}, b'{"message": "busy"}')] * 3
+        with self.assertRaises(FileCatalogError) as e:
+            client.request('GET', 'files')
+        self.assertEqual((e.exception.status, e.exception.data['message']), (503, 'busy'))
+
+    def test_10_sync(self):
+        client = Client(self.url, pool_size=4, backoff=0.01)
+        self.addCleanup(client.close)
+
+        ids = client.register([make_file(i) for i in range(30)], concurrency=12)
+        self.assertTrue(all(not isinstance(i, Exception) for i in ids))
+        self.assertTrue(client.pool.idle)
+        # a new location adds a replica, a different checksum conflicts
+        ret = client.register([dict(make_file(0), locations=['/other/file_0.dat']),
+                               dict(make_file(0), checksum=make_file(1)['checksum'])])
+        self.assertEqual(ret[0], ids[0])
+        self.assertEqual(ret[1].status, 409)
+
+        self.assertEqual(client.get_file(ids[3])['uid'], 'file_3')
+        self.assertIsNone(client.get_file('0123456789ab0123456789ab'))
+        with self.assertRaises(FileCatalogError):
+            client.request('GET', 'files', args={'limit': -1})
+
+        files = list(client.find_files({'dataset': 1}, sort='uid', limit=3))
+        self.assertEqual([f['uid'] for f in files],
+                         sorted('file_%d' % i for i in range(30) if i % 3 == 1))
+        found = client.lookup(['file_%d' % i for i in range(25)] + ['nope'],
+                              fields=['dataset'], batch_size=10, concurrency=2)
+        self.assertEqual(len(found), 25)
+        self.assertEqual(found['file_4']['dataset'], 1)
+
+        client.update_file(ids[5], {'dataset': 7})
+        self.assertEqual(client.get_file(ids[5])['dataset'], 7)
+        with self.assertRaises(FileCatalogError) as e:
+            client.update_file(ids[5], {'dataset': 8}, etag='"outdated"')
+        self.assertEqual(e.exception.status, 409)
+        client.delete_file(ids[5])
+        self.assertIsNone(client.get_file(ids[5]))
+
+    def test_20_async(self):
+        client = AsyncClient(self.url, pool_size=12, backoff=0.01)
+        self.addCleanup(client.close)
+
+        def run(func, *args, **kwargs):
+            return IOLoop.current().run_sync(lambda: func(*args, **kwargs))
+
+        ids = run(client.register, [make_file(i) for i in range(30)])
+        self.assertTrue(all(not isinstance(i, Exception) for i in ids))
+        self.assertEqual(run(client.get_file, ids[3])['uid'], 'file_3')
+        self.assertEqual(run(client.update_file, ids[3], {'dataset': 7})['dataset'], 7)
+        self.assertIsNone(run(client.get_file, '0123456789ab0123456789ab'))
+
+        files = run(client.find_files, {'dataset': 2}, sort=[('uid', -1)], limit=4)
+        self.assertEqual([f['uid'] for f in files],
+                         sorted(('file_%d' % i for i in range(30) if i % 3 == 2), reverse=True))
+        found = run(client.lookup, ['file_%d' % i for i in range(30)], batch_size=12)
+        self.assertEqual(sorted(found), sorted('file_%d' % i for i in range(30)))
+        run(client.delete_file, ids[3])
+        self.assertIsNone(run(client.get_file, ids[3]))
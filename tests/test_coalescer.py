@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from bson.objectid import ObjectId
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase, gen_test
+
+from file_catalog.mongo import WriteCoalescer
+from file_catalog.executor import DeadlineExceeded
+from file_catalog.context import RequestContext
+
+class FakeCollection(object):
+    """The `bulk_write` and `find` of a collection, on a dict"""
+    def __init__(self):
+        self.docs = {}
+        self.batches = []
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        self.batches.append(len(requests))
+        errors = []
+        inserted = matched = 0
+        for i, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                if request._doc['_id'] in self.docs:
+                    errors.append({'index': i, 'code': 11000, 'errmsg': 'duplicate key'})
+                else:
+                    self.docs[request._doc['_id']] = dict(request._doc)
+                    inserted += 1
+            elif request._filter['_id'] in self.docs:
+                self.docs[request._filter['_id']].update(request._doc['$set'])
+                matched += 1
+        details = {'nInserted': inserted, 'nMatched': matched, 'nModified': matched,
+                   'nUpserted': 0, 'nRemoved': 0, 'upserted': [], 'writeErrors': errors}
+        if errors:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+    def find(self, query, projection=None):
+        return [self.docs[i] for i in query['_id']['$in'] if i in self.docs]
+
+class InlineExecutor(object):
+    def submit(self, fn, *args):
+        fn(*args)
+
+class TestWriteCoalescer(AsyncTestCase):
+    def setUp(self):
+        super(TestWriteCoalescer, self).setUp()
+        self.collection = FakeCollection()
+        self.coalescer = WriteCoalescer(self.collection, InlineExecutor(), window=0.01)
+
+    @gen_test
+    def test_10_batch(self):
+        futures = [self.coalescer.insert({'uid': str(i)}) for i in range(5)]
+        self.assertEqual(self.collection.batches, [])
+        yield sleep(0.05)
+        self.assertEqual(self.collection.batches, [5])
+        ids = [f.result() for f in futures]
+        self.assertEqual(sorted(ids), sorted(str(i) for i in self.collection.docs))
+
+        # a full batch is sent without waiting for the window
+        self.coalescer.max_batch = 2
+        self.coalescer.insert({'uid': 'a'})
+        self.coalescer.insert({'uid': 'b'})
+        self.assertEqual(self.collection.batches, [5, 2])
+
+    @gen_test
+    def test_20_results(self):
+        existing = ObjectId()
+        self.collection.docs[existing] = {'_id': existing, 'uid': 'a'}
+        insert = self.coalescer.insert({'uid': 'b'})
+        duplicate = self.coalescer.insert({'_id': existing, 'uid': 'c'})
+        update = self.coalescer.update(existing, {'run': 2})
+        missing = self.coalescer.update(ObjectId(), {'run': 3})
+        self.coalescer.flush()
+        self.assertEqual(self.collection.batches, [4])
+
+        self.assertIn(ObjectId(insert.result()), self.collection.docs)
+        with self.assertRaises(Exception) as cm:
+            duplicate.result()
+        self.assertIn('duplicate', str(cm.exception))
+        self.assertIsNone(update.result())
+        self.assertEqual(self.collection.docs[existing]['run'], 2)
+        with self.assertRaises(Exception) as cm:
+            missing.result()
+        self.assertIn('did not update', str(cm.exception))
+
+    @gen_test
+    def test_30_deadline(self):
+        expired = RequestContext(deadline=time.time()-1)
+        late = self.coalescer.insert({'uid': 'a'}, ctx=expired)
+        ctx = RequestContext(deadline=time.time()+10)
+        ok = self.coalescer.insert({'uid': 'b'}, ctx=ctx)
+        self.coalescer.flush()
+        with self.assertRaises(DeadlineExceeded):
+            late.result()
+        self.assertTrue(ok.result())
+        self.assertEqual(self.collection.batches, [1])
+        self.assertEqual([d['uid'] for d in self.collection.docs.values()], ['b'])
+        self.assertIn('db', ctx.timings.phases)
+
+        # nothing is written when all of the batch expired
+        self.coalescer.insert({'uid': 'c'}, ctx=expired)
+        self.coalescer.flush()
+        self.assertEqual(self.collection.batches, [1])
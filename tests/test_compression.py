@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+
+import zlib
+import unittest
+
+from tornado.escape import json_decode
+from tornado.testing import AsyncHTTPTestCase
+
+from file_catalog import compression
+from file_catalog.compression import Compression, parse_accept_encoding
+from file_catalog.config import Config
+from file_catalog.server import Server
+from file_catalog.memory import Memory
+
+def gunzip(data):
+    return zlib.decompress(data, 31)
+
+class TestCompression(unittest.TestCase):
+    def installed(self, *modules):
+        """Pretend only `modules` of brotli and zstandard are installed"""
+        for name in ('brotli', 'zstandard'):
+            self.addCleanup(setattr, compression, name, getattr(compression, name))
+            setattr(compression, name, object() if name in modules else None)
+
+    def test_10_parse(self):
+        self.assertEqual(parse_accept_encoding('gzip, br;q=0.5, *;q=0 ,, identity;q=x'),
+                         {'gzip': 1.0, 'br': 0.5, '*': 0.0, 'identity': 0.0})
+
+    def test_20_negotiate(self):
+        self.installed('brotli', 'zstandard')
+        c = Compression()
+        self.assertEqual(c.encodings, ['zstd', 'br', 'gzip'])
+        self.assertEqual(c.negotiate('gzip, br'), 'br')
+        self.assertEqual(c.negotiate('gzip;q=1, br;q=0.1'), 'br')
+        self.assertEqual(c.negotiate('zstd;q=0, br;q=0, gzip'), 'gzip')
+        self.assertEqual(c.negotiate('*'), 'zstd')
+        self.assertEqual(c.negotiate('*, zstd;q=0'), 'br')
+        self.assertIsNone(c.negotiate('identity'))
+        self.assertIsNone(c.negotiate('gzip;q=0, identity'))
+        self.assertIsNone(c.negotiate('deflate'))
+        self.assertIsNone(c.negotiate(''))
+        c.enabled = False
+        self.assertIsNone(c.negotiate('gzip'))
+
+    def test_30_fallback(self):
+        self.installed()
+        c = Compression()
+        self.assertEqual(c.encodings, ['gzip'])
+        self.assertEqual(c.negotiate('zstd, br, gzip'), 'gzip')
+        self.assertIsNone(c.negotiate('zstd, br'))
+        c.reconfigure(encodings='br, zstd')
+        self.assertEqual(c.encodings, [])
+        self.assertIsNone(c.negotiate('gzip'))
+
+        data = b'{"files": []}' * 100
+        self.assertEqual(gunzip(c.compress(data, 'gzip')), data)
+
+class ServerCase(AsyncHTTPTestCase):
+    """An in-process server with compression `options`"""
+    options = {}
+
+    def get_app(self):
+        config = Config('server.cfg')
+        config['compression'].update(self.options)
+        db = Memory()
+        for i in range(50):
+            db.create_file({'uid': 'file_%d' % i, 'locations': ['/data/file_%d' % i]})
+        server = Server(config, port=None, db=db)
+        return server.app
+
+    def get(self, url, accept_encoding=None):
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+        return self.fetch(url, headers=headers, decompress_response=False)
+
+class TestServerCompression(ServerCase):
+    def test_10_transform(self):
+        ret = self.get('/api/files', 'gzip')
+        self.assertEqual(ret.code, 200)
+        self.assertEqual(ret.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', ret.headers['Vary'])
+        self.assertEqual(int(ret.headers['Content-Length']), len(ret.body))
+        self.assertEqual(len(json_decode(gunzip(ret.body))['files']), 50)
+
+        # small bodies and clients not accepting gzip get identity
+        for url, accept_encoding in (('/api', 'gzip'), ('/api/files', None),
+                                     ('/api/files', 'identity')):
+            ret = self.get(url, accept_encoding)
+            self.assertEqual(ret.code, 200)
+            self.assertNotIn('Content-Encoding', ret.headers)
+            self.assertIn('Accept-Encoding', ret.headers['Vary'])
+            json_decode(ret.body)
+
+class TestServerCompressionOffload(ServerCase):
+    # only `write_large` compresses responses this small
+    options = {'min_length': 10**9, 'offload_length': 100}
+
+    def test_10_offload(self):
+        ret = self.get('/api/files', 'gzip')
+        self.assertEqual(ret.code, 200)
+        self.assertEqual(ret.headers['Content-Encoding'], 'gzip')
+        self.assertIn('compress;dur=', ret.headers['Server-Timing'])
+        self.assertEqual(len(json_decode(gunzip(ret.body))['files']), 50)
+
+        ret = self.get('/api/files')
+        self.assertNotIn('Content-Encoding', ret.headers)
+        self.assertNotIn('compress;dur=', ret.headers['Server-Timing'])
+        self.assertEqual(len(json_decode(ret.body)['files']), 50)
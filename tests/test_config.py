@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from file_catalog.config import Config, LiveConfig
+from file_catalog.slowlog import SlowQueryLog
+
+CONFIG = """
+[server]
+port = 8888
+request_timeout = 10
+
+[filelist]
+max_files = %d
+
+[slow_queries]
+enabled = True
+threshold_ms = %s
+"""
+
+class TestLiveConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'server.cfg')
+
+    def write(self, max_files=100, threshold_ms=100, extra=''):
+        with open(self.path, 'w') as f:
+            f.write(CONFIG % (max_files, threshold_ms) + extra)
+
+    def test_10_reload(self):
+        self.write()
+        config = Config(self.path)
+        slow_log = SlowQueryLog(**config['slow_queries'])
+        live = LiveConfig(config, per_request={'filelist': None},
+                          components={'slow_queries': slow_log})
+
+        self.write(max_files=10, threshold_ms=5, extra='port = 9999\n')
+        ret = live.reload()
+        self.assertEqual(ret['applied'], ['filelist.max_files', 'slow_queries.threshold_ms'])
+        self.assertEqual(ret['need_restart'], ['slow_queries.port'])
+        self.assertEqual(slow_log.threshold_ms, 5)
+        self.assertEqual(live.current['filelist']['max_files'], 10)
+        self.assertNotIn('port', live.current['slow_queries'])
+        # readers of the old configuration are not affected
+        self.assertEqual(config['filelist']['max_files'], 100)
+
+        # values of another kind refuse the whole reload
+        current = live.current
+        self.write(max_files=20, threshold_ms="'fast'")
+        with self.assertRaises(Exception):
+            live.reload()
+        self.assertIs(live.current, current)
+        self.assertEqual(slow_log.threshold_ms, 5)
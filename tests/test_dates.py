@@ -0,0 +1,28 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import datetime
+
+from file_catalog.dates import parse_date, add_modified_filter
+
+class TestDates(unittest.TestCase):
+    def test_10_parse(self):
+        d = datetime.datetime(2017, 3, 4, 5, 6, 7, 890000)
+        self.assertEqual(parse_date(str(d)), d)
+        self.assertEqual(parse_date('2017-03-04T05:06:07.89Z'), d)
+        self.assertEqual(parse_date('2017-03-04T05:06:07'), d.replace(microsecond=0))
+        self.assertEqual(parse_date('2017-03-04'), datetime.datetime(2017, 3, 4))
+        self.assertEqual(parse_date(d), d)
+        for bad in ('yesterday', '2017-13-01', 20170304, None):
+            self.assertRaises(ValueError, parse_date, bad)
+
+    def test_20_filter(self):
+        since = datetime.datetime(2017, 1, 1)
+        self.assertEqual(add_modified_filter({'uid': 'a'}, since='2017-01-01'),
+                         {'uid': 'a', 'meta_modify_date': {'$gte': since}})
+        self.assertEqual(add_modified_filter(None, before='2017-01-01'),
+                         {'meta_modify_date': {'$lt': since}})
+        q = {'meta_modify_date': {'$exists': True}}
+        self.assertEqual(add_modified_filter(q, since='2017-01-01'),
+                         {'$and': [q, {'meta_modify_date': {'$gte': since}}]})
+        self.assertEqual(add_modified_filter(q), q)
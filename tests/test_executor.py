@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import unittest
+
+from file_catalog.executor import (BoundedExecutor, WorkloadExecutors, QueueFull,
+                                   run_on_executor)
+
+class Calls(object):
+    def __init__(self, pools):
+        self.executor = BoundedExecutor(max_workers=1, max_queue=1, name='test')
+        self.executors = WorkloadExecutors(self.executor, pools, name='test')
+        self.release = threading.Event()
+
+    @run_on_executor(workload='list')
+    def slow(self):
+        self.release.wait(10)
+        return threading.current_thread().name
+
+    @run_on_executor(workload='point')
+    def fast(self):
+        return threading.current_thread().name
+
+    @run_on_executor(workload='bulk')
+    def other(self):
+        return threading.current_thread().name
+
+class TestExecutor(unittest.TestCase):
+    def test_10_workloads(self):
+        calls = Calls({'point': (1, 5), 'list': (1, 1)})
+        self.addCleanup(calls.release.set)
+        self.assertEqual(len(calls.executors.all()), 3)
+
+        # a full list pool neither delays nor refuses point reads
+        slow = [calls.slow(), calls.slow()]
+        with self.assertRaises(QueueFull):
+            calls.slow()
+        self.assertEqual(calls.executors.get('list').pending, 2)
+        self.assertTrue(calls.fast().result(timeout=5))
+        self.assertEqual(calls.executors.get('write'), calls.executor)
+        self.assertTrue(calls.other().result(timeout=5))
+
+        calls.release.set()
+        self.assertEqual(len(set(f.result(timeout=5) for f in slow)), 1)
+
+    def test_20_set_queues(self):
+        calls = Calls({'point': (1, 5)})
+        self.assertTrue(calls.executors.set_queues({'point': (1, 8)}))
+        self.assertEqual(calls.executors.get('point').max_queue, 8)
+        self.assertFalse(calls.executors.set_queues({'point': (2, 8)}))
+        self.assertFalse(calls.executors.set_queues({'point': (1, 8), 'bulk': (1, 1)}))
+        self.assertEqual(calls.executors.get('point').max_workers, 1)
+
+        with self.assertRaises(Exception):
+            WorkloadExecutors(calls.executor, {'reads': (1, 1)})
+        calls = Calls({'point': (1, 1), 'list': (1, 1), 'write': (1, 1), 'bulk': (1, 1)})
+        self.assertNotIn(calls.executor, calls.executors.all())
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+from pymongo.results import InsertManyResult
+
+from file_catalog.config import Config
+from file_catalog.memory import Memory
+from file_catalog.stats import Stats
+from file_catalog.validation import Validation
+from file_catalog.export import export_to_file, to_ndjson
+from file_catalog import importer
+
+def make_file(i):
+    return {'uid': 'file_%d' % i, 'checksum': hashlib.sha512(str(i).encode('ascii')).hexdigest(),
+            'locations': ['/data/file_%d.dat' % i], 'file_size': 10*i, 'dataset': i % 2}
+
+class FakeFiles(object):
+    """The `insert_many` of a collection with a unique `uid` index"""
+    def __init__(self):
+        self.docs = {}
+
+    def insert_many(self, docs, ordered=True):
+        errors = []
+        for i, doc in enumerate(docs):
+            if doc['uid'] in self.docs:
+                errors.append({'index': i, 'code': importer.DUPLICATE_KEY,
+                               'errmsg': 'duplicate key'})
+            else:
+                self.docs[doc['uid']] = doc
+        if errors:
+            raise BulkWriteError({'nInserted': len(docs)-len(errors), 'writeErrors': errors})
+        return InsertManyResult([doc['uid'] for doc in docs], True)
+
+class FakeMongo(object):
+    """What the import workers use of the `Mongo` backend"""
+    prefixes = None
+
+    def __init__(self):
+        self.client = type('Client', (), {})()
+        self.client.files = FakeFiles()
+        self.stats = Stats()
+        self.counters = {}
+
+    def _count(self, delta):
+        for key, (files, size) in delta.items():
+            c = self.counters.setdefault(key, [0, 0])
+            c[0] += files
+            c[1] += size
+
+class TestImporter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = Config('server.cfg')
+        self.addCleanup(importer._worker.clear)
+
+    def read(self, path):
+        """The lines of `path`, in the chunks the importer reads"""
+        with importer.open_input(path) as f:
+            return [line for chunk, n in importer.read_chunks(f, 3) for line in chunk]
+
+    def test_10_input(self):
+        # a plain NDJSON file, with an invalid record
+        path = os.path.join(self.tmpdir, 'files.ndjson')
+        with open(path, 'w') as f:
+            for i in range(5):
+                f.write(to_ndjson(dict(make_file(i), _id=ObjectId())))
+            f.write('{"uid": "broken"}\n')
+        self.assertEqual(len(self.read(path)), 6)
+        totals = importer.import_file(path, self.config, db_host='localhost',
+                                      workers=1, chunk_size=2, dry_run=True)
+        self.assertEqual((totals['records'], totals['invalid']), (6, 1))
+
+        # a gzip-compressed dump as written by `export`
+        db = Memory()
+        for i in range(7):
+            db.create_file(make_file(i)).result()
+        gz_path = os.path.join(self.tmpdir, 'files.ndjson.gz')
+        self.assertEqual(export_to_file(db, gz_path, batch_size=3), 7)
+        lines = self.read(gz_path)
+        self.assertEqual(sorted(json.loads(l)['uid'] for l in lines),
+                         sorted('file_%d' % i for i in range(7)))
+        totals = importer.import_file(gz_path, self.config, db_host='localhost',
+                                      workers=1, chunk_size=2, dry_run=True)
+        self.assertEqual((totals['records'], totals['invalid']), (7, 0))
+
+    def test_20_insert(self):
+        db = FakeMongo()
+        importer._worker.update(validation=Validation(self.config), db=db)
+        lines = [json.dumps(make_file(i)) for i in range(4)] + ['not json']
+        stats = importer._import_chunk(lines)
+        self.assertEqual((stats['inserted'], stats['invalid']), (4, 1))
+        self.assertEqual(sorted(db.client.files.docs), ['file_%d' % i for i in range(4)])
+        self.assertIn('meta_modify_date', db.client.files.docs['file_0'])
+
+        # files imported again are skipped, and counted only once
+        stats = importer._import_chunk([json.dumps(make_file(i)) for i in range(3, 6)])
+        self.assertEqual((stats['inserted'], stats['skipped']), (2, 1))
+        self.assertEqual(db.counters[('total', None)], [6, sum(10*i for i in range(6))])
+        self.assertEqual(db.counters[('dataset', 1)], [3, 10+30+50])
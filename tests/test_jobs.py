@@ -0,0 +1,113 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+import datetime
+
+from bson.objectid import ObjectId
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase, gen_test
+
+from file_catalog.memory import Memory
+from file_catalog.executor import QueueFull
+from file_catalog.jobs import JobManager, dump_query, load_query
+
+class BusyMemory(Memory):
+    """Refuses the first `refusals` batch deletes, as a full executor queue would"""
+    def __init__(self, refusals):
+        super(BusyMemory, self).__init__()
+        self.refusals = refusals
+
+    def delete_files(self, query, limit, ctx=None):
+        if self.refusals > 0:
+            self.refusals -= 1
+            raise QueueFull('too many requests queued')
+        return super(BusyMemory, self).delete_files(query, limit, ctx=ctx)
+
+class TestJobs(AsyncTestCase):
+    def test_10_query(self):
+        query = {'meta_modify_date': {'$gte': datetime.datetime(2017, 1, 2, 3, 4, 5)},
+                 '_id': ObjectId('0123456789abcdef01234567'), 'uid': {'$in': ['a']}}
+        self.assertEqual(load_query(dump_query(query)), query)
+
+    @gen_test
+    def test_20_queue(self):
+        db = Memory()
+        for i in range(6):
+            yield db.create_file({'uid': str(i), 'run': i % 2, 'locations': ['f%d' % i]})
+        jobs = JobManager(db, workers=1, batch_size=1, rate=0)
+        first = yield jobs.submit(jobs.new_job('delete', {'run': 0}))
+        second = yield jobs.submit(jobs.new_job('delete', {'run': 1}))
+        self.assertEqual((first['state'], second['state']), ('running', 'queued'))
+        for _ in range(100):
+            if not jobs.running:
+                break
+            yield sleep(0.01)
+        done = yield db.find_jobs(state='done')
+        self.assertEqual(sorted(j['processed'] for j in done), [3, 3])
+        self.assertEqual((yield db.count_files({})), 0)
+
+        # finished jobs are removed after `retention`
+        jobs.retention = 3600
+        yield jobs.collect()
+        self.assertEqual(len((yield db.find_jobs())), 2)
+        jobs.retention = 0
+        yield jobs.collect()
+        self.assertEqual((yield db.find_jobs()), [])
+
+    @gen_test
+    def test_30_claim(self):
+        db = Memory()
+        for i in range(20):
+            yield db.create_file({'uid': str(i), 'locations': ['f%d' % i]})
+        # two servers sharing the database
+        first = JobManager(db, workers=1, batch_size=1, rate=50)
+        second = JobManager(db, workers=1, batch_size=1, rate=50)
+        job = yield first.submit(first.new_job('delete', {'uid': {'$exists': True}}))
+        yield sleep(0.05)
+        stored = yield db.get_job(job['id'])
+        self.assertEqual((stored['state'], stored['owner']), ('running', first.owner))
+
+        # the other server does not run it too
+        yield second.resume()
+        yield sleep(0.01)
+        self.assertFalse(second.running)
+
+        # a cancel through the other server stops it
+        yield second.cancel(stored)
+        for _ in range(100):
+            if not first.running:
+                break
+            yield sleep(0.01)
+        self.assertFalse(first.running)
+        stored = yield db.get_job(job['id'])
+        self.assertEqual(stored['state'], 'cancelled')
+        self.assertTrue((yield db.count_files({})) > 0)
+
+        # a job left running by a server that stopped is taken over
+        job = first.new_job('delete', {'uid': {'$exists': True}}, rate=0,
+                            state='running', owner='gone', heartbeat=time.time()-3600)
+        yield db.save_job(job)
+        yield second.resume()
+        for _ in range(100):
+            if not second.running:
+                break
+            yield sleep(0.01)
+        stored = yield db.get_job(job['id'])
+        self.assertEqual((stored['state'], stored['owner']), ('done', second.owner))
+        self.assertEqual((yield db.count_files({})), 0)
+
+    @gen_test
+    def test_40_overloaded(self):
+        # a busy database delays a job, but does not fail it
+        db = BusyMemory(refusals=3)
+        for i in range(4):
+            yield db.create_file({'uid': str(i), 'locations': ['f%d' % i]})
+        jobs = JobManager(db, workers=1, batch_size=2, rate=0)
+        job = yield jobs.submit(jobs.new_job('delete', {'uid': {'$exists': True}}))
+        for _ in range(200):
+            if not jobs.running:
+                break
+            yield sleep(0.01)
+        stored = yield db.get_job(job['id'])
+        self.assertEqual((stored['state'], stored['processed']), ('done', 4))
+        self.assertEqual(db.refusals, 0)
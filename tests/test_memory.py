@@ -0,0 +1,63 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from file_catalog.memory import Memory, match
+from file_catalog.backend import sort_is_indexed
+
+class TestMemory(unittest.TestCase):
+    def test_10_match(self):
+        doc = {'uid': 'a', 'size': 10, 'locations': ['x', 'y'],
+               'run': {'number': 5}}
+        self.assertTrue(match(doc, {'uid': 'a'}))
+        self.assertTrue(match(doc, {'locations': 'y'}))
+        self.assertTrue(match(doc, {'run.number': {'$gte': 5, '$lt': 6}}))
+        self.assertTrue(match(doc, {'size': {'$in': [1, 10]}}))
+        self.assertTrue(match(doc, {'missing': None}))
+        self.assertTrue(match(doc, {'$or': [{'uid': 'b'}, {'size': 10}]}))
+        self.assertTrue(match(doc, {'uid': {'$regex': '^A', '$options': 'i'}}))
+        self.assertFalse(match(doc, {'size': {'$gt': '1'}}))
+        self.assertFalse(match(doc, {'locations': {'$size': 3}}))
+        self.assertFalse(match(doc, {'run': {'$exists': False}}))
+        with self.assertRaises(Exception):
+            match(doc, {'uid': {'$where': 'true'}})
+
+    def test_20_indexes(self):
+        db = Memory()
+        ids = [db.create_file({'uid': str(i), 'checksum': 'c%d' % (i%2),
+                               'locations': ['f%d' % i]}).result()
+               for i in range(10)]
+        ret = db.find_files({'checksum': 'c1'}).result()
+        self.assertEqual([r['uid'] for r in ret], ['1', '3', '5', '7', '9'])
+        ret = db.find_files({'checksum': 'c1'}, limit=2, start=1).result()
+        self.assertEqual([r['uid'] for r in ret], ['3', '5'])
+
+        db.update_file({'mongo_id': ids[1], 'checksum': 'c0'}).result()
+        self.assertEqual(len(db.find_files({'checksum': 'c1'}).result()), 4)
+        self.assertEqual(db.get_file({'uid': '1'}).result()['checksum'], 'c0')
+
+        db.delete_file({'mongo_id': ids[0]}).result()
+        self.assertIsNone(db.get_file({'mongo_id': ids[0]}).result())
+        self.assertEqual(db.find_files({'uid': {'$in': ['0', '2']}}).result(),
+                         [{'mongo_id': ids[2], 'uid': '2'}])
+        with self.assertRaises(Exception):
+            db.delete_file({'mongo_id': ids[0]}).result()
+
+    def test_30_sort(self):
+        db = Memory()
+        for i in range(6):
+            db.create_file({'uid': str(i), 'size': i%3}).result()
+        db.create_file({'uid': 'none'}).result()
+        ret = db.find_files(sort=[('size', -1), ('uid', 1)], limit=3).result()
+        self.assertEqual([r['uid'] for r in ret], ['2', '5', '1'])
+        ret = db.find_files(sort=[('size', 1)], limit=2).result()
+        self.assertEqual([r['uid'] for r in ret], ['none', '0'])
+
+    def test_40_sort_is_indexed(self):
+        indexes = [[('uid', 1)], [('dataset', 1), ('run', -1)]]
+        self.assertTrue(sort_is_indexed([('uid', -1)], indexes))
+        self.assertTrue(sort_is_indexed([('dataset', -1), ('run', 1)], indexes))
+        self.assertFalse(sort_is_indexed([('dataset', 1), ('run', 1)], indexes))
+        self.assertFalse(sort_is_indexed([('run', -1)], indexes))
+        self.assertTrue(sort_is_indexed([('run', -1)], indexes, {'dataset': 5}))
+        self.assertFalse(sort_is_indexed([('size', 1)], indexes))
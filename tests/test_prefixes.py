@@ -0,0 +1,85 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from file_catalog.memory import match
+from file_catalog.prefixes import (LocationPrefixes, split_location, literal_prefix,
+                                   MARKER)
+
+LOCATIONS = [
+    'gsiftp://gridftp.icecube.wisc.edu/data/exp/IceCube/2016/a.i3.bz2',
+    'gsiftp://gridftp.icecube.wisc.edu/data/exp/IceCube/2017/b.i3.bz2',
+    'gsiftp://gridftp.icecube.wisc.edu/data/sim/IceCube/c.i3.bz2',
+    'file:///data/exp/IceCube/2016/d.i3.bz2',
+    '/data/exp/IceCube/2016/e.i3.bz2',
+    'http://x/f',
+]
+
+def cached_prefixes():
+    """A dictionary holding the prefixes of `LOCATIONS`, without a database"""
+    prefixes = LocationPrefixes(None)
+    for location in LOCATIONS:
+        prefixes.encode(location)
+    return prefixes
+
+class TestPrefixes(unittest.TestCase):
+    def test_10_split(self):
+        self.assertEqual(split_location(LOCATIONS[0], 3),
+                         ('gsiftp://gridftp.icecube.wisc.edu/data/exp/IceCube/', '2016/a.i3.bz2'))
+        self.assertEqual(split_location(LOCATIONS[2], 5),
+                         ('gsiftp://gridftp.icecube.wisc.edu/data/sim/IceCube/', 'c.i3.bz2'))
+        self.assertEqual(split_location(LOCATIONS[3], 1), ('file:///data/', 'exp/IceCube/2016/d.i3.bz2'))
+        self.assertEqual(split_location(LOCATIONS[4], 2), ('/data/exp/', 'IceCube/2016/e.i3.bz2'))
+        self.assertEqual(split_location('blah.dat', 3), ('', 'blah.dat'))
+
+        self.assertEqual(literal_prefix(r'^gsiftp://host\.org/data/'),
+                         ('gsiftp://host.org/data/', ''))
+        self.assertEqual(literal_prefix(r'^/data/run_\d+\.i3'), ('/data/run_', r'\d+\.i3'))
+        self.assertEqual(literal_prefix(r'^/data/x*'), ('/data/', 'x*'))
+        self.assertIsNone(literal_prefix(r'/data/'))
+
+    def test_20_encode(self):
+        prefixes = cached_prefixes()
+        docs = [{'uid': str(i), 'locations': [l]} for i, l in enumerate(LOCATIONS)]
+        stored = [prefixes.encode_doc(doc) for doc in docs]
+        self.assertTrue(stored[0]['locations'][0].startswith(MARKER))
+        self.assertEqual(stored[5], docs[5])
+        self.assertTrue(sum(len(d['locations'][0]) for d in stored)
+                        < sum(len(l) for l in LOCATIONS) / 2)
+        self.assertEqual([prefixes.decoded(d) for d in stored], docs)
+        self.assertEqual(docs[0]['locations'][0], LOCATIONS[0])
+
+        # stored documents match the translated query as the plain ones
+        # match the query (a migration leaves some plain)
+        mixed = stored[:3] + docs[3:]
+        queries = [
+            {'locations': LOCATIONS[1]},
+            {'locations': {'$in': LOCATIONS[2:5]}, 'uid': {'$ne': '3'}},
+            {'locations': {'$nin': LOCATIONS[:2]}},
+            {'locations': {'$regex': r'^gsiftp://gridftp\.icecube\.wisc\.edu/data/exp/IceCube/2017/'}},
+            {'locations': {'$regex': '^gsiftp://'}},
+            {'locations': {'$regex': '^/data/exp/IceCube/2016/e'}},
+            {'$or': [{'locations': LOCATIONS[0]}, {'locations': {'$elemMatch': {'$eq': LOCATIONS[4]}}}]},
+        ]
+        for query in queries:
+            expected = [d['uid'] for d in docs if match(d, query)]
+            self.assertTrue(expected)
+            translated = prefixes.encode_query(query)
+            for candidates in (stored, mixed):
+                self.assertEqual([d['uid'] for d in candidates if match(d, translated)],
+                                 expected, query)
+
+        # other regexes are matched on the decoded locations
+        translated = prefixes.encode_query({'locations': {'$regex': 'IceCube/2016'}})
+        self.assertIn('$expr', translated['$or'][1])
+
+    def test_30_update(self):
+        prefixes = cached_prefixes()
+        update = prefixes.encode_update({'$addToSet': {'locations': {'$each': LOCATIONS[:2]}},
+                                         '$set': {'size': 1}})
+        self.assertEqual([prefixes.decode(l) for l in update['$addToSet']['locations']['$each']],
+                         LOCATIONS[:2])
+        self.assertEqual(update['$set'], {'size': 1})
+        update = prefixes.encode_update({'$pull': {'locations': LOCATIONS[0]}})
+        self.assertEqual(update['$pull']['locations']['$in'],
+                         [LOCATIONS[0], prefixes.encode(LOCATIONS[0], create=False)])
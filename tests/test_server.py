@@ -9,10 +9,20 @@ import subprocess
 from functools import partial
 import unittest
 import hashlib
+import threading
 
 from tornado.escape import json_encode,json_decode
+from tornado.testing import AsyncHTTPTestCase, gen_test
 
 from file_catalog.urlargparse import encode as jquery_encode
+from file_catalog.config import Config
+from file_catalog.server import Server
+from file_catalog.memory import Memory
+from file_catalog.sharded import Sharded
+from file_catalog.stats import Stats
+from file_catalog.slowlog import SlowQueryLog
+from file_catalog.dates import parse_date
+from file_catalog.executor import QueueFull
 
 class TestServerAPI(unittest.TestCase):
     def setUp(self):
@@ -91,6 +101,25 @@ class TestServerAPI(unittest.TestCase):
             ret = self.curl('', m)
             self.assertEquals(ret['status'], 405)
 
+    def test_02_health(self):
+        ret = self.curl('/health/live', 'GET', prefix='')
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals(ret['data']['status'], 'live')
+
+        for _ in range(50):
+            ret = self.curl('/health/ready', 'GET', prefix='')
+            if ret['status'] == 200:
+                break
+            self.assertEquals(ret['status'], 503)
+            time.sleep(0.1)
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals(ret['data']['status'], 'ready')
+
+    def test_03_reload_config(self):
+        ret = self.curl('/admin/config', 'POST')
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals((ret['data']['applied'], ret['data']['need_restart']), ([], []))
+
     def test_10_files(self):
         metadata = {'uid': 'blah', 'checksum': hashlib.sha512('foo bar').hexdigest(), 'locations': ['blah.dat']}
         ret = self.curl('/files', 'POST', metadata)
@@ -109,6 +138,8 @@ class TestServerAPI(unittest.TestCase):
         self.assertIn('files', ret['data'])
         self.assertEqual(len(ret['data']['files']), 1)
         self.assertIn(url, ret['data']['files'])
+        self.assertIn('parse;dur=', ret['headers']['server-timing'])
+        self.assertIn('db;dur=', ret['headers']['server-timing'])
 
         for m in ('PUT','DELETE','PATCH'):
             ret = self.curl('/files', m)
@@ -158,6 +189,15 @@ class TestServerAPI(unittest.TestCase):
         metadata['test2'] = 200
         print(ret)
         self.assertEquals(ret['status'], 200)
+        # dates are stored to the millisecond, as by MongoDB
+        date = parse_date(ret['data']['meta_modify_date'])
+        self.assertEqual(date.microsecond % 1000, 0)
+
+        # the ETag of the response is that of the stored document
+        ret = self.curl(url, 'PATCH', prefix='', args={'test2':200},
+                        headers={'If-None-Match':ret['headers']['etag']})
+        print(ret)
+        self.assertEquals(ret['status'], 200)
         ret['data'].pop('mongo_id')
         ret['data'].pop('_links')
         ret['data'].pop('meta_modify_date')
@@ -180,6 +220,341 @@ class TestServerAPI(unittest.TestCase):
         self.assertEquals(ret['status'], 405)
         
 
+    def test_30_stats(self):
+        data = {
+            'uid': 'foo',
+            'checksum': hashlib.sha512('foo').hexdigest(),
+            'locations': ['gsiftp://gridftp.icecube.wisc.edu/data/foo',
+                          '/data/foo'],
+            'file_size': 100,
+            'dataset': 12345,
+        }
+        ret = self.curl('/files', 'POST', data)
+        self.assertEquals(ret['status'], 201)
+        url = ret['data']['file']
+
+        ret = self.curl('/stats', 'GET')
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals(ret['data']['files'], 1)
+        self.assertEquals(ret['data']['bytes'], 100)
+        self.assertEquals(ret['data']['datasets'], {'12345': {'files': 1, 'bytes': 100}})
+        self.assertEquals(ret['data']['sites'], {
+            'gridftp.icecube.wisc.edu': {'replicas': 1, 'bytes': 100},
+            'unknown': {'replicas': 1, 'bytes': 100},
+        })
+
+        ret = self.curl(url, 'GET', prefix='')
+        ret = self.curl(url, 'PATCH', prefix='', args={'file_size': 50},
+                        headers={'If-None-Match':ret['headers']['etag']})
+        self.assertEquals(ret['status'], 200)
+        ret = self.curl('/stats', 'GET')
+        self.assertEquals(ret['data']['bytes'], 50)
+        self.assertEquals(ret['data']['sites']['unknown']['bytes'], 50)
+
+        ret = self.curl(url, 'DELETE', prefix='')
+        self.assertEquals(ret['status'], 204)
+        ret = self.curl('/stats', 'GET')
+        self.assertEquals(ret['data']['files'], 0)
+        self.assertEquals(ret['data']['datasets'], {})
+        self.assertEquals(ret['data']['sites'], {})
+
+    def test_40_slow_queries(self):
+        ret = self.curl('/files', 'GET', {'query': json_encode({'uid': 'foo'})})
+        self.assertEquals(ret['status'], 200)
+        ret = self.curl('/files', 'GET', {'query': json_encode({'uid': 'bar'})})
+        self.assertEquals(ret['status'], 200)
+
+        ret = self.curl('/admin/slow_queries', 'GET')
+        self.assertEquals(ret['status'], 200)
+        shapes = {q['shape']: q for q in ret['data']['queries']}
+        self.assertIn('{"uid":"?"}', shapes)
+        self.assertEquals(shapes['{"uid":"?"}']['count'], 2)
+
+        ret = self.curl('/admin/slow_queries', 'DELETE')
+        self.assertEquals(ret['status'], 204)
+        ret = self.curl('/admin/slow_queries', 'GET')
+        self.assertEquals(ret['data']['queries'], [])
+
+    def test_50_files_query(self):
+        for i in range(3):
+            metadata = {'uid': 'f%d' % i, 'checksum': hashlib.sha512('f%d' % i).hexdigest(),
+                        'locations': ['f%d.dat' % i], 'size': 10*i, 'run': {'number': i%2}}
+            ret = self.curl('/files', 'POST', metadata)
+            self.assertEquals(ret['status'], 201)
+
+        ret = self.curl('/files/query', 'POST', {
+            'query': {'size': {'$gte': 10}},
+            'fields': ['size', 'run.number'],
+            'sort': [['size', -1]],
+            'limit': 5,
+        })
+        self.assertEquals(ret['status'], 200)
+        files = ret['data']['_embedded']['files']
+        self.assertEquals([f['uid'] for f in files], ['f2', 'f1'])
+        self.assertEquals(files[0]['size'], 20)
+        self.assertEquals(files[0]['run'], {'number': 0})
+        self.assertEquals(len(ret['data']['files']), 2)
+
+        ret = self.curl('/files/query', 'POST', {'sort': [['size', 1]], 'start': 1})
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f1', 'f2'])
+        self.assertNotIn('next', ret['data']['_links'])
+
+        # a full page links to the next one
+        ret = self.curl('/files/query', 'POST', {'sort': [['size', 1]], 'limit': 2})
+        self.assertEquals(ret['data']['_links']['next']['start'], 2)
+        ret = self.curl('/files/query', 'POST', {'sort': [['size', 1]], 'limit': 2, 'start': 2})
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f2'])
+        self.assertNotIn('next', ret['data']['_links'])
+
+        ret = self.curl('/files/query', 'POST', {'sort': 'size'})
+        self.assertEquals(ret['status'], 400)
+        ret = self.curl('/files/query', 'POST', {'where': {}})
+        self.assertEquals(ret['status'], 400)
+        ret = self.curl('/files/query', 'GET')
+        self.assertEquals(ret['status'], 405)
+
+    def test_60_sort(self):
+        for i in range(3):
+            metadata = {'uid': 'f%d' % i, 'checksum': hashlib.sha512('f%d' % i).hexdigest(),
+                        'locations': ['f%d.dat' % i]}
+            ret = self.curl('/files', 'POST', metadata)
+            self.assertEquals(ret['status'], 201)
+
+        ret = self.curl('/files', 'GET', {'sort': '-uid', 'limit': 2})
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f2', 'f1'])
+
+        ret = self.curl('/files', 'GET', {'sort': ','})
+        self.assertEquals(ret['status'], 400)
+
+    def test_70_modified(self):
+        metadata = {'uid': 'f0', 'checksum': hashlib.sha512('f0').hexdigest(),
+                    'locations': ['f0.dat']}
+        ret = self.curl('/files', 'POST', metadata)
+        self.assertEquals(ret['status'], 201)
+        ret = self.curl(ret['data']['file'], 'GET', prefix='')
+        modified = ret['data']['meta_modify_date']
+
+        ret = self.curl('/files', 'GET', {'modified_since': modified})
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f0'])
+        ret = self.curl('/files', 'GET', {'modified_before': modified})
+        self.assertEquals(ret['data']['_embedded']['files'], [])
+        ret = self.curl('/files/query', 'POST', {'query': {'uid': 'f0'},
+                                                 'modified_since': '2000-01-01'})
+        self.assertEquals(len(ret['data']['_embedded']['files']), 1)
+
+        ret = self.curl('/files', 'GET', {'modified_since': 'yesterday'})
+        self.assertEquals(ret['status'], 400)
+
+    def wait_bulk(self, url):
+        for _ in range(100):
+            ret = self.curl(url, 'GET', prefix='')
+            self.assertEquals(ret['status'], 200)
+            if ret['data']['state'] != 'running':
+                return ret['data']
+            time.sleep(0.05)
+        self.fail('bulk operation did not finish')
+
+    def test_80_bulk_delete(self):
+        for i in range(5):
+            metadata = {'uid': 'f%d' % i, 'checksum': hashlib.sha512('f%d' % i).hexdigest(),
+                        'locations': ['f%d.dat' % i], 'dataset': 'old' if i < 4 else 'new'}
+            ret = self.curl('/files', 'POST', metadata)
+            self.assertEquals(ret['status'], 201)
+
+        ret = self.curl('/bulk/delete', 'POST', {'query': {}})
+        self.assertEquals(ret['status'], 400)
+
+        ret = self.curl('/bulk/delete', 'POST', {'query': {'dataset': 'old'}, 'dry_run': True})
+        self.assertEquals(ret['status'], 200)
+        self.assertEquals(ret['data']['matched'], 4)
+
+        ret = self.curl('/bulk/delete', 'POST', {'query': {'dataset': 'old'}, 'batch_size': 3})
+        self.assertEquals(ret['status'], 202)
+        self.assertEquals(ret['data']['matched'], 4)
+        op = self.wait_bulk(ret['headers']['location'])
+        self.assertEquals((op['state'], op['processed'], op['batches']), ('done', 4, 2))
+
+        ret = self.curl('/files', 'GET')
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f4'])
+        ret = self.curl('/bulk', 'GET')
+        self.assertEquals([o['id'] for o in ret['data']['jobs']], [op['id']])
+
+    def test_90_bulk_update(self):
+        for i in range(4):
+            metadata = {'uid': 'f%d' % i, 'checksum': hashlib.sha512('f%d' % i).hexdigest(),
+                        'locations': ['f%d.dat' % i], 'dataset': 'a'}
+            if i == 3:
+                # already updated
+                metadata['site'] = 'x'
+                metadata['locations'].append('f0.dat')
+            ret = self.curl('/files', 'POST', metadata)
+            self.assertEquals(ret['status'], 201)
+
+        for update in ({'$unset': {'checksum': ''}}, {'$set': {'uid': 'x'}},
+                       {'$set': {'locations': []}}, {'$pull': {'dataset': 'a'}},
+                       {'$rename': {'a': 'b'}}):
+            ret = self.curl('/bulk/update', 'POST', {'query': {'dataset': 'a'}, 'update': update})
+            self.assertEquals(ret['status'], 400)
+
+        update = {'$set': {'site': 'x'}, '$addToSet': {'locations': 'f0.dat'}}
+        ret = self.curl('/bulk/update', 'POST', {'query': {'dataset': 'a'},
+                                                 'update': update, 'dry_run': True})
+        self.assertEquals(ret['data']['matched'], 3)
+        ret = self.curl('/bulk/update', 'POST', {'query': {'dataset': 'a'},
+                                                 'update': update, 'batch_size': 2})
+        self.assertEquals(ret['status'], 202)
+        op = self.wait_bulk(ret['headers']['location'])
+        self.assertEquals((op['state'], op['processed'], op['modified']), ('done', 3, 3))
+
+        ret = self.curl('/files', 'GET', {'query': json_encode({'site': 'x'})})
+        self.assertEquals(len(ret['data']['_embedded']['files']), 4)
+        ret = self.curl('/files', 'GET', {'query': json_encode({'locations': 'f0.dat'})})
+        self.assertEquals(len(ret['data']['_embedded']['files']), 4)
+
+        # f0 would be left without a location
+        ret = self.curl('/bulk/update', 'POST', {'query': {'dataset': 'a'},
+                        'update': {'$pull': {'locations': 'f0.dat'}}})
+        op = self.wait_bulk(ret['headers']['location'])
+        self.assertEquals((op['state'], op['modified']), ('done', 3))
+        ret = self.curl('/files', 'GET', {'query': json_encode({'locations': 'f0.dat'})})
+        self.assertEquals([f['uid'] for f in ret['data']['_embedded']['files']], ['f0'])
+
+    def test_95_jobs_export(self):
+        for i in range(5):
+            metadata = {'uid': 'f%d' % i, 'checksum': hashlib.sha512('f%d' % i).hexdigest(),
+                        'locations': ['f%d.dat' % i], 'run': i % 2}
+            ret = self.curl('/files', 'POST', metadata)
+            self.assertEquals(ret['status'], 201)
+
+        ret = self.curl('/jobs/export', 'POST', {'query': {'run': 0}, 'fields': ['uid'],
+                                                 'batch_size': 2})
+        self.assertEquals(ret['status'], 202)
+        self.assertEquals(ret['data']['matched'], 3)
+        job = self.wait_bulk(ret['headers']['location'])
+        self.assertEquals((job['state'], job['processed'], job['chunks']), ('done', 3, 2))
+
+        ret = self.fetch(job['_links']['result']['href'])
+        self.assertEquals(ret.code, 200)
+        lines = [json_decode(l) for l in ret.body.splitlines()]
+        self.assertEquals([sorted(l) for l in lines], [['mongo_id', 'uid']]*3)
+        # in mongo_id order
+        self.assertEquals([l['mongo_id'] for l in lines], sorted(l['mongo_id'] for l in lines))
+        self.assertEquals(sorted(l['uid'] for l in lines), ['f0', 'f2', 'f4'])
+
+        ret = self.curl('/jobs', 'GET', {'state': 'done'})
+        self.assertEquals([j['id'] for j in ret['data']['jobs']], [job['id']])
+        ret = self.curl(job['_links']['self']['href'], 'DELETE', prefix='')
+        self.assertEquals(ret['status'], 409)
+        ret = self.curl('/jobs/0123abc', 'GET')
+        self.assertEquals(ret['status'], 404)
+
+class TestServerAPIMemory(TestServerAPI, AsyncHTTPTestCase):
+    """Runs the same API tests in-process against the memory backend"""
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+
+    def get_app(self):
+        server = Server(Config('server.cfg'), port=None, db=Memory(stats=Stats(), slow_log=SlowQueryLog()))
+        self.io_loop.add_callback(server.warmup)
+        return server.app
+
+    def curl(self, url, method='GET', args=None, prefix='/api', headers=None):
+        url = prefix+url
+        body = None
+        if args:
+            if method == 'GET':
+                url += '?'+jquery_encode(args)
+            else:
+                body = json_encode(args)
+        if body is None and method in ('POST','PUT','PATCH'):
+            body = ''
+        ret = self.fetch(url, method=method, body=body, headers=headers,
+                         allow_nonstandard_methods=True)
+        data = {}
+        try:
+            data = json_decode(ret.body)
+        except:
+            pass
+        return {
+            'status': ret.code,
+            'headers': {k.lower(): v for k,v in ret.headers.get_all()},
+            'data': data,
+        }
+
+class TestServerAPISharded(TestServerAPIMemory):
+    """Runs the same API tests against memory backends behind `Sharded`"""
+    def get_app(self):
+        slow_log = SlowQueryLog()
+        db = Sharded([Memory(stats=Stats(), slow_log=slow_log) for _ in range(3)],
+                     stats=Stats(), slow_log=slow_log)
+        server = Server(Config('server.cfg'), port=None, db=db)
+        self.io_loop.add_callback(server.warmup)
+        return server.app
+
+class OverloadedMemory(Memory):
+    """File listings that find a full queue, or start after their deadline"""
+    def __init__(self):
+        super(OverloadedMemory, self).__init__()
+        self.mode = None
+
+    def find_files(self, *args, **kwargs):
+        if self.mode == 'full':
+            raise QueueFull('too many requests queued')
+        if self.mode == 'slow':
+            time.sleep(0.05)
+        return super(OverloadedMemory, self).find_files(*args, **kwargs)
+
+class TestServerOverload(AsyncHTTPTestCase):
+    """Requests refused for lack of capacity are answered with 503"""
+    def get_app(self):
+        self.db = OverloadedMemory()
+        self.config = Config('server.cfg')
+        server = Server(self.config, port=None, db=self.db)
+        return server.app
+
+    def test_10_shed(self):
+        self.config['server']['request_timeout'] = 0.01
+        self.config['server']['retry_after'] = 7
+        ret = self.fetch('/api/files')
+        self.assertEqual(ret.code, 200)
+
+        for mode, message in (('full', 'queued'), ('slow', 'deadline')):
+            self.db.mode = mode
+            ret = self.fetch('/api/files')
+            self.assertEqual(ret.code, 503, mode)
+            self.assertEqual(ret.headers['Retry-After'], '7')
+            self.assertIn(message, json_decode(ret.body)['message'])
+
+class SlowIndexMemory(Memory):
+    """Index builds that last until `built` is set"""
+    def __init__(self):
+        super(SlowIndexMemory, self).__init__()
+        self.building = threading.Event()
+        self.built = threading.Event()
+
+    def ensure_indexes(self):
+        self.building.set()
+        self.built.wait(10)
+
+class TestServerStart(AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = SlowIndexMemory()
+        self.addCleanup(self.db.built.set)
+        self.server = Server(Config('server.cfg'), port=None, db=self.db)
+        return self.server.app
+
+    @gen_test
+    def test_10_index_build(self):
+        # ready, and serving, while the indexes are still being built
+        yield self.server.start()
+        self.assertTrue(self.db.building.wait(5))
+        ret = yield self.http_client.fetch(self.get_url('/health/ready'))
+        self.assertEqual(ret.code, 200)
+        ret = yield self.http_client.fetch(self.get_url('/api/files'))
+        self.assertEqual(ret.code, 200)
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestStringMethods)
     unittest.TextTestRunner(verbosity=2).run(suite)
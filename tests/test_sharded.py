@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import unittest
+from collections import Counter
+
+from file_catalog.memory import Memory
+from file_catalog.stats import Stats
+from file_catalog.sharded import HashRing, Sharded, new_id, id_shard, rebalance
+
+def add_files(db, n):
+    return [db.create_file({'uid': 'f%d' % i, 'checksum': 'c%d' % i, 'size': i % 7,
+                            'locations': ['f%d.dat' % i], 'file_size': 10,
+                            'meta_modify_date': datetime.datetime(2020, 1, 1)}).result()
+            for i in range(n)]
+
+class TestSharded(unittest.TestCase):
+    def test_10_ring(self):
+        keys = ['file_%d' % i for i in range(3000)]
+        ring = HashRing(3)
+        placed = {k: ring.shard(k) for k in keys}
+        counts = Counter(placed.values())
+        self.assertEqual(sorted(counts), [0, 1, 2])
+        self.assertTrue(min(counts.values()) > 600)
+
+        # a new shard only takes keys
+        ring = HashRing(4)
+        moved = [k for k in keys if ring.shard(k) != placed[k]]
+        self.assertTrue(all(ring.shard(k) == 3 for k in moved))
+        self.assertTrue(500 < len(moved) < 1000)
+
+        self.assertEqual(id_shard(new_id(2)), 2)
+        self.assertEqual(id_shard(str(new_id(255))), 255)
+        self.assertIsNone(id_shard('blah'))
+
+    def test_20_queries(self):
+        shards = [Memory(stats=Stats()) for _ in range(3)]
+        db = Sharded(shards, stats=Stats())
+        ids = add_files(db, 30)
+        self.assertTrue(all(len(s.docs) for s in shards))
+        for i in (0, 17):
+            self.assertEqual(db.get_file({'mongo_id': ids[i]}).result()['uid'], 'f%d' % i)
+            self.assertEqual(db.get_file({'uid': 'f%d' % i}).result()['mongo_id'], ids[i])
+        self.assertIsNone(db.get_file({'uid': 'nope'}).result())
+
+        single = Memory()
+        add_files(single, 30)
+        for kwargs in ({}, {'limit': 5, 'start': 3},
+                       {'sort': [('size', -1), ('uid', 1)], 'limit': 10, 'start': 4}):
+            expected = [f['uid'] for f in single.find_files({}, **kwargs).result()]
+            ret = db.find_files({}, **kwargs).result()
+            if 'sort' in kwargs:
+                self.assertEqual([f['uid'] for f in ret], expected)
+                self.assertEqual(sorted(ret[0]), ['mongo_id', 'uid'])
+            else:
+                self.assertEqual(len(ret), len(expected))
+                self.assertEqual([f['mongo_id'] for f in ret],
+                                 sorted(f['mongo_id'] for f in ret))
+        self.assertEqual(db.count_files({'size': 3}).result(), 4)
+
+        db.update_file({'mongo_id': ids[5], 'size': 100}).result()
+        self.assertEqual(db.get_file({'mongo_id': ids[5]}).result()['size'], 100)
+        db.delete_file({'mongo_id': ids[6]}).result()
+        self.assertIsNone(db.get_file({'mongo_id': ids[6]}).result())
+
+        cursor = db.export_cursor(after=ids[0])
+        docs = db.next_batch(cursor, 100).result()
+        self.assertEqual([str(d['_id']) for d in docs],
+                         sorted(i for i in ids if i > ids[0] and i != ids[6]))
+        self.assertEqual(db.get_stats().result()['files'], 29)
+
+        self.assertEqual(db.delete_files({'size': {'$lt': 3}}, 5).result(), 5)
+        self.assertEqual(db.delete_files({'size': {'$lt': 3}}, 100).result(), 9)
+
+    def test_30_rebalance(self):
+        shards = [Memory(stats=Stats()) for _ in range(2)]
+        ids = add_files(Sharded(shards), 40)
+
+        shards.append(Memory(stats=Stats()))
+        db = Sharded(shards, fallback=True)
+        misplaced = [i for i in range(40) if db.ring.shard('f%d' % i) == 2]
+        self.assertTrue(misplaced)
+        self.assertEqual(db.get_file({'uid': 'f%d' % misplaced[0]}).result()['mongo_id'],
+                         ids[misplaced[0]])
+
+        counts = rebalance(db)
+        # moved files are checked again on their new shard
+        self.assertEqual((counts['checked'], counts['moved']), (40+len(misplaced), len(misplaced)))
+        self.assertEqual(len(shards[2].docs), len(misplaced))
+        db.fallback = False
+        for i in range(40):
+            self.assertEqual(db.get_file({'uid': 'f%d' % i}).result()['mongo_id'], ids[i])
+            self.assertEqual(db.get_file({'mongo_id': ids[i]}).result()['uid'], 'f%d' % i)
+        db.update_file({'mongo_id': ids[misplaced[0]], 'size': 100}).result()
+        self.assertEqual(shards[2].get_file({'mongo_id': ids[misplaced[0]]}).result()['size'], 100)
+        self.assertEqual(db.get_stats().result()['files'], 40)
+        self.assertEqual(rebalance(db)['moved'], 0)
@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function
+
+from tornado.gen import coroutine, sleep, multi, Return
+from tornado.testing import AsyncTestCase, gen_test
+
+from file_catalog.memory import Memory
+from file_catalog.context import RequestContext
+from file_catalog.singleflight import SingleFlight, freeze
+
+class SlowMemory(Memory):
+    """Reads that take a while, so that identical ones overlap"""
+    def __init__(self):
+        super(SlowMemory, self).__init__()
+        self.reads = 0
+
+    @coroutine
+    def get_file(self, filters, ctx=None):
+        self.reads += 1
+        yield sleep(0.05)
+        ret = yield super(SlowMemory, self).get_file(filters, ctx=ctx)
+        raise Return(ret)
+
+    @coroutine
+    def find_files(self, *args, **kwargs):
+        self.reads += 1
+        yield sleep(0.05)
+        ret = yield super(SlowMemory, self).find_files(*args, **kwargs)
+        raise Return(ret)
+
+def reading():
+    return RequestContext(read_only=True)
+
+class TestSingleFlight(AsyncTestCase):
+    def test_10_freeze(self):
+        self.assertEqual(freeze({'a': [1, {'b': 2}], 'c': None}),
+                         freeze({'c': None, 'a': [1, {'b': 2}]}))
+        self.assertNotEqual(freeze({'a': 1}), freeze({'a': True}))
+        self.assertNotEqual(freeze([1]), freeze((1,)))
+
+    @gen_test
+    def test_20_coalesce(self):
+        backend = SlowMemory()
+        db = SingleFlight(backend)
+        mongo_id = yield db.create_file({'uid': 'a', 'locations': ['/a']})
+        filters = {'mongo_id': mongo_id}
+
+        files = yield multi([db.get_file(dict(filters), ctx=reading()) for _ in range(5)])
+        self.assertEqual(backend.reads, 1)
+        self.assertEqual([f['uid'] for f in files], ['a']*5)
+        # every caller has its own copy
+        files[0]['uid'] = 'changed'
+        self.assertEqual(files[1]['uid'], 'a')
+
+        # other arguments, causal tokens or writing requests do not share
+        backend.reads = 0
+        yield multi([db.find_files(query={'uid': 'a'}, limit=1, ctx=reading()),
+                     db.find_files(query={'uid': 'a'}, limit=1, ctx=reading()),
+                     db.find_files(query={'uid': 'a'}, limit=2, ctx=reading()),
+                     db.get_file(filters, ctx=RequestContext(read_only=True, causal_token='t')),
+                     db.get_file(filters, ctx=reading()),
+                     db.get_file(filters, ctx=RequestContext()),
+                     db.get_file(filters)])
+        self.assertEqual(backend.reads, 6)
+
+        db.enabled = False
+        backend.reads = 0
+        yield multi([db.get_file(filters, ctx=reading()) for _ in range(2)])
+        self.assertEqual(backend.reads, 2)
+
+    @gen_test
+    def test_30_writes(self):
+        backend = SlowMemory()
+        db = SingleFlight(backend)
+        mongo_id = yield db.create_file({'uid': 'a', 'locations': ['/a'], 'run': 1})
+        filters = {'mongo_id': mongo_id}
+
+        # a read after a write does not join one started before it
+        before = db.get_file(filters, ctx=reading())
+        yield db.update_file({'mongo_id': mongo_id, 'run': 2})
+        after = yield db.get_file(filters, ctx=reading())
+        self.assertEqual(backend.reads, 2)
+        self.assertEqual(after['run'], 2)
+        yield before
+
+        # errors reach every caller
+        backend.reads = 0
+        calls = [db.get_file({'mongo_id': 'bad'}, ctx=reading()) for _ in range(3)]
+        for call in calls:
+            with self.assertRaises(Exception):
+                yield call
+        self.assertEqual(backend.reads, 1)
+        self.assertEqual(db.flights, {})
@@ -0,0 +1,22 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from file_catalog.slowlog import SlowQueryLog, shape_key
+
+class TestSlowQueryLog(unittest.TestCase):
+    def test_10_shape(self):
+        self.assertEqual(shape_key({'uid': 'a', 'run.number': {'$gte': 1, '$lt': 5}}),
+                         '{"run.number":{"$gte":"?","$lt":"?"},"uid":"?"}')
+        self.assertEqual(shape_key({'$or': [{'uid': 'a'}, {'locations': {'$in': ['x', 'y']}}]}),
+                         '{"$or":[{"uid":"?"},{"locations":{"$in":["?"]}}]}')
+
+    def test_20_top(self):
+        log = SlowQueryLog(threshold_ms=10, max_shapes=2)
+        log.record({'uid': 'a'}, 5, 1)
+        log.record({'uid': 'b'}, 20, 1, examined=100)
+        log.record({'checksum': 'c'}, 1, 0)
+        log.record({'size': 1}, 2, 0)
+        top = log.top()
+        self.assertEqual([q['shape'] for q in top], ['{"uid":"?"}', '{"size":"?"}'])
+        self.assertEqual((top[0]['count'], top[0]['slow'], top[0]['examined']), (2, 1, 100))
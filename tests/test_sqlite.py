@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from file_catalog.sqlite import SQLite, translate
+from file_catalog.stats import Stats
+
+class TestSQLite(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = SQLite(path=os.path.join(self.tmpdir, 'test.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_10_translate(self):
+        where, params = translate({'uid': 'a'})
+        self.assertIn('uid', where)
+        self.assertEqual(params, ['a'])
+        with self.assertRaises(Exception):
+            translate({'uid': {'$where': 'true'}})
+
+    def test_20_queries(self):
+        db = self.db
+        ids = [db.create_file({'uid': str(i), 'checksum': 'c%d' % (i%2),
+                               'size': i, 'locations': ['f%d' % i],
+                               'run': {'number': i%3}}).result()
+               for i in range(10)]
+        ret = db.find_files({'checksum': 'c1'}, limit=2, start=1).result()
+        self.assertEqual([r['uid'] for r in ret], ['3', '5'])
+        ret = db.find_files({'locations': 'f4'}).result()
+        self.assertEqual(ret, [{'mongo_id': ids[4], 'uid': '4'}])
+        ret = db.find_files({'run.number': 2, 'size': {'$gte': 5}}).result()
+        self.assertEqual([r['uid'] for r in ret], ['5', '8'])
+        ret = db.find_files({'$or': [{'uid': '1'}, {'size': {'$in': [2, 3]}}]}).result()
+        self.assertEqual([r['uid'] for r in ret], ['1', '2', '3'])
+
+        db.update_file({'mongo_id': ids[1], 'checksum': 'c0'}).result()
+        self.assertEqual(len(db.find_files({'checksum': 'c1'}).result()), 4)
+        self.assertEqual(db.get_file({'uid': '1'}).result()['checksum'], 'c0')
+
+        db.delete_file({'mongo_id': ids[0]}).result()
+        self.assertIsNone(db.get_file({'mongo_id': ids[0]}).result())
+        with self.assertRaises(Exception):
+            db.delete_file({'mongo_id': ids[0]}).result()
+
+    def test_30_stats(self):
+        db = SQLite(path=os.path.join(self.tmpdir, 'stats.sqlite'), stats=Stats())
+        ids = [db.create_file({'uid': str(i), 'file_size': 10, 'dataset': i%2,
+                               'locations': ['gsiftp://a.b/f%d' % i]}).result()
+               for i in range(4)]
+        db.update_file({'mongo_id': ids[0], 'file_size': 20}).result()
+        db.delete_file({'mongo_id': ids[1]}).result()
+        ret = db.get_stats().result()
+        self.assertEqual((ret['files'], ret['bytes']), (3, 40))
+        self.assertEqual(ret['datasets'], {'0': {'files': 2, 'bytes': 30},
+                                           '1': {'files': 1, 'bytes': 10}})
+        self.assertEqual(ret['sites'], {'a.b': {'replicas': 3, 'bytes': 40}})
+        self.assertIsNone(ret['reconciled'])
+
+        db.reconcile_stats()
+        ret2 = db.get_stats().result()
+        self.assertIsNotNone(ret2.pop('reconciled'))
+        ret.pop('reconciled')
+        self.assertEqual(ret, ret2)
+
+    def test_40_bulk_delete(self):
+        db = SQLite(path=os.path.join(self.tmpdir, 'bulk.sqlite'), stats=Stats())
+        for i in range(5):
+            db.create_file({'uid': str(i), 'file_size': 10, 'dataset': i%2,
+                            'locations': ['f%d' % i]}).result()
+        self.assertEqual(db.count_files({'dataset': 0}).result(), 3)
+        self.assertEqual(db.delete_files({'dataset': 0}, 2).result(), 2)
+        self.assertEqual(db.delete_files({'dataset': 0}, 2).result(), 1)
+        self.assertEqual(db.delete_files({'dataset': 0}, 2).result(), 0)
+        self.assertEqual(db.get_stats().result()['files'], 2)
+
+        job = {'id': 'a', 'state': 'running', 'created': '2017-01-01', 'processed': 3}
+        db.save_job(job).result()
+        db.save_job(dict(job, id='b', state='done', created='2017-01-02')).result()
+        self.assertEqual(db.get_job('a').result(), job)
+        self.assertEqual([j['id'] for j in db.find_jobs().result()], ['b', 'a'])
+        self.assertEqual([j['id'] for j in db.find_jobs('running').result()], ['a'])
+
+        for seq in (1, 0, 2):
+            db.save_job_result('a', seq, 'chunk%d' % seq).result()
+        self.assertEqual(db.get_job_results('a', 1).result(), ['chunk1', 'chunk2'])
+        db.delete_job('a').result()
+        self.assertIsNone(db.get_job('a').result())
+        self.assertEqual(db.get_job_results('a').result(), [])
+
+    def test_45_warmup(self):
+        db = self.db
+        for i in range(3):
+            db.create_file({'uid': str(i), 'checksum': 'c', 'locations': ['f%d' % i]}).result()
+        db.warmup(prefetch=2)
+        self.assertEqual(len(db.executor.executor._threads), db.executor.max_workers)
+        db.ping().result()
+
+    def test_50_bulk_update(self):
+        db = SQLite(path=os.path.join(self.tmpdir, 'update.sqlite'), stats=Stats())
+        ids = [db.create_file({'uid': str(i), 'file_size': 10, 'dataset': 0,
+                               'locations': ['gsiftp://a/%d' % i, 'gsiftp://b/%d' % i]}).result()
+               for i in range(3)]
+        update = {'$set': {'dataset': 1}, '$pull': {'locations': {'$in': ['gsiftp://a/0', 'gsiftp://a/1']}}}
+        self.assertEqual(db.update_files({'dataset': 0}, update, 2).result(), (2, 2, ids[1]))
+        self.assertEqual(db.update_files({'dataset': 0}, update, 2, after=ids[1]).result(),
+                         (1, 1, ids[2]))
+        self.assertEqual(db.get_file({'uid': '0'}).result()['locations'], ['gsiftp://b/0'])
+        self.assertEqual(db.get_stats().result()['sites'],
+                         {'a': {'replicas': 1, 'bytes': 10}, 'b': {'replicas': 3, 'bytes': 30}})
+
+        ret = db.find_files({'locations': {'$elemMatch': {'$nin': ['gsiftp://b/0']}}}).result()
+        self.assertEqual([r['uid'] for r in ret], ['1', '2'])
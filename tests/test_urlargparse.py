@@ -0,0 +1,22 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from file_catalog.urlargparse import parse, encode, get_type
+
+class TestURLArgParse(unittest.TestCase):
+    def test_10_get_type(self):
+        self.assertEqual(get_type('12'), 12)
+        self.assertEqual(get_type(' -3'), -3)
+        self.assertEqual(get_type('2.5'), 2.5)
+        self.assertEqual(get_type('1e3'), 1000.0)
+        self.assertEqual(get_type('foo'), 'foo')
+        self.assertEqual(get_type('nope'), 'nope')
+        self.assertEqual(get_type(''), '')
+
+    def test_20_parse(self):
+        self.assertEqual(parse('limit=10&start=5&query=%7B%22uid%22%3A%22a%22%7D'),
+                         {'limit': 10, 'start': 5, 'query': '{"uid":"a"}'})
+        args = {'query': {'run': {'number': 5}, 'locations': ['a', 'b']}, 'limit': 10}
+        self.assertEqual(parse(encode(args)), args)
+        self.assertEqual(parse('a[0][x]=1&a[1][x]=2'), {'a': {0: {'x': 1}, 1: {'x': 2}}})
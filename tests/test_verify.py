@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import hashlib
+import datetime
+import tempfile
+import unittest
+
+from file_catalog.verify import (site_filter, local_path, verification_tasks,
+                                 hash_file, record_requests, _verify, Throttle)
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_10_locations(self):
+        self.assertEqual(local_path('/data/a b.dat'), '/data/a b.dat')
+        self.assertEqual(local_path('file:///data/a%20b.dat'), '/data/a b.dat')
+        self.assertEqual(local_path('gsiftp://host.org:2811/data/a'), '/data/a')
+        self.assertEqual(local_path('/data/a', mount='/mnt'), '/mnt/data/a')
+        self.assertEqual(site_filter('host.org')['locations']['$regex'],
+                         r'^[a-zA-Z][a-zA-Z0-9+.-]*://host\.org([:/]|$)')
+
+        verified = datetime.datetime(2020, 1, 2)
+        doc = {'_id': 1, 'checksum': 'c',
+               'locations': ['/data/a', 'file:///data/b', 'gsiftp://host.org/data/a'],
+               'verified': [{'location': '/data/a', 'date': verified}]}
+        self.assertEqual([t[1] for t in verification_tasks(doc, 'unknown')],
+                         ['/data/a', 'file:///data/b'])
+        self.assertEqual([t[1] for t in verification_tasks(doc, 'unknown',
+                                                           verified_after=datetime.datetime(2020, 1, 1))],
+                         ['file:///data/b'])
+        self.assertEqual(verification_tasks(doc, 'host.org'),
+                         [(1, 'gsiftp://host.org/data/a', '/data/a', 'c')])
+
+    def test_20_hash(self):
+        data = os.urandom(1000) * 100
+        path = self.write('a', data)
+        expected = hashlib.sha512(data).hexdigest()
+        for use_mmap in (True, False):
+            self.assertEqual(hash_file(path, use_mmap, block_size=4096), (expected, len(data)))
+        self.assertEqual(hash_file(self.write('empty', b'')),
+                         (hashlib.sha512(b'').hexdigest(), 0))
+
+        self.assertTrue(_verify((1, 'a', path, expected))[1])
+        self.assertEqual(_verify((1, 'a', path, 'c'))[1:], (False, 'checksum mismatch', len(data)))
+        missing = _verify((1, 'b', os.path.join(self.tmpdir, 'b'), 'c'))
+        self.assertFalse(missing[1])
+        self.assertEqual(missing[3], 0)
+
+        date = datetime.datetime(2020, 1, 1)
+        requests = record_requests([missing], 'unknown', date)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0]._filter, {'_id': 1, 'checksum': 'c'})
+        entry = requests[1]._doc['$push']['verified']
+        self.assertEqual((entry['location'], entry['ok'], entry['date']), ('b', False, date))
+        self.assertIn('error', entry)
+
+    def test_30_throttle(self):
+        throttle = Throttle(bytes_per_sec=1000, files_per_sec=10)
+        self.assertEqual(throttle.delay(), 0)
+        throttle.add(2000)
+        self.assertTrue(1.5 < throttle.delay() <= 2)
+        throttle = Throttle(files_per_sec=10)
+        for _ in range(50):
+            throttle.add(10**9)
+        self.assertTrue(4.5 < throttle.delay() <= 5)